@@ -0,0 +1,57 @@
+"""
+📏 قياس تكلفة تنسيق نتائج الاستعلام لكل طلب: بدون كاش ← مع cached_body
+- يقرأ bot_data.xlsx من المجلد الحالي (قراءة فقط) – شغّله من مجلد المشروع
+- "الطلب" = تنسيق أول ROWS صف (header + body + footer) كما في الاستعلام الحقيقي
+
+التشغيل:
+    python bench_render_cache.py [ROWS] [REPEAT]
+
+النتيجة على bot_data.xlsx المرفق (50 صف): part_line ≈ 612µs ← 92µs | independent ≈ 435µs ← 141µs
+"""
+import os
+import sys
+import timeit
+
+# main يقرأ التوكن عند الاستيراد فقط؛ لا يتم أي اتصال بتيليجرام هنا
+os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+
+import main  # noqa: E402
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+REPEAT = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+HEADER = "<code>🧑‍💻 استعلام خاص بـ مستخدم</code>\n\n"
+FOOTER = "\n<code>⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة</code>"
+
+
+def bench(kind: str, df, render) -> tuple:
+    rows = list(df.head(ROWS).iterrows())
+
+    def uncached():
+        return [f"{HEADER}{render(row)}{FOOTER}" for _, row in rows]
+
+    def cached():
+        return [f"{HEADER}{main.cached_body(kind, df, i, lambda: render(row))}{FOOTER}" for i, row in rows]
+
+    assert uncached() == cached()  # نفس النص بالضبط + تسخين الكاش
+    before = min(timeit.repeat(uncached, number=1, repeat=REPEAT))
+    after = min(timeit.repeat(cached, number=1, repeat=REPEAT))
+    return len(rows), before, after
+
+
+def main_cli():
+    cases = [
+        ("part_line", main.df_parts, main._render_part_line),
+        ("independent", main.df_independent, main._render_independent_body),
+    ]
+    print(f"{'kind':<12} {'rows':>5} {'uncached':>12} {'cached':>12} {'speedup':>8}")
+    for kind, df, render in cases:
+        if df.empty:
+            print(f"{kind:<12} {'—':>5}  (الشيت فارغ)")
+            continue
+        rows, before, after = bench(kind, df, render)
+        print(f"{kind:<12} {rows:>5} {before * 1e6:>10.0f}µs {after * 1e6:>10.0f}µs {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -2,23 +2,52 @@ import os
 import re
 import html
 import asyncio
+import inspect
+import importlib.util
+import json
+import pickle
+import socket
+import sqlite3
+import threading
+import contextvars
+import base64
+import hashlib
 import openpyxl
 import logging
 import pandas as pd
 from uuid import uuid4
 from datetime import datetime, timezone, timedelta, time
 from pathlib import Path
+from contextlib import asynccontextmanager, contextmanager
+from time import perf_counter, monotonic
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 import shutil
-import requests
-from typing import Optional
+import zlib
+import struct
+import heapq
+import zipfile
+try:
+    import fcntl  # قفل ملفات بين العمليات (لينكس فقط)
+except ImportError:
+    fcntl = None
+import httpx
+from types import MappingProxyType
+from typing import NamedTuple, Optional
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 import telegram.ext._jobqueue as tg_jobqueue
-from telegram.error import BadRequest
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter
 from telegram import InputMediaPhoto, InputMediaVideo, InputMediaDocument
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
 from telegram.constants import ParseMode
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -30,122 +59,2209 @@ from telegram.ext import (
 # 1) سجلات GO للاقتراحات والنقاشات
 # -----------------------------------------------------------
 
-suggestion_records = {}  # جميع اقتراحات المستخدمين
+# TICKETS / TEAM_THREADS تُعرّف بعد قسم الحالة المشتركة (SQLite داخل STATE_DIR)
 SUGGESTION_TICKET_COUNTER = 0  # عداد تذاكر مركز الدعم الفني (يزيد مع كل استفسار جديد)
+# أول رقم تذكرة مطلوب 2623 (تعويض الأرقام القديمة)، لذلك الأساس 2622
+TICKET_BASE_COUNTER = 2622
+TICKET_BLOCK_SIZE = 100  # عدد الأرقام المحجوزة دفعة واحدة من ملف العداد
+TICKET_COUNTER_SEED = 0  # آخر رقم محفوظ في bot_stats (يُقرأ مرة واحدة عند التحميل)
 SUGGESTION_REPLIES: dict[str, str] = {} 
 
-team_threads: dict[int, dict] = {}  # نقاشات فريق GO الداخلية
-TEAM_THREAD_COUNTER = 0
 # عدّاد استخدام GO في الذاكرة فقط (بدون كتابة مباشرة على Excel)
 GLOBAL_GO_COUNTER = 0
 
-SUPPORT_LOCK_TTL_MIN = 10  # مدة القفل بالدقائق
+# -----------------------------------------------------------
+# 2) نظام السجلات
+# -----------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    force=True
+)
+
+# -----------------------------------------------------------
+# 2-ب) قياسات الأداء (Prometheus) – كلها في الذاكرة وتُعرض على /metrics
+# -----------------------------------------------------------
+
+# حدود الهستوجرام بالثواني (مناسبة لزمن الهاندلرات وطلبات تيليجرام وأقفال الإكسل)
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS_META: dict[str, tuple[str, str]] = {}   # الاسم -> (النوع، الوصف)
+METRICS_VALUES: dict[tuple, float] = {}          # (الاسم، الوسوم) -> قيمة counter / gauge
+METRICS_HISTOGRAMS: dict[tuple, dict] = {}       # (الاسم، الوسوم) -> {"buckets", "sum", "count"}
+
+
+def metric_declare(name: str, kind: str, help_text: str):
+    """تعريف مقياس جديد (counter / gauge / histogram) مع وصفه."""
+    METRICS_META[name] = (kind, help_text)
+
+
+def _metric_key(name: str, labels: Optional[dict]):
+    if not labels:
+        return (name, ())
+    return (name, tuple(sorted((str(k), str(v)) for k, v in labels.items())))
+
+
+def metric_inc(name: str, labels: Optional[dict] = None, amount: float = 1.0):
+    key = _metric_key(name, labels)
+    METRICS_VALUES[key] = METRICS_VALUES.get(key, 0.0) + amount
+
+
+def metric_set(name: str, value: float, labels: Optional[dict] = None):
+    METRICS_VALUES[_metric_key(name, labels)] = float(value)
+
+
+def metric_observe(name: str, value: float, labels: Optional[dict] = None):
+    key = _metric_key(name, labels)
+    hist = METRICS_HISTOGRAMS.get(key)
+    if hist is None:
+        hist = {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0}
+        METRICS_HISTOGRAMS[key] = hist
+    for i, bound in enumerate(METRIC_BUCKETS):
+        if value <= bound:
+            hist["buckets"][i] += 1
+    hist["sum"] += value
+    hist["count"] += 1
+
+
+def _format_metric_labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    body = ",".join(
+        f'{k}="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def render_metrics() -> str:
+    """تحويل كل المقاييس إلى صيغة Prometheus النصية."""
+    lines = []
+    for name, (kind, help_text) in sorted(METRICS_META.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            for (m_name, labels), hist in sorted(METRICS_HISTOGRAMS.items()):
+                if m_name != name:
+                    continue
+                for bound, count in zip(METRIC_BUCKETS, hist["buckets"]):
+                    lines.append(f"{name}_bucket{_format_metric_labels(labels, ('le', repr(bound)))} {count}")
+                lines.append(f"{name}_bucket{_format_metric_labels(labels, ('le', '+Inf'))} {hist['count']}")
+                lines.append(f"{name}_sum{_format_metric_labels(labels)} {hist['sum']:.6f}")
+                lines.append(f"{name}_count{_format_metric_labels(labels)} {hist['count']}")
+        else:
+            for (m_name, labels), value in sorted(METRICS_VALUES.items()):
+                if m_name == name:
+                    lines.append(f"{name}{_format_metric_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+metric_declare("go_handler_latency_seconds", "histogram", "Handler latency keyed by the registered pattern.")
+metric_declare("go_handler_errors_total", "counter", "Unhandled exceptions raised by handlers.")
+metric_declare("go_telegram_api_latency_seconds", "histogram", "Telegram Bot API call latency by method.")
+metric_declare("go_telegram_api_errors_total", "counter", "Telegram Bot API errors by method and reason.")
+metric_declare("go_excel_lock_wait_seconds", "histogram", "Time spent waiting to acquire EXCEL_LOCK.")
+metric_declare("go_excel_lock_hold_seconds", "histogram", "Time EXCEL_LOCK was held.")
+metric_declare("go_event_loop_lag_seconds", "histogram", "Scheduling delay of the asyncio event loop.")
+metric_declare("go_event_loop_lag_last_seconds", "gauge", "Last measured event loop lag.")
+metric_declare("go_http_pool_size", "gauge", "Configured connection pool size per Telegram request pool.")
+metric_declare("go_http_pool_in_flight", "gauge", "Requests currently in flight per Telegram request pool.")
+metric_declare("go_http_pool_in_flight_peak", "gauge", "Highest in-flight count seen per Telegram request pool.")
+metric_declare("go_http_pool_timeouts_total", "counter", "Requests that gave up waiting for a free pooled connection.")
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest يقيس زمن كل طلب لتيليجرام وعدد الأخطاء حسب الـ method.
+
+    نفس الـ pool يُستخدم لطلبات HTTP الأخرى في البوت (keepalive) عبر http_client
+    بدل requests + ثريد منفصل.
+    """
+
+    def __init__(self, *args, pool_name: str = "api", keepalive_expiry: float = 30.0, **kwargs):
+        # لازم قبل super().__init__ لأن العميل يُبنى داخله
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(*args, **kwargs)
+        self.pool_name = pool_name
+        self._in_flight = 0
+        self._in_flight_peak = 0
+        metric_set("go_http_pool_size", self._client_kwargs["limits"].max_connections, {"pool": pool_name})
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs.get("limits")
+        if limits is not None:
+            self._client_kwargs["limits"] = httpx.Limits(
+                max_connections=limits.max_connections,
+                max_keepalive_connections=limits.max_keepalive_connections,
+                keepalive_expiry=self._keepalive_expiry,
+            )
+        return super()._build_client()
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """عميل httpx المشترك (يُعاد بناؤه تلقائيًا بعد initialize لو كان مغلقًا)."""
+        return self._client
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1] or "unknown"
+        pool_labels = {"pool": self.pool_name}
+        self._in_flight += 1
+        self._in_flight_peak = max(self._in_flight_peak, self._in_flight)
+        metric_set("go_http_pool_in_flight", self._in_flight, pool_labels)
+        metric_set("go_http_pool_in_flight_peak", self._in_flight_peak, pool_labels)
+        started = perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data=request_data, **kwargs)
+        except Exception as e:
+            metric_observe("go_telegram_api_latency_seconds", perf_counter() - started, {"method": api_method})
+            metric_inc("go_telegram_api_errors_total", {"method": api_method, "reason": type(e).__name__})
+            if "Pool timeout" in str(e):
+                metric_inc("go_http_pool_timeouts_total", pool_labels)
+            raise
+        finally:
+            self._in_flight -= 1
+            metric_set("go_http_pool_in_flight", self._in_flight, pool_labels)
+        metric_observe("go_telegram_api_latency_seconds", perf_counter() - started, {"method": api_method})
+        if code != 200:
+            metric_inc("go_telegram_api_errors_total", {"method": api_method, "reason": f"http_{code}"})
+        return code, payload
+
+
+# 🚦 طلبات الوسائط (صور/فيديو/ملفات) بطيئة وكبيرة؛ نعزلها في pool مستقل
+#    حتى لا تحجز اتصالات الرسائل والأزرار أثناء البث
+MEDIA_API_METHODS = frozenset({
+    "sendPhoto", "sendVideo", "sendDocument", "sendMediaGroup", "sendAnimation",
+    "sendAudio", "sendVoice", "sendVideoNote", "sendSticker", "editMessageMedia",
+})
+
+# ⏱️ مهلات حسب الـ method (تُطبق فقط إذا لم يمرر الاستدعاء مهلة صريحة)
+TELEGRAM_METHOD_TIMEOUTS = {
+    "answerCallbackQuery": {"read_timeout": 5.0},
+    "setWebhook": {"connect_timeout": 10.0, "read_timeout": 10.0},
+    "sendPhoto": {"read_timeout": 30.0, "write_timeout": 60.0},
+    "sendDocument": {"read_timeout": 60.0, "write_timeout": 120.0},
+    "sendVideo": {"read_timeout": 60.0, "write_timeout": 120.0},
+    "sendMediaGroup": {"read_timeout": 60.0, "write_timeout": 120.0},
+    "editMessageMedia": {"read_timeout": 30.0, "write_timeout": 60.0},
+    "getFile": {"read_timeout": 15.0},
+}
+
+
+class RoutedRequest(BaseRequest):
+    """يوزع طلبات Bot API على pool للرسائل العادية وpool للوسائط مع مهلات حسب الـ method."""
+
+    def __init__(self, api: InstrumentedRequest, media: InstrumentedRequest, method_timeouts: Optional[dict] = None):
+        self.api = api
+        self.media = media
+        self.method_timeouts = method_timeouts or {}
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.api.read_timeout
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return self.api.http_client
+
+    async def initialize(self) -> None:
+        await asyncio.gather(self.api.initialize(), self.media.initialize())
+
+    async def shutdown(self) -> None:
+        await asyncio.gather(self.api.shutdown(), self.media.shutdown())
+
+    def _pool_for(self, url: str, api_method: str, request_data) -> InstrumentedRequest:
+        if api_method in MEDIA_API_METHODS or "/file/bot" in url:
+            return self.media
+        if request_data is not None and request_data.contains_files:
+            return self.media
+        return self.api
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        for key, value in self.method_timeouts.get(api_method, {}).items():
+            if kwargs.get(key, BaseRequest.DEFAULT_NONE) is BaseRequest.DEFAULT_NONE:
+                kwargs[key] = value
+        pool = self._pool_for(url, api_method, request_data)
+        return await pool.do_request(url, method, request_data=request_data, **kwargs)
+
+
+def build_telegram_request() -> RoutedRequest:
+    """إعدادات الشبكة من البيئة؛ HTTP/2 فقط إن كانت حزمة h2 مثبتة (python-telegram-bot[http2])."""
+    want_http2 = (os.getenv("GO_HTTP2") or "1").strip() not in ("0", "false", "no")
+    http_version = "2" if want_http2 and importlib.util.find_spec("h2") is not None else "1.1"
+    if want_http2 and http_version != "2":
+        logging.warning("[HTTP] ⚠️ حزمة h2 غير مثبتة — سيتم استخدام HTTP/1.1")
+
+    keepalive_expiry = float(os.getenv("GO_HTTP_KEEPALIVE_EXPIRY", "30"))
+    api = InstrumentedRequest(
+        pool_name="api",
+        connection_pool_size=int(os.getenv("GO_HTTP_POOL_SIZE", "256")),
+        keepalive_expiry=keepalive_expiry,
+        http_version=http_version,
+        connect_timeout=float(os.getenv("GO_HTTP_CONNECT_TIMEOUT", "5")),
+        read_timeout=float(os.getenv("GO_HTTP_READ_TIMEOUT", "10")),
+        write_timeout=float(os.getenv("GO_HTTP_WRITE_TIMEOUT", "10")),
+        pool_timeout=float(os.getenv("GO_HTTP_POOL_TIMEOUT", "5")),
+    )
+    media = InstrumentedRequest(
+        pool_name="media",
+        connection_pool_size=int(os.getenv("GO_HTTP_MEDIA_POOL_SIZE", "32")),
+        keepalive_expiry=keepalive_expiry,
+        http_version=http_version,
+        connect_timeout=float(os.getenv("GO_HTTP_CONNECT_TIMEOUT", "5")),
+        read_timeout=30.0,
+        write_timeout=60.0,
+        pool_timeout=float(os.getenv("GO_HTTP_MEDIA_POOL_TIMEOUT", "15")),
+    )
+    logging.info(f"[HTTP] 🌐 pools: api={api.pool_name} media={media.pool_name} http_version={http_version}")
+    return RoutedRequest(api, media, TELEGRAM_METHOD_TIMEOUTS)
+
+
+# ----------------------------------------------------------------
+# 🚥 محدد معدل الإرسال لكل طلبات Bot API
+# - دلو tokens عام (حد تيليجرام ~30 رسالة/ثانية) + دلو لكل مجموعة (~20/دقيقة)
+#   المحادثات الخاصة بلا دلو محادثة (مثل AIORateLimiter في PTB) إلا بعد RetryAfter
+# - أولويات: ردود تفاعلية ← بث ← حذف/تنظيف (الأعلى يسبق في الدلو العام ودلو المجموعة)
+#   الحذف لا يستهلك حصة المحادثة إطلاقاً (فقط يحترم إيقاف RetryAfter)
+# - RetryAfter (429) يُعالج تلقائياً: إيقاف المحادثة المعنية ثم إعادة المحاولة
+# ----------------------------------------------------------------
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BROADCAST = 1
+PRIORITY_CLEANUP = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BROADCAST: "broadcast", PRIORITY_CLEANUP: "cleanup"}
 
-def _now_dt():
-    return datetime.now()
+OUTBOUND_PRIORITY = contextvars.ContextVar("go_outbound_priority", default=PRIORITY_INTERACTIVE)
 
-def _parse_dt(val):
+# طلبات لا تستهلك حصة الرسائل (لكن RetryAfter ما زال يُعالج لها)
+RATE_LIMIT_EXEMPT = frozenset({"answerCallbackQuery", "getMe", "setWebhook", "deleteWebhook", "getFile", "getChatMember"})
+CLEANUP_ENDPOINTS = frozenset({"deleteMessage", "deleteMessages"})
+
+metric_declare("go_rate_limit_wait_seconds", "histogram", "Time outbound calls waited for rate-limit tokens by priority.")
+metric_declare("go_rate_limit_retry_after_total", "counter", "RetryAfter (429) responses received by endpoint.")
+
+
+@contextmanager
+def outbound_priority(priority: int):
+    """كل طلبات تيليجرام داخل الـ with تأخذ هذه الأولوية (يشمل المهام المنشأة داخله)."""
+    token = OUTBOUND_PRIORITY.set(priority)
     try:
-        return datetime.fromisoformat(val)
-    except Exception:
+        yield
+    finally:
+        OUTBOUND_PRIORITY.reset(token)
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until", "waiting")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self.waiting = [0, 0, 0]  # عدد المنتظرين على هذا الدلو لكل أولوية
+
+    def delay(self, now: float) -> float:
+        """كم ثانية حتى يتوفر token (0 = متاح الآن)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class GoRateLimiter(BaseRateLimiter):
+    def __init__(
+        self,
+        overall_rate: float = 30.0,
+        private_chat_rate: Optional[float] = None,
+        group_chat_rate: float = 20 / 60,
+        chat_burst: float = 3.0,
+        max_retries: int = 3,
+    ):
+        self.overall = _TokenBucket(overall_rate, overall_rate)
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets: dict = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self.chat_buckets.clear()
+
+    def _chat_bucket(self, chat_id, create: bool = True) -> Optional[_TokenBucket]:
+        """دلو المحادثة؛ None للمحادثات الخاصة (لا حد لكل محادثة) ما لم يُنشأ بسبب RetryAfter."""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = str(chat_id).startswith("-") or str(chat_id).startswith("@")
+            rate = self.group_chat_rate if is_group else self.private_chat_rate
+            if rate is None:
+                if not create:
+                    return None
+                rate = self.overall.rate  # دلو للإيقاف المؤقت فقط
+            if len(self.chat_buckets) > 10000:
+                self._prune_chat_buckets()
+            bucket = _TokenBucket(rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_chat_buckets(self):
+        now = monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity and not any(bucket.waiting):
+                del self.chat_buckets[chat_id]
+
+    async def _take(self, bucket: _TokenBucket, priority: int):
+        """انتظار token من الدلو: لا نأخذ token وهناك منتظر بأولوية أعلى على نفس الدلو."""
+        bucket.waiting[priority] += 1
+        try:
+            while True:
+                wait = bucket.delay(monotonic())
+                if wait <= 0 and not any(bucket.waiting[:priority]):
+                    bucket.take()
+                    return
+                await asyncio.sleep(wait if wait > 0 else 1 / self.overall.rate)
+        finally:
+            bucket.waiting[priority] -= 1
+
+    async def _acquire(self, chat_id, priority: int):
+        # 1) حصة المحادثة (المجموعات فقط) — الحذف لا يستهلكها، فقط ينتظر انتهاء إيقاف RetryAfter
+        bucket = self._chat_bucket(chat_id, create=False) if chat_id is not None else None
+        if bucket is not None:
+            if priority == PRIORITY_CLEANUP:
+                wait = bucket.paused_until - monotonic()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = bucket.paused_until - monotonic()
+            else:
+                await self._take(bucket, priority)
+
+        # 2) الحصة العامة
+        await self._take(self.overall, priority)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = OUTBOUND_PRIORITY.get()
+        if isinstance(rate_limit_args, dict) and "priority" in rate_limit_args:
+            priority = rate_limit_args["priority"]
+        if endpoint in CLEANUP_ENDPOINTS:
+            priority = PRIORITY_CLEANUP
+        chat_id = data.get("chat_id")
+
+        for attempt in range(self.max_retries + 1):
+            if endpoint not in RATE_LIMIT_EXEMPT:
+                started = perf_counter()
+                await self._acquire(chat_id, priority)
+                metric_observe(
+                    "go_rate_limit_wait_seconds", perf_counter() - started, {"priority": PRIORITY_NAMES[priority]}
+                )
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metric_inc("go_rate_limit_retry_after_total", {"endpoint": endpoint})
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                # نوقف المحادثة المعنية (أو الكل إن لم تكن محادثة محددة)
+                target = self._chat_bucket(chat_id) if chat_id is not None else self.overall
+                target.paused_until = max(target.paused_until, monotonic() + retry_after)
+                if attempt >= self.max_retries:
+                    logging.warning(f"[RATE LIMIT] ❌ {endpoint} chat={chat_id}: استنفدت المحاولات بعد RetryAfter={retry_after}s")
+                    raise
+                logging.info(f"[RATE LIMIT] ⏳ {endpoint} chat={chat_id}: RetryAfter={retry_after}s (محاولة {attempt + 1})")
+                if endpoint in RATE_LIMIT_EXEMPT:
+                    await asyncio.sleep(retry_after)
+
+
+class TimedLock:
+    """asyncio.Lock يسجّل زمن الانتظار وزمن الإمساك بالقفل (نفس الاستخدام: async with)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = asyncio.Lock()
+        self._acquired_at = 0.0
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def __aenter__(self):
+        started = perf_counter()
+        await self._lock.acquire()
+        self._acquired_at = perf_counter()
+        metric_observe(f"go_{self.name}_wait_seconds", self._acquired_at - started)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        metric_observe(f"go_{self.name}_hold_seconds", perf_counter() - self._acquired_at)
+        self._lock.release()
+        return False
+
+
+def _handler_metric_label(handler) -> str:
+    """اسم الهاندلر في القياسات = النمط المسجل في add_handler."""
+    pattern = getattr(handler, "pattern", None)
+    if pattern is not None:
+        return getattr(pattern, "pattern", str(pattern))
+    commands = getattr(handler, "commands", None)
+    if commands:
+        return "/" + ",/".join(sorted(commands))
+    return f"{type(handler).__name__}:{getattr(handler.callback, '__name__', 'callback')}"
+
+
+def instrument_handlers(app_: Application):
+    """تغليف callback لكل هاندلر مسجل لقياس الزمن والأخطاء."""
+    for handlers in app_.handlers.values():
+        for handler in handlers:
+            if getattr(handler.callback, "_go_instrumented", False):
+                continue
+            label = _handler_metric_label(handler)
+            original = handler.callback
+
+            async def _timed_callback(update, context, _original=original, _label=label):
+                started = perf_counter()
+                try:
+                    async with shared_state_unit():
+                        result = _original(update, context)
+                        if inspect.isawaitable(result):
+                            result = await result
+                    return result
+                except Exception:
+                    metric_inc("go_handler_errors_total", {"handler": _label})
+                    raise
+                finally:
+                    metric_observe("go_handler_latency_seconds", perf_counter() - started, {"handler": _label})
+
+            _timed_callback._go_instrumented = True
+            handler.callback = _timed_callback
+
+
+EVENT_LOOP_LAG_INTERVAL = 0.5  # ثانية
+
+
+async def event_loop_lag_monitor():
+    """يقيس تأخر الـ event loop: الفرق بين موعد الاستيقاظ المتوقع والفعلي."""
+    while True:
+        expected = perf_counter() + EVENT_LOOP_LAG_INTERVAL
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = max(0.0, perf_counter() - expected)
+        metric_observe("go_event_loop_lag_seconds", lag)
+        metric_set("go_event_loop_lag_last_seconds", lag)
+        if lag > 1.0:
+            logging.warning(f"[METRICS] ⚠️ تأخر في event loop: {lag:.2f}s")
+
+# -----------------------------------------------------------
+# 3) تصحيح set_application داخل JobQueue لإزالة weakref
+# -----------------------------------------------------------
+
+def _patched_set_application(self, application):
+    """استبدال weakref بـ lambda للحفاظ على التطبيق دائماً."""
+    self._application = lambda: application
+
+tg_jobqueue.JobQueue.set_application = _patched_set_application
+
+# -----------------------------------------------------------
+# 4) إعداد التوكن
+# -----------------------------------------------------------
+
+API_TOKEN = os.getenv("TELEGRAM_TOKEN")
+
+# -----------------------------------------------------------
+# 5) تعريف initial_branches لتفادي NameError
+# -----------------------------------------------------------
+
+initial_branches = {
+    "CHERY": [],
+    "EXEED": [],
+    "MG": [],
+    "JETOUR": [],
+    "JAECOO / OMODA": [],
+    "BYD": [],
+    "SOUEAST": [],
+}
+# -----------------------------------------------------------
+# 6) تهيئة FastAPI + Telegram Application
+# -----------------------------------------------------------
+
+app = FastAPI()
+# 🌐 طبقة الشبكة: pool للرسائل + pool للوسائط، وkeepalive يستخدم pool الرسائل
+TELEGRAM_REQUEST = build_telegram_request()
+
+application = (
+    Application.builder()
+    .token(API_TOKEN)
+    .updater(None)
+    .request(TELEGRAM_REQUEST)
+    .rate_limiter(GoRateLimiter(
+        overall_rate=float(os.getenv("GO_RATE_OVERALL", "30")),
+        max_retries=int(os.getenv("GO_RATE_MAX_RETRIES", "3")),
+    ))
+    .build()
+)
+
+# 🧵 مهام الخلفية: نحتفظ بمراجعها حتى لا يجمعها garbage collector قبل انتهائها
+BACKGROUND_TASKS: set = set()
+
+def spawn_background(coro, name: Optional[str] = None):
+    # المهمة ترث وحدة عمل الحالة المشتركة؛ تعديلاتها بعد انتهاء الهاندلر تُحفظ عند انتهائها
+    unit = _STATE_UNIT.get()
+    if unit is not None:
+        coro = _flush_after(coro, unit)
+    task = asyncio.create_task(coro, name=name)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+# 📣 موزّع إشعارات المشرفين: إرسال متوازي بحد أقصى + جمع message_id في الخلفية
+ADMIN_FANOUT_CONCURRENCY = int(os.getenv("ADMIN_FANOUT_CONCURRENCY") or 8)
+
+metric_declare("go_admin_notifications_total", "counter", "Admin fan-out deliveries by tag and result.")
+
+
+async def _deliver_to_admins(send_one, admin_ids, record: Optional[dict], tag: str):
+    semaphore = asyncio.Semaphore(ADMIN_FANOUT_CONCURRENCY)
+
+    async def _one(aid):
+        async with semaphore:
+            try:
+                sent = await send_one(aid)
+            except Exception as e:
+                metric_inc("go_admin_notifications_total", {"tag": tag, "result": "failed"})
+                logging.warning(f"[{tag}] فشل إشعار المشرف {aid}: {e}")
+                return
+        metric_inc("go_admin_notifications_total", {"tag": tag, "result": "sent"})
+        if sent is not None and record is not None:
+            record.setdefault("admin_messages", {})[aid] = sent.message_id
+
+    await asyncio.gather(*(_one(aid) for aid in admin_ids))
+
+
+def notify_admins(send_one, record: Optional[dict] = None, tag: str = "ADMIN NOTIFY", admin_ids=None):
+    """
+    إرسال نفس الإشعار لكل المشرفين بدون تأخير المستخدم:
+    - send_one(admin_id) ترجع الرسالة المرسلة (أو None)
+    - لو تم تمرير record تُحفظ أرقام الرسائل في record["admin_messages"]
+    - ترجع المهمة (task) لمن يحتاج ينتظر اكتمال التسليم
+    """
+    targets = list(AUTHORIZED_USERS if admin_ids is None else admin_ids)
+    return spawn_background(_deliver_to_admins(send_one, targets, record, tag), name=f"notify_admins:{tag}")
+
+# 🔒 قفل واحد لعمليات الكتابة على ملف Excel لمنع التعارض والتلف (مع قياس الانتظار والإمساك)
+EXCEL_LOCK = TimedLock("excel_lock")
+
+# 📁 مجلد النسخ الاحتياطي لملف الإكسل
+BACKUP_DIR = Path("backups")
+try:
+    BACKUP_DIR.mkdir(exist_ok=True)
+except Exception as e:
+    logging.error(f"[BACKUP] ❌ فشل إنشاء مجلد النسخ الاحتياطي: {e}")
+
+# 📁 مجلد الحالة المحلية الدائمة (عدادات وسجلات صغيرة بدل ملف الإكسل الكامل)
+STATE_DIR = Path(os.getenv("GO_STATE_DIR") or "state")
+try:
+    STATE_DIR.mkdir(exist_ok=True)
+except Exception as e:
+    logging.error(f"[STATE] ❌ فشل إنشاء مجلد الحالة: {e}")
+
+
+def _read_json_file(path: Path, default=None):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        logging.warning(f"[STATE] ⚠️ فشل قراءة {path}: {e}")
+        return default
+
+
+def _write_json_file_atomic(path: Path, data):
+    """كتابة JSON بشكل ذري: ملف مؤقت + fsync + rename (لا يظهر نصف مكتوب أبداً)."""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class _FileLock:
+    """قفل حصري بين العمليات عبر flock (بدون أثر إذا fcntl غير متوفر)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = open(self.path, "a+")
+        if fcntl:
+            fcntl.flock(self._fd.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if fcntl:
+                fcntl.flock(self._fd.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._fd.close()
+            self._fd = None
+        return False
+
+# ================================================================
+#  🗄️ الحالة المشتركة بين العمليات (لتشغيل أكثر من worker)
+#  - GO_STATE_BACKEND: memory (افتراضي/تطوير) | sqlite | redis
+#  - memory يعيد dict/set عادية (نفس السلوك السابق تماماً وبدون أي تكلفة)
+#  - sqlite: ملف داخل STATE_DIR (نفس الجهاز)، redis: GO_REDIS_URL (أي خادم متوافق)
+#  - القيم تُحفظ بـ pickle؛ المفاتيح ints/strings
+# ================================================================
+STATE_BACKEND_KIND = (os.getenv("GO_STATE_BACKEND") or "memory").strip().lower()
+GO_WORKERS = max(int(os.getenv("GO_WORKERS") or 1), 1)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class MemoryStateBackend:
+    """تخزين داخل العملية فقط (للتطوير أو worker واحد)."""
+
+    shared = False
+
+    def __init__(self):
+        self._data: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, ns, key, default=None):
+        return self._data.get(ns, {}).get(key, default)
+
+    def set(self, ns, key, value):
+        self._data.setdefault(ns, {})[key] = value
+
+    def set_default(self, ns, key, value):
+        return self._data.setdefault(ns, {}).setdefault(key, value)
+
+    def delete(self, ns, key):
+        self._data.get(ns, {}).pop(key, None)
+
+    def contains(self, ns, key) -> bool:
+        return key in self._data.get(ns, {})
+
+    def keys(self, ns) -> list:
+        return list(self._data.get(ns, {}))
+
+    def items(self, ns) -> dict:
+        return dict(self._data.get(ns, {}))
+
+    def count(self, ns) -> int:
+        return len(self._data.get(ns, {}))
+
+    def set_many(self, ns, mapping: dict):
+        self._data.setdefault(ns, {}).update(mapping)
+
+    def seed_counter(self, ns, key, value: int) -> int:
+        with self._lock:
+            return self._data.setdefault(ns, {}).setdefault(key, int(value))
+
+    def incr(self, ns, key, amount: int = 1) -> int:
+        with self._lock:
+            bucket = self._data.setdefault(ns, {})
+            bucket[key] = int(bucket.get(key, 0)) + amount
+            return bucket[key]
+
+    def claim(self, ns, key, owner: str, ttl: float) -> bool:
+        with self._lock:
+            bucket = self._data.setdefault(ns, {})
+            current = bucket.get(key)
+            now = monotonic()
+            if current is None or current[0] == owner or current[1] < now:
+                bucket[key] = (owner, now + ttl)
+                return True
+            return False
+
+    def release(self, ns, key, owner: str):
+        with self._lock:
+            bucket = self._data.setdefault(ns, {})
+            if bucket.get(key, (None,))[0] == owner:
+                del bucket[key]
+
+    def holder(self, ns, key) -> Optional[str]:
+        with self._lock:
+            current = self._data.get(ns, {}).get(key)
+        return current[0] if current is not None and current[1] >= monotonic() else None
+
+    def push(self, queue: str, value):
+        self._data.setdefault("__queues__", {}).setdefault(queue, []).append(value)
+
+    def pop_all(self, queue: str) -> list:
+        return self._data.setdefault("__queues__", {}).pop(queue, [])
+
+
+class SQLiteStateBackend:
+    """ملف SQLite مشترك بين عمليات نفس الجهاز (WAL + busy_timeout)."""
+
+    shared = True
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (ns TEXT NOT NULL, key TEXT NOT NULL, value BLOB, PRIMARY KEY (ns, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters (ns TEXT NOT NULL, key TEXT NOT NULL, value INTEGER NOT NULL, PRIMARY KEY (ns, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS claims (ns TEXT NOT NULL, key TEXT NOT NULL, owner TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (ns, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, value BLOB NOT NULL)"
+        )
+
+    @staticmethod
+    def _k(key) -> str:
+        return json.dumps(key)
+
+    def get(self, ns, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM kv WHERE ns=? AND key=?", (ns, self._k(key))).fetchone()
+        return pickle.loads(row[0]) if row else default
+
+    def set(self, ns, key, value):
+        blob = pickle.dumps(value)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO kv (ns, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (ns, key) DO UPDATE SET value=excluded.value",
+                (ns, self._k(key), blob),
+            )
+
+    def set_default(self, ns, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO kv (ns, key, value) VALUES (?, ?, ?)", (ns, self._k(key), pickle.dumps(value))
+            )
+        return self.get(ns, key, value)
+
+    def delete(self, ns, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE ns=? AND key=?", (ns, self._k(key)))
+
+    def contains(self, ns, key) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM kv WHERE ns=? AND key=?", (ns, self._k(key))).fetchone() is not None
+
+    def keys(self, ns) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM kv WHERE ns=?", (ns,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def items(self, ns) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM kv WHERE ns=?", (ns,)).fetchall()
+        return {json.loads(key): pickle.loads(value) for key, value in rows}
+
+    def count(self, ns) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM kv WHERE ns=?", (ns,)).fetchone()[0]
+
+    def set_many(self, ns, mapping: dict):
+        rows = [(ns, self._k(key), pickle.dumps(value)) for key, value in mapping.items()]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO kv (ns, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (ns, key) DO UPDATE SET value=excluded.value",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def seed_counter(self, ns, key, value: int) -> int:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO counters (ns, key, value) VALUES (?, ?, ?)", (ns, self._k(key), int(value))
+            )
+        return self.incr(ns, key, 0)
+
+    def incr(self, ns, key, amount: int = 1) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "INSERT INTO counters (ns, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (ns, key) DO UPDATE SET value=value+excluded.value RETURNING value",
+                (ns, self._k(key), amount),
+            ).fetchone()[0]
+
+    def claim(self, ns, key, owner: str, ttl: float) -> bool:
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            row = self._conn.execute(
+                "INSERT INTO claims (ns, key, owner, expires) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (ns, key) DO UPDATE SET owner=excluded.owner, expires=excluded.expires "
+                "WHERE claims.owner=excluded.owner OR claims.expires < ? RETURNING owner",
+                (ns, self._k(key), owner, now + ttl, now),
+            ).fetchone()
+        return row is not None
+
+    def release(self, ns, key, owner: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM claims WHERE ns=? AND key=? AND owner=?", (ns, self._k(key), owner))
+
+    def holder(self, ns, key) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT owner FROM claims WHERE ns=? AND key=? AND expires >= ?",
+                (ns, self._k(key), datetime.now(timezone.utc).timestamp()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def push(self, queue: str, value):
+        with self._lock:
+            self._conn.execute("INSERT INTO queue (name, value) VALUES (?, ?)", (queue, pickle.dumps(value)))
+
+    def pop_all(self, queue: str) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "DELETE FROM queue WHERE name=? RETURNING id, value", (queue,)
+            ).fetchall()
+        return [pickle.loads(value) for _, value in sorted(rows)]
+
+
+class RedisStateBackend:
+    """أي خادم متوافق مع Redis (redis / valkey / keydb) — يحتاج حزمة redis."""
+
+    shared = True
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("GO_STATE_BACKEND=redis يتطلب تثبيت الحزمة: pip install redis") from e
+        self._r = redis.Redis.from_url(url)
+        self._r.ping()
+
+    @staticmethod
+    def _h(ns) -> str:
+        return f"go:{ns}"
+
+    @staticmethod
+    def _k(key) -> str:
+        return json.dumps(key)
+
+    def get(self, ns, key, default=None):
+        raw = self._r.hget(self._h(ns), self._k(key))
+        return pickle.loads(raw) if raw is not None else default
+
+    def set(self, ns, key, value):
+        self._r.hset(self._h(ns), self._k(key), pickle.dumps(value))
+
+    def set_default(self, ns, key, value):
+        self._r.hsetnx(self._h(ns), self._k(key), pickle.dumps(value))
+        return self.get(ns, key, value)
+
+    def delete(self, ns, key):
+        self._r.hdel(self._h(ns), self._k(key))
+
+    def contains(self, ns, key) -> bool:
+        return bool(self._r.hexists(self._h(ns), self._k(key)))
+
+    def keys(self, ns) -> list:
+        return [json.loads(k) for k in self._r.hkeys(self._h(ns))]
+
+    def items(self, ns) -> dict:
+        return {json.loads(k): pickle.loads(v) for k, v in self._r.hgetall(self._h(ns)).items()}
+
+    def count(self, ns) -> int:
+        return int(self._r.hlen(self._h(ns)))
+
+    def set_many(self, ns, mapping: dict):
+        if mapping:
+            self._r.hset(self._h(ns), mapping={self._k(k): pickle.dumps(v) for k, v in mapping.items()})
+
+    def seed_counter(self, ns, key, value: int) -> int:
+        self._r.hsetnx(f"go:counters:{ns}", self._k(key), int(value))
+        return self.incr(ns, key, 0)
+
+    def incr(self, ns, key, amount: int = 1) -> int:
+        return int(self._r.hincrby(f"go:counters:{ns}", self._k(key), amount))
+
+    def claim(self, ns, key, owner: str, ttl: float) -> bool:
+        name = f"go:claim:{ns}:{self._k(key)}"
+        if self._r.set(name, owner, nx=True, px=int(ttl * 1000)):
+            return True
+        current = self._r.get(name)
+        if current is not None and current.decode() == owner:
+            self._r.pexpire(name, int(ttl * 1000))
+            return True
+        return False
+
+    _RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def release(self, ns, key, owner: str):
+        self._r.eval(self._RELEASE_SCRIPT, 1, f"go:claim:{ns}:{self._k(key)}", owner)
+
+    def holder(self, ns, key) -> Optional[str]:
+        current = self._r.get(f"go:claim:{ns}:{self._k(key)}")
+        return current.decode() if current is not None else None
+
+    def push(self, queue: str, value):
+        self._r.rpush(f"go:queue:{queue}", pickle.dumps(value))
+
+    def pop_all(self, queue: str) -> list:
+        name = f"go:queue:{queue}"
+        pipe = self._r.pipeline(transaction=True)
+        pipe.lrange(name, 0, -1)
+        pipe.delete(name)
+        items, _ = pipe.execute()
+        return [pickle.loads(raw) for raw in items]
+
+
+def _build_state_backend():
+    try:
+        if STATE_BACKEND_KIND == "sqlite":
+            return SQLiteStateBackend(Path(os.getenv("GO_SQLITE_PATH") or STATE_DIR / "shared_state.sqlite3"))
+        if STATE_BACKEND_KIND == "redis":
+            return RedisStateBackend(os.getenv("GO_REDIS_URL") or "redis://127.0.0.1:6379/0")
+    except Exception as e:
+        logging.error(f"[STATE] ❌ فشل تهيئة الحالة المشتركة ({STATE_BACKEND_KIND}): {e} — سيتم استخدام الذاكرة")
+    return MemoryStateBackend()
+
+
+STATE_BACKEND = _build_state_backend()
+if GO_WORKERS > 1 and not STATE_BACKEND.shared:
+    logging.error("[STATE] ❌ GO_WORKERS > 1 يتطلب GO_STATE_BACKEND=sqlite أو redis — سيتم العمل كـ worker واحد")
+    GO_WORKERS = 1
+
+# وحدة عمل لكل تحديث: القيم المقروءة من SharedDict تُعدّل في مكانها ثم تُكتب مرة واحدة في النهاية
+_STATE_UNIT = contextvars.ContextVar("go_state_unit", default=None)
+
+# 🧵 لا استدعاء لـ STATE_BACKEND على حلقة الأحداث:
+# - SharedDict / SharedSet تقرأ من نسخة محلية، تُحدَّث كل SHARED_CACHE_TTL ثانية (refresh_shared_state_job)
+# - الكتابة تُطبّق محلياً فوراً ثم تُرسل لـ thread واحد بالترتيب (SHARED_STATE_IO) بدون انتظار
+# - نهاية وحدة العمل تُكتب في نفس الـ thread وتُنتظر (التحديث التالي يرى ما كُتب)
+SHARED_CACHE_TTL = float(os.getenv("GO_SHARED_CACHE_TTL") or 5)
+SHARED_STATE_IO = ThreadPoolExecutor(max_workers=1, thread_name_prefix="go-state")
+SHARED_CACHES: dict = {}  # ns → SharedDict / SharedSet
+
+
+def _log_state_io_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"[STATE] ❌ فشل الكتابة في الحالة المشتركة: {future.exception()}")
+
+
+def _state_io(fn, *args):
+    """استدعاء STATE_BACKEND: في SHARED_STATE_IO إن كانت حلقة الأحداث تعمل (بدون انتظار)، وإلا مباشرة (الإقلاع)."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return fn(*args)
+    future = loop.run_in_executor(SHARED_STATE_IO, fn, *args)
+    future.add_done_callback(_log_state_io_error)
+    return future
+
+
+class SharedDict(MutableMapping):
+    """dict محفوظ في STATE_BACKEND. التعديل الداخلي (record["x"] = ...) يُحفظ عند نهاية وحدة العمل."""
+
+    def __init__(self, ns: str):
+        self.ns = ns
+        self._data = STATE_BACKEND.items(ns)
+        self._version = 0  # يزيد مع كل كتابة محلية؛ refresh لا يستبدل نسخة تغيّرت أثناء القراءة
+        SHARED_CACHES[ns] = self
+
+    async def refresh(self):
+        version = self._version
+        data = await asyncio.get_running_loop().run_in_executor(SHARED_STATE_IO, STATE_BACKEND.items, self.ns)
+        if version == self._version:
+            self._data = data
+
+    def _track(self, key, value):
+        unit = _STATE_UNIT.get()
+        if unit is not None:
+            unit[(self.ns, key)] = (value, pickle.dumps(value))
+        return value
+
+    def __getitem__(self, key):
+        unit = _STATE_UNIT.get()
+        if unit is not None and (self.ns, key) in unit:
+            return unit[(self.ns, key)][0]
+        return self._track(key, self._data[key])
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._version += 1
+        _state_io(STATE_BACKEND.set, self.ns, key, pickle.loads(pickle.dumps(value)))
+        self._track(key, value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._version += 1
+        _state_io(STATE_BACKEND.delete, self.ns, key)
+        unit = _STATE_UNIT.get()
+        if unit is not None:
+            unit.pop((self.ns, key), None)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedSet:
+    """set محفوظ في STATE_BACKEND (add / discard / in / len / iter) — القراءة من النسخة المحلية."""
+
+    def __init__(self, ns: str):
+        self.ns = ns
+        self._items = set(STATE_BACKEND.keys(ns))
+        self._version = 0
+        SHARED_CACHES[ns] = self
+
+    async def refresh(self):
+        version = self._version
+        items = await asyncio.get_running_loop().run_in_executor(SHARED_STATE_IO, STATE_BACKEND.keys, self.ns)
+        if version == self._version:
+            self._items = set(items)
+
+    def add(self, item):
+        self._items.add(item)
+        self._version += 1
+        _state_io(STATE_BACKEND.set, self.ns, item, 1)
+
+    def update(self, items):
+        items = set(items)
+        self._items |= items
+        self._version += 1
+        _state_io(STATE_BACKEND.set_many, self.ns, {item: 1 for item in items})
+
+    def discard(self, item):
+        self._items.discard(item)
+        self._version += 1
+        _state_io(STATE_BACKEND.delete, self.ns, item)
+
+    def clear(self):
+        self._items = set()
+        self._version += 1
+        _state_io(self._clear_backend)
+
+    def _clear_backend(self):
+        for item in STATE_BACKEND.keys(self.ns):
+            STATE_BACKEND.delete(self.ns, item)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(list(self._items))
+
+    def __len__(self):
+        return len(self._items)
+
+
+def shared_dict(ns: str):
+    return SharedDict(ns) if STATE_BACKEND.shared else {}
+
+
+def shared_set(ns: str, initial=()):
+    container = SharedSet(ns) if STATE_BACKEND.shared else set()
+    container.update(initial)
+    return container
+
+
+async def refresh_shared_state_job(context: ContextTypes.DEFAULT_TYPE):
+    """جلب تعديلات العمليات الأخرى إلى النسخ المحلية (خارج حلقة الأحداث)."""
+    for cache in list(SHARED_CACHES.values()):
+        try:
+            await cache.refresh()
+        except Exception as e:
+            logging.warning(f"[STATE] ⚠️ فشل تحديث {cache.ns}: {e}")
+
+
+def _write_shared_state(dirty: list) -> list:
+    """كتابة القيم المتغيرة (داخل SHARED_STATE_IO) → ما حُفظ فعلاً."""
+    saved = []
+    for ns, key, blob in dirty:
+        try:
+            value = pickle.loads(blob)
+            if isinstance(ns, str):
+                STATE_BACKEND.set(ns, key, value)
+            else:
+                ns.persist(key, value)  # مخزن له جدوله الخاص (مثل TICKETS)
+            saved.append((ns, key, blob))
+        except Exception as e:
+            logging.error(f"[STATE] ❌ فشل حفظ {ns}/{key}: {e}")
+    return saved
+
+
+async def flush_shared_state(unit: Optional[dict]):
+    """كتابة القيم التي تغيرت داخل وحدة العمل فقط (اللقطة تُؤخذ هنا، والكتابة خارج حلقة الأحداث)."""
+    if not unit:
+        return
+    dirty = []
+    for (ns, key), (value, snapshot) in list(unit.items()):
+        try:
+            current = pickle.dumps(value)
+        except Exception as e:
+            logging.error(f"[STATE] ❌ فشل حفظ {ns}/{key}: {e}")
+            continue
+        if current != snapshot:
+            dirty.append((ns, key, current))
+    if not dirty:
+        return
+    saved = await asyncio.get_running_loop().run_in_executor(SHARED_STATE_IO, _write_shared_state, dirty)
+    for ns, key, blob in saved:
+        if (ns, key) in unit:
+            unit[(ns, key)] = (unit[(ns, key)][0], blob)
+
+
+@asynccontextmanager
+async def shared_state_unit():
+    """وحدة عمل لتحديث واحد (المتداخلة تستخدم الوحدة الخارجية)."""
+    if _STATE_UNIT.get() is not None:
+        yield
+        return
+    unit = {}
+    token = _STATE_UNIT.set(unit)
+    try:
+        yield
+    finally:
+        _STATE_UNIT.reset(token)
+        await flush_shared_state(unit)
+
+
+async def _flush_after(coro, unit: dict):
+    """مهمة خلفية ترث وحدة العمل: تعديلاتها بعد انتهاء الهاندلر تُحفظ عند انتهائها."""
+    try:
+        return await coro
+    finally:
+        await flush_shared_state(unit)
+
+
+# 🔗 الحالة التي يجب أن تراها كل العمليات (تذاكر الدعم + نقاشات الفريق)
+
+# ================================================================
+#  🎫 مخزن تذاكر الدعم (بدل suggestion_records المتداخل في الذاكرة)
+#  - SQLite داخل STATE_DIR: يبقى بعد إعادة التشغيل ويُشارك بين عمليات نفس الجهاز
+#  - فهارس: رقم التذكرة (فريد) / المستخدم / الحالة (draft → open → replied)
+#  - المُجاب عليها والخاملة أكثر من TICKET_RETENTION_DAYS تُنقل لأرشيف مضغوط (zlib JSON)
+#  - المسودات غير المرسلة تُحذف بعد TICKET_DRAFT_TTL_HOURS
+#  - السجل المقروء يُعدّل في مكانه ويُحفظ مع نهاية وحدة العمل (مثل SharedDict)
+# ================================================================
+TICKETS_DB_PATH = Path(os.getenv("GO_TICKETS_DB") or STATE_DIR / "tickets.sqlite3")
+TICKET_RETENTION_DAYS = float(os.getenv("GO_TICKET_RETENTION_DAYS") or 30)
+TICKET_DRAFT_TTL_HOURS = float(os.getenv("GO_TICKET_DRAFT_TTL_HOURS") or 24)
+
+metric_declare("go_tickets", "gauge", "Live support tickets by status.")
+metric_declare("go_tickets_pruned_total", "counter", "Tickets removed from the live table by action.")
+
+
+def ticket_status(record: dict) -> str:
+    if not record.get("submitted"):
+        return "draft"
+    replies = str(record.get("reply_count") or 0)
+    if (replies.isdigit() and int(replies) > 0) or record.get("replied_by"):
+        return "replied"
+    return "open"
+
+
+class TicketStore:
+    """تذاكر مركز الدعم: get / create / by_number / for_status / discard_drafts / prune."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tickets (suggestion_id TEXT PRIMARY KEY, ticket_no INTEGER UNIQUE, "
+            "user_id INTEGER NOT NULL, status TEXT NOT NULL, updated_at REAL NOT NULL, record BLOB NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tickets_user ON tickets (user_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tickets_status ON tickets (status, updated_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS archive (ticket_no INTEGER PRIMARY KEY, suggestion_id TEXT NOT NULL, "
+            "user_id INTEGER NOT NULL, closed_at REAL NOT NULL, record BLOB NOT NULL)"
+        )
+
+    def _track(self, suggestion_id: str, record: dict) -> dict:
+        unit = _STATE_UNIT.get()
+        if unit is not None:
+            unit[(self, suggestion_id)] = (record, pickle.dumps(record))
+        return record
+
+    def _tracked(self, suggestion_id: str) -> Optional[dict]:
+        unit = _STATE_UNIT.get()
+        if unit is not None and (self, suggestion_id) in unit:
+            return unit[(self, suggestion_id)][0]
         return None
 
-def _lock_expired(record):
-    locked_at = record.get("locked_at")
-    if not locked_at:
-        return True
-    dt = _parse_dt(locked_at)
-    if not dt:
-        return True
-    return (_now_dt() - dt) > timedelta(minutes=SUPPORT_LOCK_TTL_MIN)
+    def persist(self, suggestion_id: str, record: dict):
+        """كتابة السجل (تُستدعى من flush_shared_state عند تغيّره)."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO tickets (suggestion_id, ticket_no, user_id, status, updated_at, record) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (suggestion_id) DO UPDATE SET "
+                "status=excluded.status, updated_at=excluded.updated_at, record=excluded.record",
+                (
+                    suggestion_id,
+                    record.get("ticket_no"),
+                    int(record["user_id"]),
+                    ticket_status(record),
+                    datetime.now(timezone.utc).timestamp(),
+                    pickle.dumps(record),
+                ),
+            )
+
+    def create(self, user_id: int, suggestion_id: str, record: dict) -> dict:
+        record["user_id"] = int(user_id)
+        self.persist(suggestion_id, record)
+        return self._track(suggestion_id, record)
+
+    def get(self, user_id: int, suggestion_id: str) -> Optional[dict]:
+        record = self._tracked(suggestion_id)
+        if record is None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT record FROM tickets WHERE suggestion_id=?", (suggestion_id,)
+                ).fetchone()
+            if not row:
+                return None
+            record = self._track(suggestion_id, pickle.loads(row[0]))
+        return record if record.get("user_id") == int(user_id) else None
+
+    def by_number(self, ticket_no: int) -> Optional[dict]:
+        """بحث فوري برقم التذكرة (الحية أولاً ثم الأرشيف)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT suggestion_id, user_id, record FROM tickets WHERE ticket_no=?", (ticket_no,)
+            ).fetchone()
+            archived = None if row else self._conn.execute(
+                "SELECT suggestion_id, user_id, record FROM archive WHERE ticket_no=?", (ticket_no,)
+            ).fetchone()
+        if row:
+            suggestion_id, user_id, blob = row
+            record = self._tracked(suggestion_id) or self._track(suggestion_id, pickle.loads(blob))
+            return {"suggestion_id": suggestion_id, "user_id": user_id, "record": record, "archived": False}
+        if archived:
+            suggestion_id, user_id, blob = archived
+            record = json.loads(zlib.decompress(blob).decode("utf-8"))
+            return {"suggestion_id": suggestion_id, "user_id": user_id, "record": record, "archived": True}
+        return None
+
+    def for_status(self, status: str, limit: int = 20) -> list:
+        """أحدث أرقام التذاكر بحالة معينة: [(ticket_no, user_id), ...]."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT ticket_no, user_id FROM tickets WHERE status=? ORDER BY updated_at DESC LIMIT ?",
+                (status, limit),
+            ).fetchall()
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM tickets GROUP BY status").fetchall()
+            archived = self._conn.execute("SELECT COUNT(*) FROM archive").fetchone()[0]
+        return {**dict(rows), "archived": archived}
+
+    def discard_drafts(self, user_id: int):
+        """إلغاء مسودات المستخدم غير المرسلة (التذاكر المرسلة تبقى)."""
+        unit = _STATE_UNIT.get()
+        if unit is not None:
+            for key, (record, _) in list(unit.items()):
+                if key[0] is self and record.get("user_id") == int(user_id) and ticket_status(record) == "draft":
+                    unit.pop(key, None)
+        with self._lock:
+            self._conn.execute("DELETE FROM tickets WHERE user_id=? AND status='draft'", (int(user_id),))
+
+    def prune(self) -> tuple:
+        """نقل المُجاب عليها الخاملة للأرشيف وحذف المسودات القديمة: (archived, dropped)."""
+        now = datetime.now(timezone.utc).timestamp()
+        closed_before = now - TICKET_RETENTION_DAYS * 86400
+        drafts_before = now - TICKET_DRAFT_TTL_HOURS * 3600
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT suggestion_id, ticket_no, user_id, record FROM tickets "
+                    "WHERE status='replied' AND updated_at < ?",
+                    (closed_before,),
+                ).fetchall()
+                archive_rows = []
+                for suggestion_id, ticket_no, user_id, blob in rows:
+                    record = pickle.loads(blob)
+                    record.pop("admin_messages", None)
+                    payload = json.dumps(record, ensure_ascii=False, default=str).encode("utf-8")
+                    archive_rows.append((ticket_no, suggestion_id, user_id, now, zlib.compress(payload, 9)))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO archive (ticket_no, suggestion_id, user_id, closed_at, record) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    archive_rows,
+                )
+                self._conn.executemany(
+                    "DELETE FROM tickets WHERE suggestion_id=?", [(r[0],) for r in rows]
+                )
+                dropped = self._conn.execute(
+                    "DELETE FROM tickets WHERE status='draft' AND updated_at < ?", (drafts_before,)
+                ).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows), dropped
+
+
+TICKETS = TicketStore(TICKETS_DB_PATH)
 
-def lock_ticket(record, admin_id, admin_name):
+
+async def prune_tickets_job(context: ContextTypes.DEFAULT_TYPE):
+    """أرشفة التذاكر المنتهية وحذف المسودات القديمة + تحديث عدادات الحالة."""
+    if not is_primary_worker():
+        return
+    try:
+        archived, dropped = await asyncio.to_thread(TICKETS.prune)
+        metric_inc("go_tickets_pruned_total", {"action": "archived"}, archived)
+        metric_inc("go_tickets_pruned_total", {"action": "dropped"}, dropped)
+        for status, count in (await asyncio.to_thread(TICKETS.counts)).items():
+            metric_set("go_tickets", count, {"status": status})
+        if archived or dropped:
+            logging.info(f"[TICKETS] 🗄️ أرشفة {archived} تذكرة وحذف {dropped} مسودة")
+    except Exception as e:
+        logging.error(f"[TICKETS] ❌ فشل تنظيف التذاكر: {e}")
+
+
+# ----------------------------------------------------------------
+#  🔒 أقفال التذاكر قبل أول رد (منع مشرفين يفتحون نفس التذكرة بنفس الوقت)
+#  - مفتاح القفل: رقم التذكرة؛ "من يمسك التذكرة" = قراءة dict واحدة
+#  - الانتهاء بساعة monotonic + heap: ticket_lock_reaper يفك القفل في موعده
+#    ويبلغ المشرف الممسك وبقية المشرفين أن التذكرة أصبحت متاحة
+#  - مع الحالة المشتركة: الحجز عبر STATE_BACKEND.claim (ذري بين العمليات)
+#  - فك القفل للمشرف الممسك فقط؛ الاستدعاءات تمر عبر asyncio.to_thread (lock_ticket / unlock_ticket)
+# ----------------------------------------------------------------
+SUPPORT_LOCK_TTL_MIN = 10  # مدة القفل بالدقائق
+TICKET_LOCK_NS = "ticket_locks"
+TICKET_LOCK_HOLDERS_NS = "ticket_lock_holders"
+
+metric_declare("go_ticket_locks_total", "counter", "Ticket lock outcomes (acquired / busy / released / expired).")
+
+
+class TicketLockManager:
+    """acquire / release / holder لأقفال التذاكر مع انتهاء تلقائي."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._holders = {}  # ticket_no → (admin_id, admin_name, expires_monotonic, token)
+        self._heap = []     # (expires_monotonic, token, ticket_no) — الإدخالات القديمة تُتجاهل عبر token
+        self._token = 0
+        self._lock = threading.Lock()
+        self.wake = asyncio.Event()
+
+    def holder(self, ticket_no) -> Optional[tuple]:
+        """(admin_id, admin_name) للقفل الساري أو None."""
+        entry = self._holders.get(ticket_no)
+        if entry and entry[2] > monotonic():
+            return entry[0], entry[1]
+        if STATE_BACKEND.shared:
+            info = STATE_BACKEND.get(TICKET_LOCK_HOLDERS_NS, ticket_no)
+            if info and info[2] > datetime.now(timezone.utc).timestamp():
+                return info[0], info[1]
+        return None
+
+    def acquire(self, ticket_no, admin_id: int, admin_name: str) -> tuple:
+        """(True, None) عند الحجز أو التجديد لنفس المشرف، وإلا (False, (holder_id, holder_name)).
+        المستدعي يوقظ ticket_lock_reaper عبر wake.set() (الدالة تُنفذ داخل thread)."""
+        current = self.holder(ticket_no)
+        if current and int(current[0]) != int(admin_id):
+            metric_inc("go_ticket_locks_total", {"result": "busy"})
+            return False, current
+        if STATE_BACKEND.shared:
+            if not STATE_BACKEND.claim(TICKET_LOCK_NS, ticket_no, str(admin_id), self.ttl):
+                metric_inc("go_ticket_locks_total", {"result": "busy"})
+                return False, self.holder(ticket_no) or (None, None)
+            expires_at = datetime.now(timezone.utc).timestamp() + self.ttl
+            STATE_BACKEND.set(TICKET_LOCK_HOLDERS_NS, ticket_no, (int(admin_id), admin_name, expires_at))
+        with self._lock:
+            self._token += 1
+            expires = monotonic() + self.ttl
+            self._holders[ticket_no] = (int(admin_id), admin_name, expires, self._token)
+            heapq.heappush(self._heap, (expires, self._token, ticket_no))
+        metric_inc("go_ticket_locks_total", {"result": "acquired"})
+        return True, None
+
+    def _drop(self, ticket_no, admin_id: int):
+        if STATE_BACKEND.shared:
+            STATE_BACKEND.release(TICKET_LOCK_NS, ticket_no, str(admin_id))
+            info = STATE_BACKEND.get(TICKET_LOCK_HOLDERS_NS, ticket_no)
+            if info and int(info[0]) == int(admin_id):
+                STATE_BACKEND.delete(TICKET_LOCK_HOLDERS_NS, ticket_no)
+
+    def release(self, ticket_no, admin_id: int):
+        """فك القفل إن كان admin_id هو الممسك به (قفل مشرف آخر لا يُمس)."""
+        current = self.holder(ticket_no)
+        if current and int(current[0]) != int(admin_id):
+            return
+        with self._lock:
+            entry = self._holders.get(ticket_no)
+            if entry and entry[0] == int(admin_id):
+                del self._holders[ticket_no]
+        self._drop(ticket_no, admin_id)
+        if current:
+            metric_inc("go_ticket_locks_total", {"result": "released"})
+
+    def seconds_until_next(self) -> Optional[float]:
+        with self._lock:
+            return max(0.0, self._heap[0][0] - monotonic()) if self._heap else None
+
+    def pop_expired(self) -> list:
+        """الأقفال المنتهية الآن: [(ticket_no, admin_id, admin_name), ...]."""
+        expired = []
+        now = monotonic()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, token, ticket_no = heapq.heappop(self._heap)
+                entry = self._holders.get(ticket_no)
+                if entry and entry[3] == token:
+                    del self._holders[ticket_no]
+                    expired.append((ticket_no, entry[0], entry[1]))
+        if STATE_BACKEND.shared:
+            # قفل جدده نفس المشرف من عملية أخرى لم ينتهِ فعلياً
+            now_wall = datetime.now(timezone.utc).timestamp()
+            expired = [
+                item for item in expired
+                if (STATE_BACKEND.get(TICKET_LOCK_HOLDERS_NS, item[0]) or (None, None, 0))[2] <= now_wall
+            ]
+        for ticket_no, admin_id, _ in expired:
+            self._drop(ticket_no, admin_id)
+        return expired
+
+
+TICKET_LOCKS = TicketLockManager(SUPPORT_LOCK_TTL_MIN * 60)
+
+
+async def lock_ticket(record, admin_id, admin_name):
     """
     قفل مؤقت فقط قبل أول رد.
     بعد أول رد (وجود replied_by) ما نحتاج قفل لأن نظامك يمنع غير نفس المشرف.
     """
-    # ✅ إذا تم الرد مسبقًا، لا نطبق قفل
-    if record.get("replied_by"):
+    if record.get("replied_by") or not record.get("ticket_no"):
+        return True, ""
+    ok, current = await asyncio.to_thread(TICKET_LOCKS.acquire, record["ticket_no"], admin_id, admin_name)
+    if ok:
+        TICKET_LOCKS.wake.set()
         return True, ""
+    return False, f"🔒 التذكرة قيد المعالجة بواسطة: {current[1] or 'مشرف آخر'}"
+
+
+async def unlock_ticket(record, admin_id):
+    """فك قفل التذكرة إن كان admin_id هو الممسك به (بدون أثر على قفل مشرف آخر)."""
+    if record.get("ticket_no"):
+        await asyncio.to_thread(TICKET_LOCKS.release, record["ticket_no"], admin_id)
+
+
+async def _announce_lock_expiry(ticket_no, admin_id: int, admin_name: str):
+    bot = application.bot
+    minutes = SUPPORT_LOCK_TTL_MIN
+    try:
+        await bot.send_message(
+            chat_id=admin_id,
+            text=f"⌛ انتهت مدة قفل التذكرة #{ticket_no} ({minutes} دقائق) دون إرسال رد، وأصبحت متاحة لبقية المشرفين.",
+        )
+    except Exception as e:
+        logging.warning(f"[TICKET LOCK] فشل إشعار المشرف {admin_id} بانتهاء القفل: {e}")
+
+    found = await asyncio.to_thread(TICKETS.by_number, ticket_no)
+    keyboard = None
+    if found and not found["archived"] and ticket_status(found["record"]) == "open":
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(
+            "📝 الرد على الاستفسار الوارد",
+            callback_data=f"reply_{found['user_id']}_{found['suggestion_id']}",
+        )]])
+
+    async def _send(aid):
+        return await bot.send_message(
+            chat_id=aid,
+            text=f"🔓 التذكرة #{ticket_no} أصبحت متاحة للرد (انتهى قفل {admin_name}).",
+            reply_markup=keyboard,
+        )
+
+    notify_admins(_send, tag="TICKET LOCK", admin_ids=[aid for aid in AUTHORIZED_USERS if aid != admin_id])
+
+
+async def ticket_lock_reaper():
+    """ينام حتى أقرب انتهاء قفل (أو حتى يُضاف قفل جديد) ثم يفك المنتهي ويبلغ المشرفين."""
+    while True:
+        try:
+            await asyncio.wait_for(TICKET_LOCKS.wake.wait(), timeout=TICKET_LOCKS.seconds_until_next())
+        except asyncio.TimeoutError:
+            pass
+        TICKET_LOCKS.wake.clear()
+        for ticket_no, admin_id, admin_name in await asyncio.to_thread(TICKET_LOCKS.pop_expired):
+            metric_inc("go_ticket_locks_total", {"result": "expired"})
+            logging.info(f"[TICKET LOCK] ⌛ انتهى قفل التذكرة #{ticket_no} ({admin_name})")
+            try:
+                await _announce_lock_expiry(ticket_no, admin_id, admin_name)
+            except Exception as e:
+                logging.error(f"[TICKET LOCK] ❌ فشل إشعار انتهاء القفل: {e}")
+
+
+# ----------------------------------------------------------------
+#  🧵 نقاشات فريق GO: أرقام دائمة + سجل رسائل محدود في الذاكرة
+#  - SQLite داخل STATE_DIR: رقم النقاش AUTOINCREMENT لا يتكرر بعد إعادة التشغيل
+#    (أزرار "رد على هذا النقاش" القديمة تبقى تشير للنقاش الصحيح)
+#  - كل مداخلة تُلحق بجدول thread_messages؛ السجل يحتفظ بآخر TEAM_THREAD_RECENT_MESSAGES فقط
+#  - النقاش يُقرأ من القرص عند الحاجة فقط (عند وصول رد المشرف) ويُحفظ مع نهاية وحدة العمل
+# ----------------------------------------------------------------
+TEAM_THREADS_DB_PATH = Path(os.getenv("GO_TEAM_THREADS_DB") or STATE_DIR / "team_threads.sqlite3")
+TEAM_THREAD_RECENT_MESSAGES = int(os.getenv("GO_TEAM_THREAD_RECENT_MESSAGES") or 20)
+
+
+class TeamThreadStore:
+    """نقاشات الفريق: create / get / add_message / discard_if_empty."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads (thread_id INTEGER PRIMARY KEY AUTOINCREMENT, record BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS thread_messages (thread_id INTEGER NOT NULL, from_id INTEGER, "
+            "name TEXT, text TEXT, at TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS thread_messages_thread ON thread_messages (thread_id)")
+
+    def _track(self, thread_id: int, record: dict) -> dict:
+        unit = _STATE_UNIT.get()
+        if unit is not None:
+            unit[(self, thread_id)] = (record, pickle.dumps(record))
+        return record
+
+    def persist(self, thread_id: int, record: dict):
+        with self._lock:
+            self._conn.execute("UPDATE threads SET record=? WHERE thread_id=?", (pickle.dumps(record), thread_id))
+
+    def create(self, record: dict) -> int:
+        record.setdefault("messages", [])
+        with self._lock:
+            thread_id = self._conn.execute(
+                "INSERT INTO threads (record) VALUES (?)", (pickle.dumps(record),)
+            ).lastrowid
+        self._track(thread_id, record)
+        return thread_id
+
+    def get(self, thread_id: int) -> Optional[dict]:
+        unit = _STATE_UNIT.get()
+        if unit is not None and (self, thread_id) in unit:
+            return unit[(self, thread_id)][0]
+        with self._lock:
+            row = self._conn.execute("SELECT record FROM threads WHERE thread_id=?", (thread_id,)).fetchone()
+        return self._track(thread_id, pickle.loads(row[0])) if row else None
+
+    def add_message(self, thread_id: int, thread: dict, message: dict):
+        """إلحاق المداخلة بالقرص + إبقاء آخر TEAM_THREAD_RECENT_MESSAGES في السجل."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO thread_messages (thread_id, from_id, name, text, at) VALUES (?, ?, ?, ?, ?)",
+                (thread_id, message.get("from"), message.get("name"), message.get("text"), message.get("at")),
+            )
+        recent = thread.setdefault("messages", [])
+        recent.append(message)
+        del recent[:-TEAM_THREAD_RECENT_MESSAGES]
+
+    def discard_if_empty(self, thread_id: int):
+        """حذف نقاش أُنشئ ثم أُلغي قبل أي مداخلة (النقاشات الفعلية لا تُحذف)."""
+        unit = _STATE_UNIT.get()
+        if unit is not None:
+            tracked = unit.get((self, thread_id))
+            if tracked and tracked[0].get("messages"):
+                return
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM threads WHERE thread_id=? AND NOT EXISTS "
+                "(SELECT 1 FROM thread_messages WHERE thread_id=?)",
+                (thread_id, thread_id),
+            ).rowcount
+        if deleted and unit is not None:
+            unit.pop((self, thread_id), None)
+
+
+TEAM_THREADS = TeamThreadStore(TEAM_THREADS_DB_PATH)
+
+# ================================================================
+#  💾 كاتب وحيد لملف bot_data.xlsx (آمن مع أكثر من عملية)
+#  - كل الكتابات تمر عبر excel_write([...]) كتعديلات:
+#    ("sheet", name, df)                       نسخة كاملة (شيتات مصدرها واحد: سجلات الإلحاق / القطع)
+#    ("upsert", name, key_col, row) / ("delete", name, key_col, key)
+#                                              تعديل صف واحد يُطبق على الشيت الموجود في الملف وقت الحفظ
+#                                              (تعديلات عمليتين على نفس الشيت لا تلغي إحداهما الأخرى)
+#    ("stat", key, value)                      قيمة في bot_stats
+#  - الحفظ: نسخة مؤقتة بجانب الملف ← تعديل الشيتات ← fsync ← فحص سلامة ← os.replace
+#    (لا يظهر الملف نصف مكتوب، وانهيار أثناء الحفظ يترك النسخة السابقة كما هي)
+#  - قفل flock على مستوى الملف يمنع أي حفظين متزامنين من عمليات مختلفة
+#  - مع GO_WORKERS > 1: عملية واحدة تُنتخب كاتباً (flock غير حاجز) والبقية ترسل
+#    تعديلاتها لطابور storage:mutations في الحالة المشتركة ويجمعها الكاتب دفعة واحدة
+# ================================================================
+EXCEL_PATH = Path("bot_data.xlsx")
+EXCEL_SAVE_LOCK_PATH = STATE_DIR / "bot_data.xlsx.lock"
+EXCEL_WRITER_LOCK_PATH = STATE_DIR / "excel_writer.lock"
+EXCEL_MUTATIONS_QUEUE = "storage:mutations"
+EXCEL_WRITER_POLL = float(os.getenv("GO_EXCEL_WRITER_POLL") or 0.5)
+EXCEL_WRITER = {"is_writer": GO_WORKERS == 1, "fd": None}
+
+metric_declare("go_excel_saves_total", "counter", "Workbook saves by result.")
+metric_declare("go_excel_mutations_total", "counter", "Workbook mutations by how they reached the writer.")
+metric_declare("go_excel_save_seconds", "histogram", "Time spent saving the workbook (copy + write + replace).")
+
+
+def _merge_excel_mutations(mutations) -> tuple:
+    """
+    دمج دفعة تعديلات بالترتيب:
+    - آخر نسخة كاملة لكل شيت تفوز (وتلغي تعديلات الصفوف التي سبقتها على نفس الشيت)
+    - تعديلات الصفوف تُجمع لكل شيت بترتيب وصولها
+    - قيم bot_stats تُجمع في dict
+    """
+    sheets, rows, stats = {}, {}, {}
+    for op, name, *args in mutations:
+        if op == "sheet":
+            sheets[name] = args[0]
+            rows.pop(name, None)
+        elif op in ("upsert", "delete"):
+            rows.setdefault(name, []).append((op, *args))
+        elif op == "stat":
+            stats[str(name).strip()] = args[0]
+    return sheets, rows, stats
+
+
+def _row_key(value) -> str:
+    # 123 و 123.0 (بعد قراءة الإكسل) نفس المفتاح
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _apply_row_mutations(df: Optional[pd.DataFrame], ops: list) -> pd.DataFrame:
+    df = pd.DataFrame() if df is None else df.copy()
+    for op, key_col, payload in ops:
+        key = _row_key(payload.get(key_col) if op == "upsert" else payload)
+        if key_col not in df.columns:
+            df[key_col] = pd.Series(dtype=object)
+        mask = df[key_col].map(_row_key) == key
+        if op == "delete":
+            df = df[~mask].reset_index(drop=True)
+        elif mask.any():
+            for column, value in payload.items():
+                df.loc[mask, column] = value
+        else:
+            df = pd.concat([df, pd.DataFrame([payload])], ignore_index=True)
+    return df
+
+
+def _apply_stats_to_sheet(df_stats: Optional[pd.DataFrame], stats: dict) -> pd.DataFrame:
+    if df_stats is None or "key" not in df_stats.columns or "value" not in df_stats.columns:
+        df_stats = pd.DataFrame(columns=["key", "value"])
+    df_stats = df_stats.copy()
+    keys = df_stats["key"].astype(str).str.strip()
+    for key, value in stats.items():
+        mask = keys == key
+        if mask.any():
+            df_stats.loc[mask, "value"] = value
+        else:
+            df_stats = pd.concat([df_stats, pd.DataFrame([{"key": key, "value": value}])], ignore_index=True)
+            keys = df_stats["key"].astype(str).str.strip()
+    return df_stats
+
+
+def _fsync_path(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        # بعض أنظمة الملفات لا تدعم fsync على المجلدات
+        pass
+    finally:
+        os.close(fd)
+
+
+def _workbook_sheet_names(path: Path) -> list:
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return list(wb.sheetnames)
+    finally:
+        wb.close()
+
+
+def _verify_workbook_sync(path: Path, expected_sheets) -> None:
+    """إعادة فتح الملف المؤقت قبل الاستبدال: zip سليم + كل الشيتات المتوقعة موجودة."""
+    with zipfile.ZipFile(path) as zf:
+        bad = zf.testzip()
+        if bad is not None:
+            raise ValueError(f"ملف تالف داخل الـ zip: {bad}")
+    missing = set(expected_sheets) - set(_workbook_sheet_names(path))
+    if missing:
+        raise ValueError(f"شيتات مفقودة بعد الحفظ: {', '.join(sorted(missing))}")
+
+
+def _save_workbook_sync(mutations):
+    """تطبيق دفعة تعديلات على نسخة مؤقتة ثم استبدال الملف الأصلي بها ذرياً."""
+    sheets, rows, stats = _merge_excel_mutations(mutations)
+    if not sheets and not rows and not stats:
+        return
+    started = perf_counter()
+    # اللاحقة .xlsx ضرورية لأن openpyxl يرفض الامتدادات الأخرى
+    tmp_path = EXCEL_PATH.with_name(f".{EXCEL_PATH.stem}.{os.getpid()}.tmp.xlsx")
+    try:
+        with _FileLock(EXCEL_SAVE_LOCK_PATH):
+            exists = EXCEL_PATH.exists()
+            expected = set()
+            if exists:
+                shutil.copy2(EXCEL_PATH, tmp_path)
+                expected = set(_workbook_sheet_names(tmp_path))
+
+            def _current(sheet_name):
+                # الشيت كما هو في الملف الآن (يشمل ما حفظته العمليات الأخرى)
+                if sheet_name not in expected:
+                    return None
+                return pd.read_excel(tmp_path, sheet_name=sheet_name)
+
+            for sheet_name, ops in rows.items():
+                base = sheets[sheet_name] if sheet_name in sheets else _current(sheet_name)
+                sheets[sheet_name] = _apply_row_mutations(base, ops)
+            if stats:
+                try:
+                    current = _current("bot_stats")
+                except Exception:
+                    current = None
+                sheets["bot_stats"] = _apply_stats_to_sheet(sheets.get("bot_stats", current), stats)
+            writer_kwargs = {"mode": "a", "if_sheet_exists": "replace"} if exists else {"mode": "w"}
+            with pd.ExcelWriter(tmp_path, engine="openpyxl", **writer_kwargs) as writer:
+                for sheet_name, df in sheets.items():
+                    df.to_excel(writer, sheet_name=sheet_name, index=False)
+            _fsync_path(tmp_path)
+            _verify_workbook_sync(tmp_path, expected | set(sheets))
+            os.replace(tmp_path, EXCEL_PATH)
+            # fsync للمجلد حتى يثبت الـ rename نفسه على القرص
+            _fsync_path(EXCEL_PATH.resolve().parent)
+        metric_inc("go_excel_saves_total", {"result": "ok"})
+    except Exception:
+        metric_inc("go_excel_saves_total", {"result": "error"})
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        metric_observe("go_excel_save_seconds", perf_counter() - started)
+    logging.info(f"[EXCEL] 💾 تم حفظ: {', '.join(sheets)}")
+
+
+def _try_become_excel_writer() -> bool:
+    """انتخاب الكاتب: أول عملية تحصل على flock غير حاجز تحتفظ به طوال عمرها."""
+    if EXCEL_WRITER["is_writer"]:
+        return True
+    if not fcntl:
+        EXCEL_WRITER["is_writer"] = True
+        return True
+    fd = open(EXCEL_WRITER_LOCK_PATH, "a+")
+    try:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        return False
+    EXCEL_WRITER.update(is_writer=True, fd=fd)
+    logging.info(f"[EXCEL] ✍️ {WORKER_ID} أصبح كاتب bot_data.xlsx")
+    return True
+
+
+async def excel_write(mutations: list) -> bool:
+    """
+    إرسال تعديلات للكاتب:
+    - إن كانت هذه العملية هي الكاتب: حفظ مباشر (تحت EXCEL_LOCK + flock) في ثريد → True
+    - وإلا: دفعها لطابور الكاتب في الحالة المشتركة (الحفظ يتم خلال EXCEL_WRITER_POLL) → False
+    """
+    if not EXCEL_WRITER["is_writer"] and STATE_BACKEND.shared:
+        metric_inc("go_excel_mutations_total", {"route": "queued"}, len(mutations))
+        await asyncio.to_thread(STATE_BACKEND.push, EXCEL_MUTATIONS_QUEUE, mutations)
+        return False
+    metric_inc("go_excel_mutations_total", {"route": "local"}, len(mutations))
+    async with EXCEL_LOCK:
+        await asyncio.to_thread(_save_workbook_sync, mutations)
+    return True
+
+
+async def excel_writer_loop():
+    """محاولة الانتخاب دورياً؛ والكاتب يسحب تعديلات العمليات الأخرى ويحفظها دفعة واحدة."""
+    while True:
+        try:
+            if await asyncio.to_thread(_try_become_excel_writer):
+                batches = await asyncio.to_thread(STATE_BACKEND.pop_all, EXCEL_MUTATIONS_QUEUE)
+                if batches:
+                    mutations = [m for batch in batches for m in batch]
+                    metric_inc("go_excel_mutations_total", {"route": "drained"}, len(mutations))
+                    async with EXCEL_LOCK:
+                        await asyncio.to_thread(_save_workbook_sync, mutations)
+        except Exception as e:
+            logging.error(f"[EXCEL] ❌ فشل حفظ تعديلات الطابور: {e}")
+        await asyncio.sleep(EXCEL_WRITER_POLL)
+
+
+# ================================================================
+#  📜 سجلات إلحاق صغيرة على القرص (بدل إعادة كتابة شيت كامل لكل سطر جديد)
+#  - كل سجل جديد يُلحق بملف داخل STATE_DIR (تكلفة ثابتة)
+#  - الشيت المقابل في bot_data.xlsx يُحدّث دورياً (وقبل كل نسخة احتياطية) ثم تُحذف بداية السجل
+#  - مع أكثر من worker: قراءة ذيل السجل لرؤية ما أضافته العمليات الأخرى (نفس الجهاز)
+# ================================================================
+STATE_LOGS_SNAPSHOT_INTERVAL = int(os.getenv("GO_STATE_LOGS_SNAPSHOT_INTERVAL") or 30 * 60)
+
+
+class AppendLog:
+    """ملف إلحاق فقط: سجلات ثابتة الحجم (record_size) أو سطور (record_size=None)."""
+
+    def __init__(self, path: Path, record_size: Optional[int] = None):
+        self.path = path
+        self.lock_path = path.with_name(f"{path.name}.lock")
+        self.record_size = record_size
+        self.offset = 0
+        self.inode = None
 
-    # إذا في قفل صالح لمشرف آخر
-    if record.get("locked_by_id") and not _lock_expired(record):
-        if int(record.get("locked_by_id")) != int(admin_id):
-            locker = record.get("locked_by_name") or "مشرف آخر"
-            return False, f"🔒 التذكرة قيد المعالجة بواسطة: {locker}"
-        return True, ""  # نفس المشرف
+    def reset(self):
+        self.offset, self.inode = 0, None
 
-    # إذا القفل منتهي أو غير موجود، اقفلها
-    record["locked_by_id"] = int(admin_id)
-    record["locked_by_name"] = admin_name
-    record["locked_at"] = _now_dt().isoformat()
-    return True, ""
+    def append(self, data: bytes):
+        with _FileLock(self.lock_path):
+            with open(self.path, "ab") as f:
+                f.write(data)
 
-def unlock_ticket(record):
-    record.pop("locked_by_id", None)
-    record.pop("locked_by_name", None)
-    record.pop("locked_at", None)
+    def read_new(self) -> bytes:
+        """السجلات الكاملة منذ آخر قراءة (السجل الناقص في النهاية يُترك لحين اكتماله)."""
+        try:
+            with open(self.path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self.inode:
+                    self.inode, self.offset = inode, 0
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return b""
+        if self.record_size:
+            usable = len(data) - len(data) % self.record_size
+        else:
+            usable = data.rfind(b"\n") + 1
+        self.offset += usable
+        return data[:usable]
 
-# -----------------------------------------------------------
-# 2) نظام السجلات
-# -----------------------------------------------------------
+    def compact(self, upto_offset: int, inode):
+        """حذف بداية السجل بعد حفظها في الشيت (ما أُضيف بعدها يبقى)."""
+        with _FileLock(self.lock_path):
+            try:
+                with open(self.path, "rb") as f:
+                    if os.fstat(f.fileno()).st_ino != inode:
+                        return
+                    f.seek(upto_offset)
+                    rest = f.read()
+            except FileNotFoundError:
+                return
+            tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(rest)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+
+# ----------------------------------------------------------------
+#  👥 سجل المستخدمين المضغوط (بدل set + إعادة كتابة all_users_log لكل مستخدم جديد)
+#  - في الذاكرة: array('q') مرتب (8 بايت لكل مستخدم) + set صغير للإضافات الحديثة
+#  - على القرص: STATE_DIR/users.log (8 بايت لكل مستخدم جديد)
+# ----------------------------------------------------------------
+USERS_LOG_PATH = STATE_DIR / "users.log"
+USER_REGISTRY_MERGE_AT = 4096
+_USER_RECORD = struct.Struct("<q")
+
+
+class UserRegistry:
+    """مجموعة user_id مضغوطة (in / add / len / iter) مع سجل إلحاق على القرص."""
+
+    def __init__(self, log_path: Path):
+        self.log = AppendLog(log_path, _USER_RECORD.size)
+        self._base = array("q")
+        self._recent = set()
+        self._lock = threading.Lock()
+
+    def load(self, ids=()):
+        """القاعدة من شيت all_users_log + ما لم يُحفظ بعد في users.log."""
+        with self._lock:
+            self._base = array("q", sorted({int(i) for i in ids}))
+            self._recent = set()
+            self.log.reset()
+        self._read_log_tail()
+        return self
+
+    def _has(self, user_id: int) -> bool:
+        if user_id in self._recent:
+            return True
+        i = bisect_left(self._base, user_id)
+        return i < len(self._base) and self._base[i] == user_id
+
+    def _remember(self, user_id: int) -> bool:
+        if self._has(user_id):
+            return False
+        self._recent.add(user_id)
+        if len(self._recent) >= USER_REGISTRY_MERGE_AT:
+            self._base = array("q", heapq.merge(self._base, sorted(self._recent)))
+            self._recent = set()
+        return True
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    force=True
-)
+    def _read_log_tail(self):
+        with self._lock:
+            for (user_id,) in _USER_RECORD.iter_unpack(self.log.read_new()):
+                self._remember(user_id)
+
+    def __contains__(self, user_id) -> bool:
+        user_id = int(user_id)
+        with self._lock:
+            if self._has(user_id):
+                return True
+        if GO_WORKERS == 1:
+            return False
+        self._read_log_tail()
+        with self._lock:
+            return self._has(user_id)
+
+    def add(self, user_id) -> bool:
+        """يرجع True إن كان المستخدم جديداً (بعد إلحاقه بالسجل على القرص)."""
+        user_id = int(user_id)
+        if user_id in self:
+            return False
+        with self._lock:
+            if not self._remember(user_id):
+                return False
+        self.log.append(_USER_RECORD.pack(user_id))
+        return True
 
-# -----------------------------------------------------------
-# 3) تصحيح set_application داخل JobQueue لإزالة weakref
-# -----------------------------------------------------------
+    def __len__(self) -> int:
+        if GO_WORKERS > 1:
+            self._read_log_tail()
+        with self._lock:
+            return len(self._base) + len(self._recent)
+
+    def __iter__(self):
+        return iter(self.to_array())
+
+    def to_array(self) -> array:
+        with self._lock:
+            return array("q", heapq.merge(self._base, sorted(self._recent)))
+
+    def log_snapshot(self) -> tuple:
+        """(كل المستخدمين، موضع نهاية السجل المقروء، inode) — الموضع 0 يعني لا جديد."""
+        self._read_log_tail()
+        with self._lock:
+            offset, inode = self.log.offset, self.log.inode
+        return self.to_array(), offset, inode
+
+    def compact_log(self, upto_offset: int, inode):
+        self.log.compact(upto_offset, inode)
+
+
+# ----------------------------------------------------------------
+#  ⭐ التقييمات: تُحمّل مرة واحدة، والعدد/المجموع/المقيّمون في الذاكرة
+#  - على القرص: STATE_DIR/ratings.log (سطر JSON لكل تقييم جديد)
+# ----------------------------------------------------------------
+RATINGS_LOG_PATH = STATE_DIR / "ratings.log"
+RATINGS_COLUMNS = ["user_id", "name", "rating", "timestamp", "group_name", "group_id"]
+
+
+class RatingsStore:
+    """تقييمات GO: count / average / has_rated / add بدون أي قراءة من الإكسل."""
+
+    def __init__(self, log_path: Path):
+        self.log = AppendLog(log_path)
+        self._rows = []
+        self._rated = set()
+        self._scored = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def load(self, df: Optional[pd.DataFrame] = None):
+        """الصفوف من شيت ratings + ما لم يُحفظ بعد في ratings.log."""
+        with self._lock:
+            self._rows, self._rated, self._scored, self._sum = [], set(), 0, 0.0
+            self.log.reset()
+            if df is not None and not df.empty:
+                for row in df.to_dict("records"):
+                    self._index(row)
+        self._read_log_tail()
+        return self
+
+    def _index(self, row: dict) -> bool:
+        user_id = pd.to_numeric(row.get("user_id"), errors="coerce")
+        if pd.notna(user_id):
+            if int(user_id) in self._rated:
+                return False
+            self._rated.add(int(user_id))
+        self._rows.append(row)
+        rating = pd.to_numeric(row.get("rating"), errors="coerce")
+        if pd.notna(rating):
+            self._scored += 1
+            self._sum += float(rating)
+        return True
 
-# دالة الكتابة في الخلفية
-def write_excel_background(path, df, sheet_name):
-    with pd.ExcelWriter(path, engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
-        df.to_excel(writer, sheet_name=sheet_name, index=False)
+    def _read_log_tail(self):
+        with self._lock:
+            for line in self.log.read_new().splitlines():
+                try:
+                    self._index(json.loads(line))
+                except ValueError:
+                    logging.warning(f"[RATINGS] ⚠️ سطر تالف في {self.log.path}")
+
+    def has_rated(self, user_id) -> bool:
+        with self._lock:
+            if int(user_id) in self._rated:
+                return True
+        if GO_WORKERS == 1:
+            return False
+        self._read_log_tail()
+        with self._lock:
+            return int(user_id) in self._rated
+
+    def add(self, entry: dict) -> bool:
+        """يرجع False إن كان المستخدم قيّم سابقاً؛ وإلا يُلحق التقييم بالسجل."""
+        if self.has_rated(entry["user_id"]):
+            return False
+        with self._lock:
+            if not self._index(entry):
+                return False
+        self.log.append((json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+        return True
 
-def _patched_set_application(self, application):
-    """استبدال weakref بـ lambda للحفاظ على التطبيق دائماً."""
-    self._application = lambda: application
+    def summary(self) -> tuple:
+        """(عدد التقييمات، المتوسط)."""
+        if GO_WORKERS > 1:
+            self._read_log_tail()
+        with self._lock:
+            avg = self._sum / self._scored if self._scored else 0.0
+            return len(self._rows), avg
+
+    def log_snapshot(self) -> tuple:
+        """(DataFrame كامل لشيت ratings، موضع نهاية السجل المقروء، inode)."""
+        self._read_log_tail()
+        with self._lock:
+            rows = list(self._rows)
+            offset, inode = self.log.offset, self.log.inode
+        df = pd.DataFrame(rows)
+        df = df.reindex(columns=list(dict.fromkeys([*RATINGS_COLUMNS, *df.columns])))
+        return df, offset, inode
+
+    def compact_log(self, upto_offset: int, inode):
+        self.log.compact(upto_offset, inode)
+
+# ----------------------------------------------------------------
+#  🖼️ كاش file_id لصور الكتالوج (روابط Image في parts و image_url في independent)
+#  - أول إرسال ناجح للرابط يحفظ file_id؛ الإرسالات التالية ترسل file_id مباشرة
+#    (تيليجرام لا يعيد تنزيل الرابط ولا يتأخر حتى fallback النصي)
+#  - على القرص: STATE_DIR/media_file_ids.log (سطر JSON لكل رابط جديد، file_id=None = حذف)
+#  - اختياري (GO_MEDIA_FILE_IDS_EXPORT=1): عمود file_id بجانب عمود الصورة في شيتات الكتالوج
+# ----------------------------------------------------------------
+MEDIA_FILE_IDS_PATH = STATE_DIR / "media_file_ids.log"
+MEDIA_FILE_IDS_EXPORT = (os.getenv("GO_MEDIA_FILE_IDS_EXPORT") or "").strip().lower() in ("1", "true", "yes", "on")
+# الشيت ← (عمود الرابط، عمود file_id)
+MEDIA_FILE_ID_COLUMNS = {
+    "parts": ("Image", "Image_file_id"),
+    "independent": ("image_url", "image_file_id"),
+}
 
-tg_jobqueue.JobQueue.set_application = _patched_set_application
+metric_declare("go_media_file_id_total", "counter", "Catalogue photo sends by file_id cache result.")
 
-# -----------------------------------------------------------
-# 4) إعداد التوكن
-# -----------------------------------------------------------
 
-API_TOKEN = os.getenv("TELEGRAM_TOKEN")
+def _media_url(value) -> Optional[str]:
+    """الرابط فقط (القيم التي هي file_id أصلاً أو فارغة لا تُخزن)."""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    return value if value.lower().startswith("http") else None
+
+
+class MediaFileIdCache:
+    """رابط ← file_id: get / remember / forget + تصدير عمود للشيت."""
+
+    def __init__(self, log_path: Path):
+        self.log = AppendLog(log_path)
+        self._ids = {}
+        self._lock = threading.Lock()
+        self.exported = True
+
+    def load(self, sheets: Optional[dict] = None):
+        """file_id المصدّرة سابقاً في الشيتات + ما في media_file_ids.log."""
+        with self._lock:
+            self._ids = {}
+            self.log.reset()
+            for name, (url_col, id_col) in MEDIA_FILE_ID_COLUMNS.items():
+                df = (sheets or {}).get(name)
+                if df is None or df.empty or url_col not in df.columns or id_col not in df.columns:
+                    continue
+                for url, file_id in zip(df[url_col], df[id_col]):
+                    url = _media_url(url)
+                    if url and isinstance(file_id, str) and file_id.strip():
+                        self._ids[url] = file_id.strip()
+        self.refresh()
+        return self
+
+    def refresh(self):
+        """قراءة ما أضافته العمليات الأخرى إلى السجل."""
+        with self._lock:
+            for line in self.log.read_new().splitlines():
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    logging.warning(f"[FILE IDS] ⚠️ سطر تالف في {self.log.path}")
+                    continue
+                if item.get("file_id"):
+                    self._ids[item["url"]] = item["file_id"]
+                else:
+                    self._ids.pop(item["url"], None)
 
-# -----------------------------------------------------------
-# 5) تعريف initial_branches لتفادي NameError
-# -----------------------------------------------------------
+    def get(self, url) -> Optional[str]:
+        url = _media_url(url)
+        return self._ids.get(url) if url else None
 
-initial_branches = {
-    "CHERY": [],
-    "EXEED": [],
-    "MG": [],
-    "JETOUR": [],
-    "JAECOO / OMODA": [],
-    "BYD": [],
-    "SOUEAST": [],
-}
-# -----------------------------------------------------------
-# 6) تهيئة FastAPI + Telegram Application
-# -----------------------------------------------------------
+    def _write(self, url: str, file_id: Optional[str]):
+        self.log.append((json.dumps({"url": url, "file_id": file_id}, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.exported = False
 
-app = FastAPI()
-application = Application.builder().token(API_TOKEN).updater(None).build()
+    def remember(self, url, file_id: Optional[str]):
+        url = _media_url(url)
+        if not url or not file_id:
+            return
+        with self._lock:
+            if self._ids.get(url) == file_id:
+                return
+            self._ids[url] = file_id
+        self._write(url, file_id)
 
-# 🔒 قفل واحد لعمليات الكتابة على ملف Excel لمنع التعارض والتلف
-EXCEL_LOCK = asyncio.Lock()
+    def forget(self, url):
+        url = _media_url(url)
+        with self._lock:
+            if not url or self._ids.pop(url, None) is None:
+                return
+        self._write(url, None)
+
+    def with_column(self, df: pd.DataFrame, url_col: str, id_col: str) -> pd.DataFrame:
+        """نسخة من الشيت مع عمود file_id محدث (للتصدير فقط)."""
+        with self._lock:
+            ids = dict(self._ids)
+        return df.assign(**{id_col: [ids.get(_media_url(v)) for v in df[url_col]]})
 
-# 📁 مجلد النسخ الاحتياطي لملف الإكسل
-BACKUP_DIR = Path("backups")
-try:
-    BACKUP_DIR.mkdir(exist_ok=True)
-except Exception as e:
-    logging.error(f"[BACKUP] ❌ فشل إنشاء مجلد النسخ الاحتياطي: {e}")
 
 # ✅ PP deep-link toggle (from Render env)
 _raw_pp_enabled = (os.getenv("PP_DIRECT_ENABLED") or "").strip().lower()
@@ -177,11 +2293,13 @@ async def create_excel_backup(reason: str = "manual", context: Optional[ContextT
     backup_name = f"bot_data_{ts}_{reason}.xlsx"
     backup_path = BACKUP_DIR / backup_name
 
+    # المستخدمون والتقييمات الجديدة في سجلات STATE_DIR تدخل الشيتات قبل النسخ
+    await update_all_users_log_async()
+    await update_ratings_sheet_async()
+
     try:
-        loop = asyncio.get_running_loop()
-        # نضمن عدم تعارض أي عملية كتابة أخرى على نفس الملف
-        async with EXCEL_LOCK:
-            await loop.run_in_executor(None, shutil.copy2, src, backup_path)
+        # الحفظ يستبدل الملف ذرياً (rename)، فالنسخ يقرأ دائماً نسخة كاملة بدون أي قفل
+        await asyncio.to_thread(shutil.copy2, src, backup_path)
 
         logging.info(f"[BACKUP] ✅ تم إنشاء نسخة احتياطية: {backup_path}")
         # إشعار الشخص الذي طلب النسخ (مثل المشرف في لوحة التحكم)
@@ -223,8 +2341,174 @@ async def create_excel_backup(reason: str = "manual", context: Optional[ContextT
             except Exception:
                 pass
 
+async def state_logs_snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    """حفظ المستخدمين والتقييمات الجديدة في شيتاتها دورياً (في كاتب الملف فقط: هو من يحذف ما حُفظ من السجلات)."""
+    if not EXCEL_WRITER["is_writer"]:
+        return
+    await update_all_users_log_async()
+    await update_ratings_sheet_async()
+    await export_media_file_ids_async()
+
+
+async def export_media_file_ids_async():
+    """كتابة أعمدة file_id في شيتات الكتالوج (عند تفعيل GO_MEDIA_FILE_IDS_EXPORT وظهور file_id جديد)."""
+    await asyncio.to_thread(MEDIA_FILE_IDS.refresh)
+    if not MEDIA_FILE_IDS_EXPORT or MEDIA_FILE_IDS.exported:
+        return
+    sheets = {"parts": df_parts, "independent": df_independent}
+    mutations = [
+        ("sheet", name, MEDIA_FILE_IDS.with_column(sheets[name], url_col, id_col))
+        for name, (url_col, id_col) in MEDIA_FILE_ID_COLUMNS.items()
+        if not sheets[name].empty and url_col in sheets[name].columns
+    ]
+    try:
+        if mutations:
+            await excel_write(mutations)
+        MEDIA_FILE_IDS.exported = True
+    except Exception as e:
+        logging.error(f"[FILE IDS] ❌ فشل تصدير أعمدة file_id: {e}")
+
+
+# ----------------------------------------------------------------
+#  🔍 فحص وسائط الكتالوج في الخلفية (parts / independent / manual)
+#  - رابط صورة له file_id محفوظ ← get_file | بدون file_id ← إرسال تجريبي إلى
+#    GO_MEDIA_WARMUP_CHAT_ID ثم حذفه (يملأ كاش file_id) | بدون قناة تجريبية ← HEAD للرابط فقط
+#  - pdf_file_id (وقيم الصور التي هي file_id أصلاً) ← get_file
+#  - طلب واحد كل MEDIA_VALIDATION_DELAY ثانية وبأولوية cleanup (لا يزاحم ردود المستخدمين)
+#  - تقرير للمشرفين عند وجود وسائط معطوبة
+# ----------------------------------------------------------------
+MEDIA_VALIDATION_DELAY = float(os.getenv("GO_MEDIA_VALIDATION_DELAY") or 1.5)
+_raw_warmup_chat_id = (os.getenv("GO_MEDIA_WARMUP_CHAT_ID") or "").strip()
+try:
+    MEDIA_WARMUP_CHAT_ID: Optional[int] = int(_raw_warmup_chat_id) if _raw_warmup_chat_id else None
+except ValueError:
+    # قيمة خاطئة ← فحص الروابط بـ HEAD فقط بدل أن يفشل فحص كل صورة
+    logging.error(f"[MEDIA CHECK] ❌ GO_MEDIA_WARMUP_CHAT_ID غير صالح ({_raw_warmup_chat_id!r})؛ تم تجاهله")
+    MEDIA_WARMUP_CHAT_ID = None
+MEDIA_REPORT_MAX_LINES = 25
+# الشيت ← [(العمود، النوع)]  النوع: image (رابط أو file_id صورة) | file (file_id ملف)
+MEDIA_REFERENCE_COLUMNS = {
+    "parts": [("Image", "image")],
+    "independent": [("image_url", "image")],
+    "manual": [("cover_image", "image"), ("pdf_file_id", "file")],
+}
+
+metric_declare("go_media_validation_total", "counter", "Catalogue media references checked by kind and result.")
+
+
+def iter_media_references() -> list:
+    """[(الشيت، رقم الصف، العمود، النوع، القيمة)] – كل قيمة مرة واحدة فقط."""
+    sheets = {"parts": df_parts, "independent": df_independent, "manual": df_manual}
+    refs, seen = [], set()
+    for name, columns in MEDIA_REFERENCE_COLUMNS.items():
+        df = sheets[name]
+        for column, kind in columns:
+            if df.empty or column not in df.columns:
+                continue
+            for index, value in df[column].items():
+                if not isinstance(value, str) or not value.strip() or value.strip() in seen:
+                    continue
+                seen.add(value.strip())
+                refs.append((name, index, column, kind, value.strip()))
+    return refs
+
+
+async def _check_file_id(bot, file_id: str) -> Optional[str]:
+    """None = صالح، وإلا سبب الفشل."""
+    try:
+        await bot.get_file(file_id)
+    except BadRequest as e:
+        if "too big" in str(e).lower():
+            return None  # الملف موجود لكنه أكبر من حد تنزيل البوت
+        return str(e)
+    return None
+
+
+async def _check_image(bot, value: str) -> Optional[str]:
+    url = _media_url(value)
+    if not url:
+        return await _check_file_id(bot, value)
+
+    cached = MEDIA_FILE_IDS.get(url)
+    if cached:
+        if await _check_file_id(bot, cached) is None:
+            return None
+        MEDIA_FILE_IDS.forget(url)
+
+    if MEDIA_WARMUP_CHAT_ID is not None:
+        # نفس مسار إرسال المستخدمين: أول إرسال ناجح يحفظ file_id
+        try:
+            msg = await send_cached_photo(bot, MEDIA_WARMUP_CHAT_ID, url, disable_notification=True)
+        except BadRequest as e:
+            return str(e)
+        try:
+            await bot.delete_message(msg.chat_id, msg.message_id)
+        except Exception:
+            pass
+        return None
+
+    response = await TELEGRAM_REQUEST.http_client.head(url, timeout=10, follow_redirects=True)
+    if response.status_code == 405:
+        return None  # الخادم لا يدعم HEAD – لا نحكم على الرابط
+    if response.status_code >= 400:
+        return f"HTTP {response.status_code}"
+    content_type = response.headers.get("content-type", "")
+    if content_type and not content_type.startswith("image/"):
+        return f"content-type: {content_type}"
+    return None
+
+
+async def media_validation_job(context: ContextTypes.DEFAULT_TYPE):
+    """فحص كل وسائط الكتالوج بمعدل محدود + تسخين كاش file_id + تقرير للمشرفين."""
+    if not is_primary_worker():
+        return
+    bot = context.bot
+    refs = iter_media_references()
+    broken, errors = [], 0
+
+    with outbound_priority(PRIORITY_CLEANUP):
+        for name, index, column, kind, value in refs:
+            try:
+                reason = await (_check_image(bot, value) if kind == "image" else _check_file_id(bot, value))
+                result = "ok" if reason is None else "broken"
+            except Exception as e:
+                # شبكة / مهلة: لا نحكم على الوسيط
+                logging.warning(f"[MEDIA CHECK] تعذر فحص {name}/{column} صف {index}: {e}")
+                reason, result = None, "error"
+                errors += 1
+            metric_inc("go_media_validation_total", {"kind": kind, "result": result})
+            if reason is not None:
+                broken.append((name, index, column, reason))
+            await asyncio.sleep(MEDIA_VALIDATION_DELAY)
+
+    await export_media_file_ids_async()
+    logging.info(f"[MEDIA CHECK] ✅ تم فحص {len(refs)} وسيط: معطوب={len(broken)} تعذر فحصه={errors}")
+    if not broken:
+        return
+
+    lines = [
+        "🔍 تقرير فحص وسائط الكتالوج\n",
+        f"تم الفحص: {len(refs)} | معطوبة: {len(broken)} | تعذر فحصها: {errors}\n",
+    ]
+    # رقم الصف كما يظهر في Excel (الصف الأول للعناوين)
+    lines.extend(
+        f"• {name} / {column} / صف {index + 2 if pd.api.types.is_integer(index) else index}: {str(reason)[:120]}"
+        for name, index, column, reason in broken[:MEDIA_REPORT_MAX_LINES]
+    )
+    if len(broken) > MEDIA_REPORT_MAX_LINES:
+        lines.append(f"… و {len(broken) - MEDIA_REPORT_MAX_LINES} أخرى")
+    report = "\n".join(lines)
+
+    async def _send_report(aid):
+        return await bot.send_message(aid, report, disable_web_page_preview=True)
+
+    notify_admins(_send_report, tag="MEDIA REPORT")
+
+
 async def daily_backup_job(context: ContextTypes.DEFAULT_TYPE):
     """نسخ احتياطي يومي تلقائي لملف الإكسل"""
+    if not is_primary_worker():
+        return  # نسخة واحدة يومياً حتى مع أكثر من worker
     try:
         # نمرر context حتى يتمكن من الإرسال إلى قناة النسخ الاحتياطي إن وُجد TG_BACKUP_CHAT_ID
         await create_excel_backup(reason="daily", context=context, notify_chat_id=None)
@@ -254,11 +2538,14 @@ df_group_logs: pd.DataFrame = pd.DataFrame()
 # 8) متغيرات عامة للنظام
 # -----------------------------------------------------------
 
-ALL_USERS = set()
+ALL_USERS = UserRegistry(USERS_LOG_PATH)
 user_sessions = {}
 
-# مستخدمون قاموا بالتقييم (كاش في الذاكرة)
-RATED_USERS: set[int] = set()
+# التقييمات (عدد/متوسط/المقيّمون في الذاكرة)
+RATINGS = RatingsStore(RATINGS_LOG_PATH)
+
+# file_id لصور الكتالوج المرسلة سابقاً
+MEDIA_FILE_IDS = MediaFileIdCache(MEDIA_FILE_IDS_PATH)
 
 # كاش لقراءة شيتات الإحصائيات لتقليل القراءة من الإكسل
 STATS_CACHE = {"excel_all": None, "loaded_at": None}
@@ -409,7 +2696,7 @@ try:
 
     # 3) تحميل المجموعات المسجلة مسبقاً في BROADCAST_GROUPS
     global BROADCAST_GROUPS
-    BROADCAST_GROUPS = {}
+    BROADCAST_GROUPS = shared_dict("broadcast_groups")
     if not df_group_logs.empty:
         for _, row in df_group_logs.iterrows():
             try:
@@ -438,7 +2725,7 @@ try:
     # 5) all_users_log → ALL_USERS
     df_users = excel_data.get("all_users_log", pd.DataFrame(columns=["user_id"]))
     try:
-        ALL_USERS = set(
+        ALL_USERS = UserRegistry(USERS_LOG_PATH).load(
             pd.to_numeric(df_users["user_id"], errors="coerce")
             .dropna()
             .astype(int)
@@ -446,23 +2733,21 @@ try:
         )
     except Exception as e:
         logging.error(f"[ALL_USERS] فشل تحميل all_users_log: {e}")
-        ALL_USERS = set()
+        ALL_USERS = UserRegistry(USERS_LOG_PATH).load()
 
-    # 6) تحميل التقييمات RATED_USERS
+    # 6) تحميل التقييمات RATINGS
     try:
-        df_ratings_init = excel_data.get("ratings", pd.DataFrame())
-        if not df_ratings_init.empty and "user_id" in df_ratings_init.columns:
-            RATED_USERS = set(
-                pd.to_numeric(df_ratings_init["user_id"], errors="coerce")
-                .dropna()
-                .astype(int)
-                .tolist()
-            )
-        else:
-            RATED_USERS = set()
+        RATINGS = RatingsStore(RATINGS_LOG_PATH).load(excel_data.get("ratings", pd.DataFrame()))
+    except Exception as e:
+        logging.warning(f"[RATINGS INIT] فشل تحميل التقييمات: {e}")
+        RATINGS = RatingsStore(RATINGS_LOG_PATH).load()
+
+    # 6-أ) كاش file_id لصور الكتالوج
+    try:
+        MEDIA_FILE_IDS = MediaFileIdCache(MEDIA_FILE_IDS_PATH).load(excel_data)
     except Exception as e:
-        logging.warning(f"[RATINGS INIT] فشل تحميل قائمة المقيمين: {e}")
-        RATED_USERS = set()
+        logging.warning(f"[FILE IDS] فشل تحميل كاش file_id: {e}")
+        MEDIA_FILE_IDS = MediaFileIdCache(MEDIA_FILE_IDS_PATH).load()
 
     # 6 مكرر) تحميل عداد GO من شيت bot_stats (لو موجود)
     try:
@@ -487,26 +2772,39 @@ try:
         else:
             GLOBAL_GO_COUNTER = 0
 
+        # أول عملية تبذر العداد المشترك، والبقية تأخذ قيمته الحالية
+        GLOBAL_GO_COUNTER = STATE_BACKEND.seed_counter("stats", "total_go_uses", GLOBAL_GO_COUNTER)
         logging.info(f"[GO STATS INIT] تم تحميل GLOBAL_GO_COUNTER = {GLOBAL_GO_COUNTER} من bot_stats")
 
+        # آخر رقم تذكرة محفوظ (بذرة لمخصص أرقام التذاكر)
+        if "key" in df_bot_stats_init.columns and "value" in df_bot_stats_init.columns:
+            row = df_bot_stats_init.loc[
+                df_bot_stats_init["key"].astype(str).str.strip() == "suggestion_ticket_counter"
+            ]
+            if not row.empty:
+                TICKET_COUNTER_SEED = int(
+                    pd.to_numeric(row["value"], errors="coerce").fillna(0).iloc[0]
+                )
+
     except Exception as e:
         logging.warning(f"[GO STATS INIT] فشل تحميل عداد GO من bot_stats: {e}")
         GLOBAL_GO_COUNTER = 0
 
-    # 7) قائمة المشرفين AUTHORIZED_USERS
+    # 7) قائمة المشرفين AUTHORIZED_USERS (مشتركة بين العمليات: الإضافة/الحذف تظهر في كل worker)
+    AUTHORIZED_USERS = shared_set("admins")
     try:
         if "manager_id" in df_admins.columns:
-            AUTHORIZED_USERS = (
+            admin_ids = set(
                 pd.to_numeric(df_admins["manager_id"], errors="coerce")
                 .dropna()
                 .astype(int)
                 .tolist()
             )
-        else:
-            AUTHORIZED_USERS = []
+            for stale_id in set(AUTHORIZED_USERS) - admin_ids:
+                AUTHORIZED_USERS.discard(stale_id)
+            AUTHORIZED_USERS.update(admin_ids)
     except Exception as e:
         logging.error(f"[ADMINS] فشل تحميل قائمة المشرفين: {e}")
-        AUTHORIZED_USERS = []
 
     # 8) الردود الجاهزة SUGGESTION_REPLIES
     if not df_replies.empty and "key" in df_replies.columns and "reply" in df_replies.columns:
@@ -549,10 +2847,11 @@ except Exception as e:
     df_group_logs  = pd.DataFrame(columns=["chat_id", "title", "type", "last_seen_utc"])
 
     unique_cars      = []
-    ALL_USERS        = set()
-    RATED_USERS      = set()
-    AUTHORIZED_USERS = []
-    BROADCAST_GROUPS = {}
+    ALL_USERS        = UserRegistry(USERS_LOG_PATH).load()
+    RATINGS          = RatingsStore(RATINGS_LOG_PATH).load()
+    MEDIA_FILE_IDS   = MediaFileIdCache(MEDIA_FILE_IDS_PATH).load()
+    AUTHORIZED_USERS = shared_set("admins")
+    BROADCAST_GROUPS = shared_dict("broadcast_groups")
 
     SUGGESTION_REPLIES = {}
     initial_branches   = []
@@ -564,16 +2863,10 @@ async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     صفحة إحصائيات GO + فتح التقييم في نفس الشاشة (HTML مسموح من تيليجرام)
     """
     query = update.callback_query
-    data = query.data or ""
     user = query.from_user
 
     # استخراج user_id من الكول باك لو متوفر
-    user_id = user.id
-    if data.startswith("rate_"):
-        try:
-            user_id = int(data.split("_", 1)[1])
-        except Exception:
-            pass
+    user_id = callback_args(context).get("user_id", user.id)
 
     user_name_raw = user.full_name or "الصديق"
     user_name_safe = html.escape(user_name_raw)
@@ -646,7 +2939,7 @@ async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # === مرات استخدام GO (من الذاكرة فقط) ===
     try:
-        real_go = int(GLOBAL_GO_COUNTER)
+        real_go = int(await asyncio.to_thread(STATE_BACKEND.incr, "stats", "total_go_uses", 0))
     except Exception:
         real_go = 0
 
@@ -657,25 +2950,9 @@ async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     already_rated = False  # 👈 نستخدمها لتحديد إظهار أزرار التقييم أو إخفائها
 
     try:
-        df_ratings = excel_all.get("ratings", pd.DataFrame())
-
-        real_count = 0
-        real_avg = 0.0
-        if not df_ratings.empty and "rating" in df_ratings.columns:
-            real_count = len(df_ratings)
-            real_avg = float(df_ratings["rating"].mean())
-
-        # 👇 التحقق هل هذا المستخدم قيّم سابقًا من الإكسل
-        if not df_ratings.empty and "user_id" in df_ratings.columns:
-            try:
-                df_ratings["user_id"] = pd.to_numeric(df_ratings["user_id"], errors="coerce")
-                already_rated = int(user_id) in df_ratings["user_id"].dropna().astype(int).tolist()
-            except Exception:
-                already_rated = False
-
-        # ربط مع الكاش RATED_USERS
-        if user_id in RATED_USERS:
-            already_rated = True
+        # 👇 من الذاكرة مباشرة (بدون قراءة شيت ratings)
+        real_count, real_avg = RATINGS.summary()
+        already_rated = RATINGS.has_rated(user_id)
 
         base_count = int(BASE_RATINGS.get("count", 0) or 0)
         base_avg = float(BASE_RATINGS.get("avg", 0.0) or 0.0)
@@ -781,40 +3058,26 @@ async def cleanup_old_sessions(context: ContextTypes.DEFAULT_TYPE, max_age_minut
 #  - total_go_uses   → عداد استخدام GO في bot_stats
 # ================================================================
 # 📌 حفظ ALL_USERS في Excel — يُستخدم في الإحصائيات والنسخ الاحتياطي
-def _update_all_users_log_sync():
-    """
-    حفظ ALL_USERS في شيت all_users_log داخل bot_data.xlsx
-    """
-    global ALL_USERS
-    try:
-        df_users = pd.DataFrame(sorted(ALL_USERS), columns=["user_id"])
-
-        with pd.ExcelWriter(
-            "bot_data.xlsx",
-            engine="openpyxl",
-            mode="a",
-            if_sheet_exists="replace",
-        ) as writer:
-            df_users.to_excel(writer, sheet_name="all_users_log", index=False)
-
-        logging.info(f"[SAVE USERS] ✅ تم حفظ {len(ALL_USERS)} مستخدم في all_users_log")
-    except Exception as e:
-        logging.error(f"[SAVE USERS] ❌ فشل حفظ all_users_log في Excel: {e}")
-
-
 async def update_all_users_log_async():
     """
-    غلاف async لحفظ المستخدمين:
-    - يشغل _update_all_users_log_sync في ثريد مستقل
-    - حتى ما يبطّئ /go ولا start
+    حفظ ALL_USERS في شيت all_users_log داخل bot_data.xlsx عبر كاتب الملف
+    - يعمل دورياً وقبل النسخ الاحتياطي فقط (المستخدم الجديد يُلحق بـ users.log)
+    - لا شيء يُكتب إن لم يضف أي مستخدم منذ آخر حفظ
+    - بعد الحفظ الفعلي يُحذف ما تم حفظه من بداية users.log
+    - في كاتب الملف فقط: غيره لا يستطيع حذف ما حُفظ فيُعيد إرسال السجل كاملاً كل مرة
     """
+    if not EXCEL_WRITER["is_writer"]:
+        return
     try:
-        loop = asyncio.get_running_loop()
-        # استخدام قفل واحد لكل عمليات الكتابة على bot_data.xlsx
-        async with EXCEL_LOCK:
-            await loop.run_in_executor(None, _update_all_users_log_sync)
+        ids, offset, inode = await asyncio.to_thread(ALL_USERS.log_snapshot)
+        if not offset:
+            return
+        df_users = pd.DataFrame({"user_id": ids})
+        if await excel_write([("sheet", "all_users_log", df_users)]):
+            await asyncio.to_thread(ALL_USERS.compact_log, offset, inode)
+        logging.info(f"[SAVE USERS] ✅ تم حفظ {len(df_users)} مستخدم في all_users_log")
     except Exception as e:
-        logging.error(f"[SAVE USERS] ❌ خطأ في تشغيل حفظ all_users_log في الخلفية: {e}")
+        logging.error(f"[SAVE USERS] ❌ فشل حفظ all_users_log في Excel: {e}")
         
 # 📌 تحديث group_logs: تعديل الداتا في الذاكرة + حفظ مباشر في Excel
 async def update_group_logs(chat_id: int, chat_title: str, context: ContextTypes.DEFAULT_TYPE):
@@ -828,6 +3091,9 @@ async def update_group_logs(chat_id: int, chat_title: str, context: ContextTypes
     if chat_id >= 0:
         return
 
+    # البوت ما زال في المجموعة ← ترجع للبث إن كانت مستبعدة
+    BROADCAST_TARGETS.revive(chat_id)
+
     # نحفظ داخل BROADCAST_GROUPS (مهم جداً للتوصيات)
     BROADCAST_GROUPS[chat_id] = {
         "title": chat_title or "غير معروف",
@@ -836,124 +3102,66 @@ async def update_group_logs(chat_id: int, chat_title: str, context: ContextTypes
 
     now_iso = datetime.now(timezone.utc).isoformat()
 
+    row = {
+        "chat_id": chat_id,
+        "title": chat_title or "غير معروف",
+        "type": "group",
+        "last_seen_utc": now_iso,
+    }
+
     # لو الشيت فيه صف سابق لنفس المجموعة -> نحدثه بدل ما نضيف واحد جديد
     if not df_group_logs.empty and (df_group_logs["chat_id"] == chat_id).any():
         mask = df_group_logs["chat_id"] == chat_id
-        df_group_logs.loc[mask, "title"] = chat_title or "غير معروف"
-        df_group_logs.loc[mask, "type"] = "group"
+        df_group_logs.loc[mask, "title"] = row["title"]
+        df_group_logs.loc[mask, "type"] = row["type"]
         df_group_logs.loc[mask, "last_seen_utc"] = now_iso
     else:
         # مجموعة جديدة -> نضيف صف واحد فقط
-        new_row = {
-            "chat_id": chat_id,
-            "title": chat_title or "غير معروف",
-            "type": "group",
-            "last_seen_utc": now_iso,
-        }
         df_group_logs = pd.concat(
-            [df_group_logs, pd.DataFrame([new_row])],
+            [df_group_logs, pd.DataFrame([row])],
             ignore_index=True
         )
 
-    # حفظ للملف بدون تجميد البوت
+    # حفظ للملف بدون تجميد البوت (صف هذه المجموعة فقط – لا نكتب فوق ما سجلته العمليات الأخرى)
     try:
-        async with EXCEL_LOCK:
-            await asyncio.to_thread(
-                write_excel_background,
-                "bot_data.xlsx",
-                df_group_logs,
-                "group_logs"
-            )
+        await excel_write([("upsert", "group_logs", "chat_id", row)])
     except Exception as e:
         logging.error(f"[GROUP_LOGS] فشل الحفظ في الخلفية: {e}")
 
-async def register_user(user_id: int):
-    """تسجيل مستخدم جديد في شيت all_users_log بشكل آمن وسريع"""
-    global ALL_USERS
-
-    if user_id in ALL_USERS:
-        return  # مسجل مسبقاً
-
-    ALL_USERS.add(user_id)
-
-    # حفظ البيانات بالخلفية بدون تجميد البوت
-    async with EXCEL_LOCK:
-        await asyncio.to_thread(
-            write_excel_background,
-            "bot_data.xlsx",
-            pd.DataFrame(sorted(ALL_USERS), columns=["user_id"]),
-            "all_users_log"
-        )
-
-def _update_go_stats_sync():
+async def update_ratings_sheet_async():
     """
-    عدّاد استخدام GO:
-    - يزيد GLOBAL_GO_COUNTER في الذاكرة
-    - يحفظ القيمة في شيت bot_stats داخل bot_data.xlsx
+    حفظ التقييمات في شيت ratings (دورياً وقبل النسخ الاحتياطي، لا لكل تقييم)
+    - بعد الحفظ الفعلي يُحذف ما تم حفظه من بداية ratings.log
+    - في كاتب الملف فقط (مثل update_all_users_log_async)
     """
-    global GLOBAL_GO_COUNTER
-
-    # 1) نحدّث العداد في الذاكرة
-    GLOBAL_GO_COUNTER += 1
-
+    if not EXCEL_WRITER["is_writer"]:
+        return
     try:
-        # 2) نقرأ شيت bot_stats الحالي (لو موجود)
-        try:
-            df_bot_stats = pd.read_excel("bot_data.xlsx", sheet_name="bot_stats")
-        except Exception:
-            # لو ما فيه شيت بهالاسم أو أول مرة ننشئه
-            df_bot_stats = pd.DataFrame(columns=["key", "value"])
-
-        # نتأكد إن عندنا الأعمدة الرئيسية
-        if "key" not in df_bot_stats.columns or "value" not in df_bot_stats.columns:
-            df_bot_stats = pd.DataFrame(columns=["key", "value"])
-
-        # 3) نحدّث أو نضيف السطر الخاص بـ total_go_uses
-        if df_bot_stats.empty:
-            df_bot_stats = pd.DataFrame(
-                [{"key": "total_go_uses", "value": GLOBAL_GO_COUNTER}]
-            )
-        else:
-            mask = df_bot_stats["key"] == "total_go_uses"
-            if mask.any():
-                df_bot_stats.loc[mask, "value"] = GLOBAL_GO_COUNTER
-            else:
-                df_bot_stats = pd.concat(
-                    [
-                        df_bot_stats,
-                        pd.DataFrame(
-                            [{"key": "total_go_uses", "value": GLOBAL_GO_COUNTER}]
-                        ),
-                    ],
-                    ignore_index=True,
-                )
-
-        # 4) نحفظ الشيت في ملف bot_data.xlsx
-        # هذا يستبدل شيت bot_stats فقط ويترك باقي الشيتات كما هي
-        with pd.ExcelWriter(
-            "bot_data.xlsx",
-            engine="openpyxl",
-            mode="a",
-            if_sheet_exists="replace",
-        ) as writer:
-            df_bot_stats.to_excel(writer, sheet_name="bot_stats", index=False)
-
-        logging.info(f"[GO STATS] ✅ تم حفظ total_go_uses = {GLOBAL_GO_COUNTER} في bot_stats")
-
+        df_ratings, offset, inode = await asyncio.to_thread(RATINGS.log_snapshot)
+        if not offset:
+            return
+        if await excel_write([("sheet", "ratings", df_ratings)]):
+            await asyncio.to_thread(RATINGS.compact_log, offset, inode)
+        logging.info(f"[RATINGS] ✅ تم حفظ {len(df_ratings)} تقييم في ratings")
     except Exception as e:
-        logging.error(f"[GO STATS] ❌ فشل حفظ عداد GO في bot_stats: {e}")
+        logging.error(f"[RATINGS] ❌ فشل حفظ شيت ratings: {e}")
 
+async def register_user(user_id: int):
+    """تسجيل مستخدم جديد (يظهر في شيت all_users_log مع الحفظ الدوري)"""
+    # إلحاق 8 بايت في users.log فقط؛ الشيت يُحدّث دورياً
+    ALL_USERS.add(user_id)
 
 async def update_go_stats_async():
     """
-    غلاف async لزيادة عداد GO:
-    - يشغّل _update_go_stats_sync في ثريد مستقل
-    - يستخدم EXCEL_LOCK حتى لا يتعارض مع أي كتابة أخرى على bot_data.xlsx
+    عدّاد استخدام GO:
+    - يزيد GLOBAL_GO_COUNTER (مشترك بين العمليات عند تفعيل الحالة المشتركة)
+    - يحفظ القيمة في شيت bot_stats عبر كاتب الملف
     """
+    global GLOBAL_GO_COUNTER
     try:
-        loop = asyncio.get_running_loop()
-        async with EXCEL_LOCK:
-            await loop.run_in_executor(None, _update_go_stats_sync)
+        GLOBAL_GO_COUNTER = await asyncio.to_thread(STATE_BACKEND.incr, "stats", "total_go_uses")
+        await excel_write([("stat", "total_go_uses", GLOBAL_GO_COUNTER)])
+        logging.info(f"[GO STATS] ✅ تم حفظ total_go_uses = {GLOBAL_GO_COUNTER} في bot_stats")
     except Exception as e:
         logging.error(f"[GO STATS] فشل تحديث عداد GO: {e}")
 
@@ -970,7 +3178,7 @@ def _write_health_log_sync():
         HEALTH_BUFFER.append({
             "timestamp": now_saudi.isoformat(timespec="seconds"),
             "total_users": len(ALL_USERS),
-            "total_go_uses": GLOBAL_GO_COUNTER,
+            "total_go_uses": STATE_BACKEND.incr("stats", "total_go_uses", 0),
         })
         logging.info("[HEALTH] buffered heartbeat")
     except Exception as e:
@@ -979,12 +3187,14 @@ def _write_health_log_sync():
 
 async def health_log_job(context: ContextTypes.DEFAULT_TYPE):
     try:
-        _write_health_log_sync()
+        await asyncio.to_thread(_write_health_log_sync)
     except Exception as e:
         logging.error(f"[HEALTH LOG] خطأ أثناء تحديث health_log في الذاكرة: {e}")
 
 # 🔁 جوب بسيط يطلب عنوان الخدمة لإبقاء Render مستيقظ
 async def keepalive_ping(context: ContextTypes.DEFAULT_TYPE):
+    if not is_primary_worker():
+        return
     try:
         base_url = os.getenv("RENDER_EXTERNAL_URL") or "https://chery-go-8a2z.onrender.com"
 
@@ -992,13 +3202,9 @@ async def keepalive_ping(context: ContextTypes.DEFAULT_TYPE):
         if not base_url.startswith("http"):
             base_url = "https://" + base_url.lstrip("/")
 
-        # نستخدم ثريد منفصل عشان ما نحجز event loop
-        await asyncio.to_thread(
-            requests.get,
-            base_url,
-            timeout=5,
-        )
-        logging.info(f"[KEEPALIVE] ✅ Ping {base_url}")
+        # نفس pool اتصالات تيليجرام (async) بدون حجز ثريد
+        response = await TELEGRAM_REQUEST.http_client.get(base_url, timeout=5)
+        logging.info(f"[KEEPALIVE] ✅ Ping {base_url} status={response.status_code}")
     except Exception as e:
         logging.error(f"[KEEPALIVE] ❌ فشل Ping الخدمة: {e}")
 
@@ -1034,10 +3240,280 @@ async def schedule_delete_message(context: ContextTypes.DEFAULT_TYPE):
     user_id = job_data.get("user_id")
 
     try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logging.info(f"[DELETE] 🗑️ تم حذف الرسالة رقم {message_id} للمستخدم {user_id}")
-    except Exception:
-        logging.warning(f"⚠️ الرسالة {message_id} للمستخدم {user_id} ربما حُذفت مسبقًا أو غير موجودة.")
+        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+        logging.info(f"[DELETE] 🗑️ تم حذف الرسالة رقم {message_id} للمستخدم {user_id}")
+    except Exception:
+        logging.warning(f"⚠️ الرسالة {message_id} للمستخدم {user_id} ربما حُذفت مسبقًا أو غير موجودة.")
+
+def register_messages(user_id, message_ids, chat_id=None, context=None):
+    """مثل register_message لكن لمجموعة رسائل (ألبوم) بجوب حذف واحد بدل جوب لكل رسالة."""
+    message_ids = [mid for mid in message_ids if mid]
+    if not message_ids:
+        return
+
+    for mid in message_ids:
+        register_message(user_id, mid, chat_id, context, skip_delete=True)
+
+    if context and hasattr(context, "job_queue") and context.job_queue:
+        try:
+            context.job_queue.run_once(
+                schedule_delete_messages,
+                timedelta(minutes=15),
+                data={
+                    "user_id": user_id,
+                    "message_ids": message_ids,
+                    "chat_id": chat_id or user_id
+                }
+            )
+        except Exception as e:
+            logging.warning(f"[JOB ERROR] فشل في جدولة الحذف التلقائي للرسائل {message_ids}: {e}")
+
+async def schedule_delete_messages(context: ContextTypes.DEFAULT_TYPE):
+    job_data = context.job.data
+    chat_id = job_data.get("chat_id")
+    user_id = job_data.get("user_id")
+
+    for message_id in job_data.get("message_ids", []):
+        try:
+            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except Exception:
+            logging.warning(f"⚠️ الرسالة {message_id} للمستخدم {user_id} ربما حُذفت مسبقًا أو غير موجودة.")
+    logging.info(f"[DELETE] 🗑️ تم حذف {len(job_data.get('message_ids', []))} رسالة للمستخدم {user_id}")
+
+# ================================================================
+#  🧱 كاش النصوص الثابتة لعناصر الكتالوج (صيانة / مراكز مستقلة / قطع)
+#  - جسم كل عنصر يُنسق مرة واحدة لكل نسخة من الـ DataFrame (هوية الكائن = النسخة)
+#  - الطلب يضيف فقط الترويسة (اسم المستخدم) والتذييل (وقت الحذف)
+# ================================================================
+RENDER_CACHE: dict = {}  # kind -> {"source": df, "bodies": {key: text}}
+
+metric_declare("go_render_cache_total", "counter", "Catalogue body render cache lookups by kind and result.")
+
+
+def cached_body(kind: str, source, key, render) -> str:
+    """render() تُستدعى فقط أول مرة لكل (kind, key) ضمن نفس نسخة source."""
+    store = RENDER_CACHE.get(kind)
+    if store is None or store["source"] is not source:
+        store = {"source": source, "bodies": {}}
+        RENDER_CACHE[kind] = store
+
+    body = store["bodies"].get(key)
+    if body is None:
+        body = render()
+        store["bodies"][key] = body
+        metric_inc("go_render_cache_total", {"kind": kind, "result": "miss"})
+    else:
+        metric_inc("go_render_cache_total", {"kind": kind, "result": "hit"})
+    return body
+
+
+# ================================================================
+#  🧾 عرض النتائج المتعددة: ألبومات صور (10 لكل طلب) + رسالة نصية واحدة بصفحات
+#  - بدل رسالة/صورة لكل صف من الإكسل (N طلب) تصبح تقريباً N/10
+#  - الصفحات محفوظة في user_data[user_id]["result_pages"] والتنقل بتعديل نفس الرسالة
+# ================================================================
+RESULT_ALBUM_SIZE = 10          # حد تيليجرام لـ send_media_group
+RESULT_PAGE_ENTRIES = 5         # أقصى عدد نتائج في الصفحة الواحدة
+RESULT_PAGE_MAX_CHARS = 3500    # هامش تحت حد 4096 حرف للرسالة
+RESULT_PAGE_SETS_PER_USER = 10  # نحتفظ بآخر 10 استعلامات فقط لكل مستخدم
+RESULT_ENTRY_SEPARATOR = "\n\n━━━━━━━━━━━━\n\n"
+
+
+def _paginate_entries(entries: list, header: str, footer: str) -> list:
+    """تقسيم النتائج إلى صفحات حسب العدد والطول. كل صفحة = قائمة فهارس entries."""
+    pages, current, length = [], [], len(header) + len(footer)
+    for idx, entry in enumerate(entries):
+        size = len(entry["text"]) + len(RESULT_ENTRY_SEPARATOR)
+        if current and (len(current) >= RESULT_PAGE_ENTRIES or length + size > RESULT_PAGE_MAX_CHARS):
+            pages.append(current)
+            current, length = [], len(header) + len(footer)
+        current.append(idx)
+        length += size
+    if current:
+        pages.append(current)
+    return pages
+
+
+def _render_result_page(result_set: dict, page: int, user_id: int):
+    entries = result_set["entries"]
+    page_indexes = result_set["pages"][page]
+    total_pages = len(result_set["pages"])
+
+    body = RESULT_ENTRY_SEPARATOR.join(entries[i]["text"] for i in page_indexes)
+    text = f"{result_set['header']}{body}{result_set['footer']}"
+
+    keyboard = []
+    for i in page_indexes:
+        buttons = entries[i].get("buttons") or []
+        if buttons:
+            keyboard.append([InlineKeyboardButton(label, callback_data=data) for label, data in buttons])
+
+    if total_pages > 1:
+        key = result_set["key"]
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"rpage_{key}_{page - 1}_{user_id}"))
+        nav.append(InlineKeyboardButton(f"📄 {page + 1}/{total_pages}", callback_data="disabled"))
+        if page < total_pages - 1:
+            nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"rpage_{key}_{page + 1}_{user_id}"))
+        keyboard.append(nav)
+
+    for row in result_set.get("extra_rows") or []:
+        keyboard.append([InlineKeyboardButton(label, callback_data=data) for label, data in row])
+
+    return text, (InlineKeyboardMarkup(keyboard) if keyboard else None)
+
+
+async def send_paginated_results(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    user_id: int,
+    entries: list,
+    header: str = "",
+    footer: str = "",
+    parse_mode=constants.ParseMode.HTML,
+    extra_rows: Optional[list] = None,
+):
+    """
+    إرسال نتائج نصية في رسالة واحدة بصفحات.
+    entries: [{"text": str, "buttons": [(label, callback_data), ...]}]
+    extra_rows: صفوف أزرار ثابتة أسفل كل صفحة [[(label, callback_data), ...], ...]
+    """
+    if not entries:
+        return None
+
+    result_set = {
+        "key": uuid4().hex[:8],
+        "entries": entries,
+        "header": header,
+        "footer": footer,
+        "parse_mode": parse_mode,
+        "extra_rows": extra_rows or [],
+    }
+    result_set["pages"] = _paginate_entries(entries, header, footer)
+
+    store = context.user_data.setdefault(user_id, {}).setdefault("result_pages", {})
+    store[result_set["key"]] = result_set
+    while len(store) > RESULT_PAGE_SETS_PER_USER:
+        store.pop(next(iter(store)))
+
+    text, markup = _render_result_page(result_set, 0, user_id)
+    msg = await context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=markup,
+        parse_mode=parse_mode,
+        disable_web_page_preview=True,
+    )
+    register_message(user_id, msg.message_id, chat_id, context)
+    return msg
+
+
+async def send_cached_photo(bot, chat_id: int, photo, **kwargs):
+    """send_photo مع كاش file_id: الرابط يُرفع مرة واحدة ثم يُستخدم file_id الخاص به."""
+    file_id = MEDIA_FILE_IDS.get(photo)
+    if file_id:
+        try:
+            msg = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            metric_inc("go_media_file_id_total", {"result": "hit"})
+            return msg
+        except BadRequest as e:
+            # file_id لم يعد صالحاً ← نرجع للرابط ونحفظ الجديد
+            logging.warning(f"[FILE IDS] file_id محفوظ مرفوض ({e})، إعادة الإرسال بالرابط")
+            MEDIA_FILE_IDS.forget(photo)
+    msg = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    if _media_url(photo) and msg.photo:
+        MEDIA_FILE_IDS.remember(photo, msg.photo[-1].file_id)
+        metric_inc("go_media_file_id_total", {"result": "miss"})
+    return msg
+
+
+async def send_photo_albums(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, photos: list, parse_mode=constants.ParseMode.HTML):
+    """
+    إرسال الصور كألبومات (حتى 10 صور لكل طلب) مع كابشن لكل صورة.
+    photos: [{"url": str, "caption": str, "entry": {...}}]
+    ترجع قائمة العناصر التي فشل إرسالها (لعرضها نصياً بدل الصورة).
+    """
+    failed = []
+    for start in range(0, len(photos), RESULT_ALBUM_SIZE):
+        chunk = photos[start:start + RESULT_ALBUM_SIZE]
+        try:
+            if len(chunk) == 1:
+                sent = [await send_cached_photo(
+                    context.bot,
+                    chat_id,
+                    chunk[0]["url"],
+                    caption=chunk[0]["caption"],
+                    parse_mode=parse_mode,
+                )]
+            else:
+                sent = await send_cached_album(context.bot, chat_id, chunk, parse_mode)
+            register_messages(user_id, [m.message_id for m in sent], chat_id, context)
+        except Exception as e:
+            # صورة واحدة معطوبة تفشل الألبوم كله؛ نعرض هذه المجموعة نصياً
+            logging.warning(f"[RESULTS] فشل إرسال ألبوم ({len(chunk)} صورة): {e}")
+            failed.extend(chunk)
+    return failed
+
+
+async def send_cached_album(bot, chat_id: int, chunk: list, parse_mode) -> list:
+    """
+    ألبوم صور مع كاش file_id (مثل send_cached_photo):
+    - كل صورة سبق إرسالها تُرسل بـ file_id المحفوظ
+    - رفض الألبوم وفيه file_id محفوظ ← إعادة الألبوم بالروابط الأصلية مرة واحدة؛
+      نجاحها يستبدل file_id المحفوظة فقط (التي أُرسلت من الكاش) بالجديدة، وفشلها يعني
+      أن السبب رابط معطوب فتبقى file_id السليمة في الكاش
+    """
+    def _album(sources):
+        return [
+            InputMediaPhoto(media=source, caption=item["caption"], parse_mode=parse_mode)
+            for source, item in zip(sources, chunk)
+        ]
+
+    sources = [MEDIA_FILE_IDS.get(item["url"]) or item["url"] for item in chunk]
+    try:
+        sent = await bot.send_media_group(chat_id=chat_id, media=_album(sources))
+    except BadRequest as e:
+        cached = [item["url"] for item, source in zip(chunk, sources) if source != item["url"]]
+        if not cached:
+            raise
+        logging.warning(f"[FILE IDS] ألبوم بـ {len(cached)} file_id محفوظ مرفوض ({e})، إعادة الإرسال بالروابط")
+        sources = [item["url"] for item in chunk]
+        sent = await bot.send_media_group(chat_id=chat_id, media=_album(sources))
+
+    for item, source, message in zip(chunk, sources, sent):
+        if source == item["url"] and message.photo:
+            MEDIA_FILE_IDS.remember(item["url"], message.photo[-1].file_id)
+    return sent
+
+
+async def change_result_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """rpage_KEY_PAGE_USERID: التنقل بين صفحات النتائج بتعديل نفس الرسالة"""
+    query = update.callback_query
+    args = callback_args(context)
+    user_id, key, page = args["user_id"], args["key"], args["page"]
+
+    if query.from_user.id != user_id:
+        await query.answer("❌ هذا الاستعلام خاص بصاحبه - استخدم الأمر go", show_alert=True)
+        return
+
+    result_set = context.user_data.get(user_id, {}).get("result_pages", {}).get(key)
+    if not result_set or not (0 <= page < len(result_set["pages"])):
+        await query.answer("⌛ انتهت صلاحية هذه النتائج، يرجى إعادة الاستعلام عبر /go", show_alert=True)
+        return
+
+    text, markup = _render_result_page(result_set, page, user_id)
+    try:
+        await query.edit_message_text(
+            text,
+            reply_markup=markup,
+            parse_mode=result_set["parse_mode"],
+            disable_web_page_preview=True,
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    await query.answer()
 
 async def reset_manual_search_state(context: ContextTypes.DEFAULT_TYPE):
     """تصـفير عداد البحث اليدوي (search_attempts) بعد 15 دقيقة من آخر استعلام"""
@@ -1110,20 +3586,9 @@ def make_back_button(target: str, user_id: int) -> InlineKeyboardButton:
 async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة أزرار الرجوع الموحدة من نوع back:target:user_id"""
     query = update.callback_query
-    raw = query.data or ""
-    parts = raw.split(":")
-
-    if len(parts) < 3:
-        await query.answer("❌ زر رجوع غير معروف.", show_alert=True)
-        return
-
-    _, target, user_id_str = parts
-
-    try:
-        user_id = int(user_id_str)
-    except ValueError:
-        await query.answer("❌ خطأ في بيانات زر الرجوع.", show_alert=True)
-        return
+    args = callback_args(context)
+    target = args["target"]
+    user_id = args["user_id"]
 
     # تجهيز كيبورد القائمة الرئيسية بشكل آمن
     kb = build_main_menu_keyboard(user_id)
@@ -1245,14 +3710,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.setdefault(user_id, {})
     context.user_data[user_id]["manual_sent"] = False
 
-    # ✅ تسجيل المستخدم في all_users_log (تحديث في الخلفية عند أول استخدام)
-    global ALL_USERS
-    if user_id not in ALL_USERS:
+    # ✅ تسجيل المستخدم (إلحاق بـ users.log؛ شيت all_users_log يُحدّث دورياً)
+    try:
         ALL_USERS.add(user_id)
-        try:
-            asyncio.create_task(update_all_users_log_async())
-        except Exception as e:
-            logging.error(f"[SAVE USERS] فشل جدولة حفظ all_users_log في الخلفية: {e}")
+    except Exception as e:
+        logging.error(f"[SAVE USERS] فشل تسجيل المستخدم {user_id}: {e}")
 
     # ✅ تحديث عداد استخدام go في الخلفية (بدون تعطيل رسالة الترحيب والقوائم)
     try:
@@ -1525,38 +3987,16 @@ async def start_suggestion_session(user_id, context):
     # ✅ لو عند المستخدم جلسة سابقة غير مرسلة، نعيد استخدام نفس التذكرة
     user_state = context.user_data.get(user_id, {})
     active_id = user_state.get("active_suggestion_id")
-    if active_id and user_id in suggestion_records:
-        existing_record = suggestion_records[user_id].get(active_id)
+    if active_id:
+        existing_record = await asyncio.to_thread(TICKETS.get, user_id, active_id)
         if existing_record and not existing_record.get("submitted"):
             return active_id
 
     # otherwise نفتح تذكرة جديدة
     suggestion_id = uuid4().hex
 
-    # ✅ توليد رقم تذكرة تسلسلي ثابت من الإكسل (bot_stats)
-    global SUGGESTION_TICKET_COUNTER
-
-    # ====== ✅ تعويض الأرقام القديمة + منع الرجوع للصفر ======
-    # أول رقم مطلوب يبدأ من 2623، لذلك نخزن/نقرأ آخر رقم كـ 2622
-    BASE_COUNTER = 2622
-
-    last_counter = await get_bot_stat_value("suggestion_ticket_counter", BASE_COUNTER)
-    try:
-        last_counter = int(last_counter)
-    except Exception:
-        last_counter = BASE_COUNTER
-
-    if last_counter < BASE_COUNTER:
-        last_counter = BASE_COUNTER
-
-    if isinstance(last_counter, int) and last_counter >= SUGGESTION_TICKET_COUNTER:
-        SUGGESTION_TICKET_COUNTER = last_counter
-    # ================================================
-
-    SUGGESTION_TICKET_COUNTER += 1
-    ticket_no = SUGGESTION_TICKET_COUNTER
-
-    await set_bot_stat_value("suggestion_ticket_counter", SUGGESTION_TICKET_COUNTER)
+    # ✅ رقم تذكرة تسلسلي من الكتلة المحجوزة في الذاكرة (بدون فتح الإكسل)
+    ticket_no = await allocate_ticket_no()
 
     context.user_data.setdefault(user_id, {})
 
@@ -1576,8 +4016,7 @@ async def start_suggestion_session(user_id, context):
     group_id = group_id or "غير معروف"
 
     # ✅ سجل الاقتراح
-    suggestion_records.setdefault(user_id, {})
-    suggestion_records[user_id][suggestion_id] = {
+    await asyncio.to_thread(TICKETS.create, user_id, suggestion_id, {
         "ticket_no": ticket_no,
         "text": None,
         "media": None,
@@ -1587,64 +4026,60 @@ async def start_suggestion_session(user_id, context):
         "group_id": group_id,
         "user_name": user_name,
         "reply_count": 0,
-    }
+    })
 
     context.user_data[user_id]["active_suggestion_id"] = suggestion_id
     return suggestion_id
 
-async def get_bot_stat_value(key: str, default=0):
-    try:
-        async with EXCEL_LOCK:
-            wb = openpyxl.load_workbook("bot_data.xlsx")
-            if "bot_stats" not in wb.sheetnames:
-                return default
-
-            ws = wb["bot_stats"]
-
-            for row in range(2, ws.max_row + 1):
-                k = ws.cell(row=row, column=1).value
-                if str(k).strip() == str(key).strip():
-                    v = ws.cell(row=row, column=2).value
-                    try:
-                        return int(v)
-                    except Exception:
-                        return default
-
-            return default
-    except Exception:
-        return default
+# ================================================================
+#  🎫 مخصص أرقام التذاكر: كتل محجوزة مسبقاً في ملف عداد صغير
+#  - كل 100 تذكرة = كتابة واحدة لملف JSON (ذرية) بدل حفظ الإكسل كاملاً
+#  - الأرقام تصاعدية دائماً حتى بعد إعادة التشغيل (الأرقام غير المستخدمة تُتجاوز)
+#  - flock يمنع تداخل الحجز بين أكثر من عملية
+# ================================================================
+TICKET_COUNTER_FILE = STATE_DIR / "ticket_counter.json"
+TICKET_BLOCK = {"next": 0, "limit": 0}  # الرقم التالي المتاح + آخر رقم في الكتلة الحالية
+TICKET_ALLOC_LOCK = asyncio.Lock()
 
-async def set_bot_stat_value(key: str, value):
-    async with EXCEL_LOCK:
-        wb = openpyxl.load_workbook("bot_data.xlsx")
-        if "bot_stats" not in wb.sheetnames:
-            ws = wb.create_sheet("bot_stats")
-            ws.cell(row=1, column=1).value = "key"
-            ws.cell(row=1, column=2).value = "value"
-        else:
-            ws = wb["bot_stats"]
-
-        found = False
-        for row in range(2, ws.max_row + 1):
-            k = ws.cell(row=row, column=1).value
-            if str(k).strip() == str(key).strip():
-                ws.cell(row=row, column=2).value = value
-                found = True
-                break
 
-        if not found:
-            next_row = ws.max_row + 1
-            ws.cell(row=next_row, column=1).value = key
-            ws.cell(row=next_row, column=2).value = value
+def _reserve_ticket_block_sync(block_size: int) -> tuple[int, int]:
+    """حجز كتلة أرقام جديدة: ترجع (أول رقم، آخر رقم)."""
+    with _FileLock(TICKET_COUNTER_FILE.with_suffix(".lock")):
+        state = _read_json_file(TICKET_COUNTER_FILE, {}) or {}
+        try:
+            reserved_until = int(state.get("reserved_until", 0))
+        except Exception:
+            reserved_until = 0
+
+        start = max(reserved_until, TICKET_COUNTER_SEED, TICKET_BASE_COUNTER) + 1
+        limit = start + block_size - 1
+        _write_json_file_atomic(TICKET_COUNTER_FILE, {"reserved_until": limit})
+        return start, limit
+
+
+async def allocate_ticket_no() -> int:
+    """رقم تذكرة جديد بدون أي قراءة/كتابة على الإكسل في المسار المعتاد."""
+    global SUGGESTION_TICKET_COUNTER
+
+    async with TICKET_ALLOC_LOCK:
+        if TICKET_BLOCK["next"] == 0 or TICKET_BLOCK["next"] > TICKET_BLOCK["limit"]:
+            start, limit = await asyncio.to_thread(_reserve_ticket_block_sync, TICKET_BLOCK_SIZE)
+            TICKET_BLOCK["next"], TICKET_BLOCK["limit"] = start, limit
+            logging.info(f"[TICKETS] 🎫 تم حجز الأرقام {start} → {limit}")
+            # نسخة للإحصائيات في bot_stats (مرة لكل كتلة، في الخلفية)
+            spawn_background(set_bot_stat_value("suggestion_ticket_counter", limit))
 
-        wb.save("bot_data.xlsx")
+        ticket_no = TICKET_BLOCK["next"]
+        TICKET_BLOCK["next"] += 1
+        SUGGESTION_TICKET_COUNTER = ticket_no
+        return ticket_no
 
-def _next_team_thread_id() -> int:
-    """توليد رقم تسلسلي لكل نقاش داخلي لفريق GO"""
-    global TEAM_THREAD_COUNTER
-    TEAM_THREAD_COUNTER += 1
-    return TEAM_THREAD_COUNTER
 
+async def set_bot_stat_value(key: str, value):
+    try:
+        await excel_write([("stat", key, value)])
+    except Exception as e:
+        logging.error(f"[BOT STATS] ❌ فشل حفظ {key} في bot_stats: {e}")
 
 async def handle_team_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """استقبال رسالة داخلية من مشرف ضمن نقاش فريق GO"""
@@ -1659,21 +4094,24 @@ async def handle_team_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     state = context.user_data.get(admin_id, {})
     thread_id = state.get("team_thread_id")
-    if not thread_id or thread_id not in team_threads:
+    # تحميل النقاش من القرص الآن فقط (عند وصول الرد)
+    thread = await asyncio.to_thread(TEAM_THREADS.get, thread_id) if thread_id else None
+    if not thread:
         await message.reply_text("⚠️ لا توجد جلسة نقاش داخلي نشطة.")
         state["team_mode"] = False
         state.pop("team_thread_id", None)
         return
 
-    thread = team_threads[thread_id]
-    thread.setdefault("messages", [])
-    thread["messages"].append(
+    await asyncio.to_thread(
+        TEAM_THREADS.add_message,
+        thread_id,
+        thread,
         {
             "from": admin_id,
             "name": admin.full_name,
             "text": text,
             "at": datetime.now(timezone.utc).isoformat()
-        }
+        },
     )
 
     # عداد ردود النقاش
@@ -1718,22 +4156,20 @@ async def handle_team_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     state["team_mode"] = False
     state.pop("team_thread_id", None)
 
-    # إرسال الرسالة لكل المشرفين
-    for aid in AUTHORIZED_USERS:
-        try:
-            buttons = [
-                [InlineKeyboardButton("✉️ رد على هذا النقاش", callback_data=f"team_reply_{thread_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(buttons)
+    # إرسال الرسالة لكل المشرفين (بالتوازي وفي الخلفية)
+    reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✉️ رد على هذا النقاش", callback_data=f"team_reply_{thread_id}")]
+    ])
 
-            await context.bot.send_message(
-                chat_id=aid,
-                text=body,
-                parse_mode=constants.ParseMode.MARKDOWN,
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logging.warning(f"[TEAM_THREAD] فشل إرسال رد النقاش للمشرف {aid}: {e}")
+    async def _send_to_admin(aid):
+        return await context.bot.send_message(
+            chat_id=aid,
+            text=body,
+            parse_mode=constants.ParseMode.MARKDOWN,
+            reply_markup=reply_markup
+        )
+
+    notify_admins(_send_to_admin, tag="TEAM_THREAD")
 
 # =========================== توصيات فنية عامة للمجموعات ===========================
 
@@ -2005,6 +4441,95 @@ def build_reco_groups_keyboard(admin_id: int, context: ContextTypes.DEFAULT_TYPE
 
     return InlineKeyboardMarkup(rows)
 
+# ================================================================
+#  📑 ترقيم صفحات الكيبوردات الطويلة (براندات / سيارات / مدن / فروع)
+#  - نفس فكرة reco_page لكن عامة: كل قائمة تسجل builder يبني صفوفها من اسم القائمة + arg
+#  - رقم الصفحة داخل callback_data (kbp_NAME_PAGE_USERID_ARG) وليس في user_data
+#  - markup كل صفحة يُخزن مؤقتاً فلا نعيد بناء القائمة عند التنقل
+# ================================================================
+KEYBOARD_LISTS: dict = {}  # name -> builder(context, user_id, arg) -> (item_rows, footer_rows)
+KEYBOARD_PAGE_SIZE = int(os.getenv("GO_KEYBOARD_PAGE_SIZE", "8"))
+KEYBOARD_PAGE_CACHE: "OrderedDict[tuple, dict]" = OrderedDict()
+KEYBOARD_PAGE_CACHE_MAX = 500
+KEYBOARD_PAGE_CACHE_TTL = 15 * 60  # نفس عمر رسائل الاستعلام
+
+
+def keyboard_list(name: str):
+    """تسجيل builder لقائمة قابلة للترقيم (الاسم بدون "_" لأنه جزء من callback_data)."""
+    if "_" in name:
+        raise ValueError(f"اسم القائمة لا يقبل '_': {name}")
+
+    def decorator(builder):
+        KEYBOARD_LISTS[name] = builder
+        return builder
+    return decorator
+
+
+def _keyboard_list_entry(context, name: str, user_id: int, arg: str) -> dict:
+    key = (name, user_id, arg)
+    now = monotonic()
+    entry = KEYBOARD_PAGE_CACHE.get(key)
+    if entry is None or now - entry["built_at"] > KEYBOARD_PAGE_CACHE_TTL:
+        item_rows, footer_rows = KEYBOARD_LISTS[name](context, user_id, arg)
+        entry = {"items": item_rows, "footer": footer_rows, "pages": {}, "built_at": now}
+        KEYBOARD_PAGE_CACHE[key] = entry
+        while len(KEYBOARD_PAGE_CACHE) > KEYBOARD_PAGE_CACHE_MAX:
+            KEYBOARD_PAGE_CACHE.popitem(last=False)
+    KEYBOARD_PAGE_CACHE.move_to_end(key)
+    return entry
+
+
+def paged_keyboard(context, name: str, user_id: int, arg: str = "-", page: int = 0) -> InlineKeyboardMarkup:
+    """كيبورد صفحة واحدة من القائمة name + أزرار التنقل + الأزرار الثابتة أسفلها."""
+    entry = _keyboard_list_entry(context, name, user_id, arg)
+    items = entry["items"]
+    total_pages = max((len(items) - 1) // KEYBOARD_PAGE_SIZE + 1, 1)
+    page = min(max(page, 0), total_pages - 1)
+
+    markup = entry["pages"].get(page)
+    if markup is not None:
+        return markup
+
+    start = page * KEYBOARD_PAGE_SIZE
+    rows = list(items[start:start + KEYBOARD_PAGE_SIZE])
+
+    if total_pages > 1:
+        ref = cb_ref(arg)
+        nav_row = []
+        if page > 0:
+            nav_row.append(InlineKeyboardButton("◀️ السابق", callback_data=f"kbp_{name}_{page - 1}_{user_id}_{ref}"))
+        nav_row.append(InlineKeyboardButton(f"📄 {page + 1}/{total_pages}", callback_data="disabled"))
+        if page < total_pages - 1:
+            nav_row.append(InlineKeyboardButton("التالي ▶️", callback_data=f"kbp_{name}_{page + 1}_{user_id}_{ref}"))
+        rows.append(nav_row)
+
+    rows.extend(entry["footer"])
+    markup = InlineKeyboardMarkup(rows)
+    entry["pages"][page] = markup
+    return markup
+
+
+async def change_keyboard_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """kbp_NAME_PAGE_USERID_ARG: تبديل صفحة الكيبورد بتعديل الأزرار فقط"""
+    query = update.callback_query
+    args = callback_args(context)
+    name, page, user_id = args["name"], args["page"], args["user_id"]
+
+    if query.from_user.id != user_id:
+        await query.answer("❌ هذه القائمة خاصة بصاحبها - استخدم الأمر go", show_alert=True)
+        return
+
+    if name not in KEYBOARD_LISTS:
+        await query.answer("⚠️ قائمة غير معروفة.", show_alert=True)
+        return
+
+    try:
+        await query.edit_message_reply_markup(reply_markup=paged_keyboard(context, name, user_id, args["arg"], page))
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    await query.answer()
+
 async def show_reco_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """فتح قائمة اختيار المجموعات يدوياً"""
     query = update.callback_query
@@ -2074,16 +4599,7 @@ async def toggle_reco_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("غير مصرح.", show_alert=True)
         return
 
-    data = (query.data or "").split("_", 2)
-    if len(data) < 3:
-        await query.answer()
-        return
-
-    try:
-        cid = int(data[2])
-    except ValueError:
-        await query.answer()
-        return
+    cid = callback_args(context)["cid"]
 
     ud = context.user_data.setdefault(admin_id, {})
     selected = set(ud.get("reco_selected") or [])
@@ -2121,7 +4637,7 @@ async def change_reco_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     page = ud.get("reco_page", 0) or 0
-    action = (query.data or "").split("_")[-1]
+    action = callback_args(context)["direction"]
     page_size = 5
     max_page = max((len(groups) - 1) // page_size, 0)
 
@@ -2174,7 +4690,583 @@ def collect_target_chat_ids(context: ContextTypes.DEFAULT_TYPE) -> list[int]:
             if gid and gid < 0:
                 targets.add(gid)
 
-    return list(targets)
+    # 🩺 استبدال المجموعات المحولة + استبعاد الميتة/المتعثرة (انظر BroadcastTargetHealth)
+    return BROADCAST_TARGETS.filter_targets(targets)
+
+# ----------------------------------------------------------------
+#  📡 مُجمّع التوصيات: التوصية ← خطة إرسال ثابتة تُبنى مرة واحدة قبل البث
+#  - الخطوات نداءات API مرتبة بحمولات جاهزة (ألبوم / صوت / صورة / نص)
+#  - البث يعيد تشغيل نفس الخطة لكل مجموعة: لا فرز ولا بناء InputMedia لكل هدف
+#  - أي خطوة أساسية تفشل ← fallback (نص HTML فقط) كما كان سابقاً
+# ----------------------------------------------------------------
+RECO_FOOTER = "فريق الصيانة والدعم الفني GO"
+# ترتيب الأنواع للألبوم: فيديو ثم صورة ثم ملف
+RECO_TYPE_ORDER = {"video": 0, "photo": 1, "document": 2}
+RECO_ALBUM_TYPES = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+
+
+class BroadcastStep(NamedTuple):
+    method: str                 # اسم دالة البوت (send_media_group / send_voice / send_photo / send_message)
+    kwargs: MappingProxyType    # الحمولة الجاهزة (للقراءة فقط)
+    optional: bool = False      # فشلها يُسجل فقط ولا يوقف الخطة (أصوات إضافية)
+
+
+class BroadcastPlan(NamedTuple):
+    steps: tuple
+    pin_from: tuple             # أرقام الخطوات المفضلة للتثبيت بالترتيب (أول نتيجة موجودة)
+    fallback: BroadcastStep
+    html_text: str
+    preview_media: Optional[dict]  # وسيط واحد لمعاينة المشرفين
+
+
+def _step(method: str, optional: bool = False, **kwargs) -> BroadcastStep:
+    return BroadcastStep(method, MappingProxyType(kwargs), optional)
+
+
+def render_reco_html(raw_text: str) -> str:
+    """نص التوصية بصيغة HTML + التذييل + رابط "اضغط هنا لعرض التفاصيل" إن وجد."""
+    url_match = re.search(r"(https?://\S+)", raw_text) if raw_text else None
+    html_body = ""
+    if raw_text:
+        # إزالة الرابط الخام من النص الظاهر
+        html_body = html.escape(raw_text.replace(url_match.group(1), "").strip() if url_match else raw_text)
+    html_body = f"{html_body}\n\n{html.escape(RECO_FOOTER)}" if html_body else html.escape(RECO_FOOTER)
+    if url_match:
+        safe_url = html.escape(url_match.group(1).strip(), quote=True)
+        html_body += f"\n\n🔗 <a href=\"{safe_url}\">اضغط هنا لعرض التفاصيل</a>"
+    return html_body
+
+
+def compile_broadcast(raw_text: str, media_list: list, fallback_photo: Optional[bytes] = None) -> BroadcastPlan:
+    """تحويل التوصية (نص + وسائط) إلى خطة إرسال ثابتة."""
+    html_text = render_reco_html(raw_text or "")
+    caption = {"caption": html_text, "parse_mode": constants.ParseMode.HTML}
+    fallback = _step("send_message", text=html_text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+
+    album_media = sorted(
+        (m for m in media_list if m.get("type") in RECO_ALBUM_TYPES and m.get("file_id")),
+        key=lambda m: RECO_TYPE_ORDER.get(m.get("type"), 3),
+    )
+    voices = [m["file_id"] for m in media_list if m.get("type") == "voice" and m.get("file_id")]
+    non_voice = [m for m in media_list if m.get("type") != "voice"]
+    preview = (
+        sorted(non_voice, key=lambda m: RECO_TYPE_ORDER.get(m.get("type"), 3))[0] if non_voice
+        else next((m for m in media_list if m.get("type") == "voice"), None)
+    )
+
+    steps, pin_from = [], ()
+    if voices:
+        # 🖼️ الوسائط غير الصوتية ألبوم بدون كابتشن، ثم أول صوت مع النص الكامل، ثم بقية الأصوات
+        if album_media:
+            steps.append(_step("send_media_group", media=tuple(
+                RECO_ALBUM_TYPES[m["type"]](media=m["file_id"]) for m in album_media
+            )))
+        steps.append(_step("send_voice", voice=voices[0], **caption))
+        pin_from = (len(steps) - 1,) + ((0,) if album_media else ())
+        steps.extend(_step("send_voice", optional=True, voice=fid) for fid in voices[1:])
+    elif album_media:
+        # أول وسيط فقط معه الكابتشن (النص + التذييل + الرابط)
+        steps.append(_step("send_media_group", media=tuple(
+            RECO_ALBUM_TYPES[m["type"]](media=m["file_id"], **(caption if i == 0 else {}))
+            for i, m in enumerate(album_media)
+        )))
+        pin_from = (0,)
+    elif not media_list and fallback_photo is not None:
+        # لا توجد وسائط ← صورة GO-NOW.PNG مع نفس النص
+        steps.append(_step("send_photo", photo=fallback_photo, **caption))
+        pin_from = (0,)
+    else:
+        steps.append(fallback)
+        pin_from = (0,)
+
+    return BroadcastPlan(tuple(steps), pin_from, fallback, html_text, preview)
+
+
+async def replay_broadcast_plan(bot, chat_id: int, plan: BroadcastPlan):
+    """تنفيذ الخطة لمجموعة واحدة؛ ترجع الرسالة القابلة للتثبيت (أو None)."""
+    results = []
+    try:
+        for step in plan.steps:
+            try:
+                results.append(await getattr(bot, step.method)(chat_id, **step.kwargs))
+            except Exception as e:
+                if not step.optional:
+                    raise
+                logging.warning(f"[RECO BROADCAST] فشل إرسال {step.method} إضافي إلى {chat_id}: {e}")
+                results.append(None)
+    except (Forbidden, ChatMigrated):
+        # المجموعة غير متاحة أصلاً – لا فائدة من محاولة النص
+        raise
+    except Exception as e:
+        logging.warning(f"[RECO BROADCAST] خطأ أثناء إرسال الوسائط إلى {chat_id}: {e}")
+        # في حالة أي خطأ نرجع للخطة البسيطة: نص فقط
+        return await getattr(bot, plan.fallback.method)(chat_id, **plan.fallback.kwargs)
+
+    for index in plan.pin_from:
+        result = results[index]
+        if isinstance(result, (list, tuple)):
+            result = result[0] if result else None
+        if result is not None:
+            return result
+    return None
+
+
+# ----------------------------------------------------------------
+#  🗂️ مهام البث المحفوظة: كل بث = مهمة في SQLite مع حالة لكل مجموعة
+#  - الحالات: pending / sending / sent / failed / skipped
+#  - المجموعة تُحجز (pending ← sending) قبل الإرسال وتُسجل نتيجتها فور انتهائه
+#    (لا ترسل نفس المهمة لنفس المجموعة مرتين مهما تكرر الاستئناف)
+#  - المهمة تجدد heartbeat مع كل مجموعة؛ مهمة توقف نبضها (إعادة تشغيل / انهيار)
+#    يستأنفها الـ worker الرئيسي من المجموعات المتبقية فقط
+#  - مجموعة انقطع الإرسال لها في المنتصف (sending) تُسجل failed ولا يُعاد الإرسال لها
+# ----------------------------------------------------------------
+BROADCAST_JOBS_DB_PATH = Path(os.getenv("GO_BROADCAST_JOBS_DB") or STATE_DIR / "broadcast_jobs.sqlite3")
+BROADCAST_JOB_STALE_SECONDS = float(os.getenv("GO_BROADCAST_JOB_STALE_SECONDS") or 300)
+BROADCAST_PROGRESS_EVERY = 10
+
+BROADCAST_STATUS_LABELS = {
+    "pending": "⏳ بالانتظار",
+    "sent": "✅ تم الإرسال",
+    "skipped": "⏭️ تم التخطي",
+    "failed": "⚠️ فشل",
+}
+
+
+class BroadcastJobStore:
+    """مهام البث: create / get / claim / mark / pending / progress / take_over / finish / recent."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, "
+            "state TEXT NOT NULL, owner TEXT, heartbeat REAL NOT NULL, spec BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_targets (job_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+            "position INTEGER NOT NULL, status TEXT NOT NULL, error TEXT, PRIMARY KEY (job_id, chat_id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, heartbeat)")
+
+    def create(self, spec: dict, targets) -> int:
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                job_id = self._conn.execute(
+                    "INSERT INTO jobs (created_at, state, owner, heartbeat, spec) VALUES (?, 'running', ?, ?, ?)",
+                    (now, WORKER_ID, now, pickle.dumps(spec)),
+                ).lastrowid
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO job_targets (job_id, chat_id, position, status) VALUES (?, ?, ?, 'pending')",
+                    ((job_id, int(chat_id), position) for position, chat_id in enumerate(targets)),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT spec FROM jobs WHERE job_id=?", (job_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def update_spec(self, job_id: int, spec: dict):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET spec=? WHERE job_id=?", (pickle.dumps(spec), job_id))
+
+    def pending(self, job_id: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id FROM job_targets WHERE job_id=? AND status='pending' ORDER BY position", (job_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def claim(self, job_id: int, chat_id: int) -> bool:
+        """حجز المجموعة قبل الإرسال (مرة واحدة فقط لكل مهمة) + تجديد نبض المهمة."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET heartbeat=? WHERE job_id=?", (datetime.now(timezone.utc).timestamp(), job_id)
+            )
+            return self._conn.execute(
+                "UPDATE job_targets SET status='sending' WHERE job_id=? AND chat_id=? AND status='pending'",
+                (job_id, chat_id),
+            ).rowcount == 1
+
+    def migrate(self, job_id: int, old_chat_id: int, new_chat_id: int) -> bool:
+        """نقل هدف تحول إلى supergroup؛ False إن كان الرقم الجديد موجوداً في المهمة (يُرسل له في دوره)."""
+        with self._lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM job_targets WHERE job_id=? AND chat_id=?", (job_id, new_chat_id)
+            ).fetchone()
+            if exists:
+                self._conn.execute(
+                    "DELETE FROM job_targets WHERE job_id=? AND chat_id=?", (job_id, old_chat_id)
+                )
+                return False
+            self._conn.execute(
+                "UPDATE job_targets SET chat_id=? WHERE job_id=? AND chat_id=?", (new_chat_id, job_id, old_chat_id)
+            )
+            return True
+
+    def mark(self, job_id: int, chat_id: int, status: str, error: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE job_targets SET status=?, error=? WHERE job_id=? AND chat_id=?",
+                (status, error, job_id, chat_id),
+            )
+
+    def progress(self, job_id: int) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM job_targets WHERE job_id=? GROUP BY status", (job_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def stale(self, max_age: float) -> list:
+        cutoff = datetime.now(timezone.utc).timestamp() - max_age
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE state='running' AND heartbeat < ? ORDER BY job_id", (cutoff,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def take_over(self, job_id: int, max_age: float) -> bool:
+        """استلام مهمة متوقفة؛ المجموعات التي انقطع إرسالها تُسجل failed بدل إعادة الإرسال."""
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            taken = self._conn.execute(
+                "UPDATE jobs SET owner=?, heartbeat=? WHERE job_id=? AND state='running' AND heartbeat < ?",
+                (WORKER_ID, now, job_id, now - max_age),
+            ).rowcount == 1
+            if taken:
+                self._conn.execute(
+                    "UPDATE job_targets SET status='failed', error='interrupted' WHERE job_id=? AND status='sending'",
+                    (job_id,),
+                )
+        return taken
+
+    def finish(self, job_id: int):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET state='done' WHERE job_id=?", (job_id,))
+
+    def recent(self, limit: int = 5) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id, created_at, state, spec FROM jobs ORDER BY job_id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [(job_id, created_at, state, pickle.loads(spec)) for job_id, created_at, state, spec in rows]
+
+
+BROADCAST_JOBS = BroadcastJobStore(BROADCAST_JOBS_DB_PATH)
+# المهام التي تعمل حالياً داخل هذه العملية
+BROADCAST_RUNNING: set = set()
+
+# ----------------------------------------------------------------
+#  🩺 صحة أهداف البث: لا نكرر المحاولة في مجموعات ميتة مع كل توصية
+#  - Forbidden (البوت أُزيل/حُظر) أو "chat not found" ← dead: تُستبعد فوراً
+#  - فشل / تخطي (البوت ليس مشرفاً) متتالي BROADCAST_TARGET_MAX_FAILURES مرة ← demoted:
+#    تُستبعد، وتُجرّب مرة واحدة كل BROADCAST_TARGET_PROBE_HOURS
+#  - ChatMigrated (تحولت لـ supergroup) ← يُحفظ الرقم الجديد ويُستبدل تلقائياً في كل بث
+#  - أي نشاط جديد للبوت في المجموعة (update_group_logs) أو إرسال ناجح ← تعود live
+# ----------------------------------------------------------------
+BROADCAST_TARGET_MAX_FAILURES = int(os.getenv("GO_BROADCAST_TARGET_MAX_FAILURES") or 3)
+BROADCAST_TARGET_PROBE_HOURS = float(os.getenv("GO_BROADCAST_TARGET_PROBE_HOURS") or 24)
+
+metric_declare("go_broadcast_target_results_total", "counter", "Broadcast target outcomes by classification.")
+
+
+class BroadcastTargetHealth:
+    """صحة المجموعات: record / revive / filter_targets / resolve (الأهداف السليمة تماماً لا تُخزن في الذاكرة)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(path), timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS target_health (chat_id INTEGER PRIMARY KEY, status TEXT NOT NULL, "
+            "failures INTEGER NOT NULL, reason TEXT, moved_to INTEGER, updated_at REAL NOT NULL)"
+        )
+        # chat_id → (status, failures, moved_to, updated_at) للمجموعات غير السليمة فقط
+        self._unhealthy = {
+            row[0]: tuple(row[1:])
+            for row in self._conn.execute(
+                "SELECT chat_id, status, failures, moved_to, updated_at FROM target_health WHERE status != 'live'"
+            )
+        }
+        # فشل متتالي لمجموعات ما زالت live (محفوظ على القرص: إعادة التشغيل لا تصفّر العداد)
+        self._failures = dict(
+            self._conn.execute("SELECT chat_id, failures FROM target_health WHERE status = 'live' AND failures > 0")
+        )
+
+    def _save(self, chat_id: int, status: str, failures: int, reason: Optional[str], moved_to: Optional[int] = None):
+        now = datetime.now(timezone.utc).timestamp()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO target_health (chat_id, status, failures, reason, moved_to, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (chat_id) DO UPDATE SET status=excluded.status, "
+                "failures=excluded.failures, reason=excluded.reason, moved_to=excluded.moved_to, "
+                "updated_at=excluded.updated_at",
+                (chat_id, status, failures, reason, moved_to, now),
+            )
+            if status == "live":
+                self._unhealthy.pop(chat_id, None)
+                if failures:
+                    self._failures[chat_id] = failures
+                else:
+                    self._failures.pop(chat_id, None)
+            else:
+                self._unhealthy[chat_id] = (status, failures, moved_to, now)
+                self._failures.pop(chat_id, None)
+
+    def record(self, chat_id: int, outcome: str, reason: Optional[str] = None, moved_to: Optional[int] = None):
+        """outcome: sent / skipped / failed / dead / migrated (كتابة SQLite – تُستدعى من ثريد)."""
+        metric_inc("go_broadcast_target_results_total", {"outcome": outcome})
+        with self._lock:
+            if outcome == "sent":
+                if chat_id in self._unhealthy or chat_id in self._failures:
+                    self._save(chat_id, "live", 0, None)
+            elif outcome == "dead":
+                self._save(chat_id, "dead", 0, reason)
+            elif outcome == "migrated":
+                self._save(chat_id, "migrated", 0, reason, moved_to)
+            else:
+                # كل فشل يُحفظ فوراً؛ الوصول للحد ← demoted
+                previous = self._unhealthy[chat_id][1] if chat_id in self._unhealthy else self._failures.get(chat_id, 0)
+                failures = previous + 1
+                status = "demoted" if failures >= BROADCAST_TARGET_MAX_FAILURES else "live"
+                self._save(chat_id, status, failures, reason)
+
+    def revive(self, chat_id: int):
+        """البوت رأى نشاطاً في المجموعة ← نرجعها للبث (بدون كتابة إن كانت سليمة أصلاً)."""
+        info = self._unhealthy.get(chat_id)
+        if info and info[0] != "migrated":
+            self._save(chat_id, "live", 0, None)
+
+    def resolve(self, chat_id: int) -> int:
+        """تتبع سلسلة التحويل إلى supergroup حتى الرقم الحالي."""
+        seen = set()
+        while chat_id not in seen:
+            info = self._unhealthy.get(chat_id)
+            if not info or info[0] != "migrated" or not info[2]:
+                break
+            seen.add(chat_id)
+            chat_id = info[2]
+        return chat_id
+
+    def filter_targets(self, targets) -> list:
+        """استبدال الأرقام المحولة + استبعاد dead + استبعاد demoted حتى موعد التجربة التالية."""
+        probe_before = datetime.now(timezone.utc).timestamp() - BROADCAST_TARGET_PROBE_HOURS * 3600
+        live = {}
+        for chat_id in targets:
+            chat_id = self.resolve(int(chat_id))
+            info = self._unhealthy.get(chat_id)
+            if info and (info[0] == "dead" or (info[0] == "demoted" and info[3] > probe_before)):
+                continue
+            live[chat_id] = None
+        return list(live)
+
+    def counts(self) -> dict:
+        counts = {}
+        for status, *_ in self._unhealthy.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+BROADCAST_TARGETS = BroadcastTargetHealth(BROADCAST_JOBS_DB_PATH)
+
+
+
+def format_broadcast_progress(job_id: int, counts: dict) -> str:
+    total = sum(counts.values())
+    done = total - counts.get("pending", 0) - counts.get("sending", 0)
+    lines = [f"📡 مهمة البث #{job_id}: {done}/{total}"]
+    lines.extend(f"{label}: {counts.get(status, 0)}" for status, label in BROADCAST_STATUS_LABELS.items())
+    return "\n".join(lines)
+
+
+async def _broadcast_to_chat(bot, chat_id: int, plan: BroadcastPlan, pin_enabled: bool) -> tuple:
+    """إرسال الخطة لمجموعة واحدة ← (الحالة، الخطأ) | ("migrated", الرقم الجديد) + تحديث صحة الهدف."""
+    try:
+        # تأكد أن البوت مشرف في المجموعة
+        member = await bot.get_chat_member(chat_id, bot.id)
+        if member.status not in ("administrator", "creator"):
+            await asyncio.to_thread(BROADCAST_TARGETS.record, chat_id, "skipped", f"member status: {member.status}")
+            return "skipped", None
+
+        sent_msg = await replay_broadcast_plan(bot, chat_id, plan)
+    except ChatMigrated as e:
+        # المجموعة تحولت إلى supergroup ← نحفظ الرقم الجديد ونرسل له بدلاً منها
+        logging.info(f"[RECO BROADCAST] 🔁 المجموعة {chat_id} تحولت إلى {e.new_chat_id}")
+        await asyncio.to_thread(BROADCAST_TARGETS.record, chat_id, "migrated", "migrated", e.new_chat_id)
+        info = BROADCAST_GROUPS.pop(chat_id, None)
+        if info is not None:
+            BROADCAST_GROUPS[e.new_chat_id] = info
+        return "migrated", e.new_chat_id
+    except Exception as e:
+        logging.warning(f"[RECO BROADCAST] فشل إرسال التوصية إلى {chat_id}: {e}")
+        error = str(e)[:200]
+        # Forbidden: البوت أُزيل أو حُظر | chat not found: المجموعة حُذفت ← لا نعيد المحاولة فيها
+        dead = isinstance(e, Forbidden) or (isinstance(e, BadRequest) and "chat not found" in str(e).lower())
+        await asyncio.to_thread(BROADCAST_TARGETS.record, chat_id, "dead" if dead else "failed", error)
+        return "failed", error
+
+    # 📌 تثبيت الرسالة إن كان الخيار مفعّل
+    if pin_enabled and sent_msg is not None:
+        try:
+            await bot.pin_chat_message(
+                chat_id=chat_id,
+                message_id=sent_msg.message_id,
+                disable_notification=True,
+            )
+        except BadRequest as e:
+            # غالباً لأن البوت لا يملك صلاحية التثبيت – نتجاهل بدون إيقاف البث
+            logging.warning(f"[RECO PIN] تعذر تثبيت الرسالة في {chat_id}: {e}")
+        except Exception as e:
+            logging.warning(f"[RECO PIN] خطأ غير متوقع أثناء التثبيت في {chat_id}: {e}")
+    return "sent", None
+
+
+async def _report_broadcast_progress(bot, job_id: int, spec: dict, text: str):
+    """تحديث رسالة التقدم عند المشرف الناشر (أو إرسال رسالة جديدة إن تعذر التعديل)."""
+    try:
+        if spec.get("progress_message_id"):
+            await bot.edit_message_text(text, chat_id=spec["admin_id"], message_id=spec["progress_message_id"])
+            return
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return
+        logging.warning(f"[RECO BROADCAST] تعذر تحديث رسالة التقدم للمهمة #{job_id}: {e}")
+    except Exception as e:
+        logging.warning(f"[RECO BROADCAST] تعذر تحديث رسالة التقدم للمهمة #{job_id}: {e}")
+    try:
+        msg = await bot.send_message(spec["admin_id"], text)
+        spec["progress_message_id"] = msg.message_id
+        await asyncio.to_thread(BROADCAST_JOBS.update_spec, job_id, spec)
+    except Exception as e:
+        logging.warning(f"[RECO BROADCAST] تعذر إرسال رسالة التقدم للمهمة #{job_id}: {e}")
+
+
+async def run_broadcast_job(job_id: int):
+    """تنفيذ (أو استئناف) مهمة بث: المجموعات المتبقية فقط ← ملخص + إشعار المشرفين."""
+    if job_id in BROADCAST_RUNNING:
+        return
+    BROADCAST_RUNNING.add(job_id)
+    try:
+        spec = await asyncio.to_thread(BROADCAST_JOBS.get, job_id)
+        if spec is None:
+            return
+        bot = application.bot
+        media_list = spec["media_list"]
+
+        # 🧩 خطة الإرسال تُبنى مرة واحدة لكل التوصية ثم تُعاد لكل مجموعة
+        fallback_photo = None
+        if not media_list:
+            try:
+                fallback_photo = await asyncio.to_thread(Path("GO-NOW.PNG").read_bytes)
+            except Exception as e:
+                logging.warning(f"[RECO BROADCAST] تعذر قراءة صورة GO-NOW.PNG: {e}")
+        plan = compile_broadcast(spec["text"] or "", media_list, fallback_photo)
+
+        pending = await asyncio.to_thread(BROADCAST_JOBS.pending, job_id)
+        # 📡 البث بأولوية أقل من ردود المستخدمين التفاعلية (محدد المعدل)
+        with outbound_priority(PRIORITY_BROADCAST):
+            for done, chat_id in enumerate(pending, 1):
+                if not await asyncio.to_thread(BROADCAST_JOBS.claim, job_id, chat_id):
+                    continue
+                status, error = await _broadcast_to_chat(bot, chat_id, plan, spec["pin_enabled"])
+                if status == "migrated":
+                    # نفس الصف ينتقل للرقم الجديد (إلا إن كان الرقم الجديد ضمن المهمة أصلاً)
+                    if not await asyncio.to_thread(BROADCAST_JOBS.migrate, job_id, chat_id, error):
+                        continue
+                    chat_id = error
+                    status, error = await _broadcast_to_chat(bot, chat_id, plan, spec["pin_enabled"])
+                    if status == "migrated":
+                        status, error = "failed", "migrated twice"
+                await asyncio.to_thread(BROADCAST_JOBS.mark, job_id, chat_id, status, error)
+                if done % BROADCAST_PROGRESS_EVERY == 0 and done < len(pending):
+                    counts = await asyncio.to_thread(BROADCAST_JOBS.progress, job_id)
+                    await _report_broadcast_progress(bot, job_id, spec, format_broadcast_progress(job_id, counts))
+
+        await asyncio.to_thread(BROADCAST_JOBS.finish, job_id)
+        await _finish_broadcast_job(bot, job_id, spec, plan)
+    except Exception as e:
+        logging.error(f"[RECO BROADCAST] ❌ توقفت مهمة البث #{job_id}: {e}")
+    finally:
+        BROADCAST_RUNNING.discard(job_id)
+
+
+async def _finish_broadcast_job(bot, job_id: int, spec: dict, plan: BroadcastPlan):
+    counts = await asyncio.to_thread(BROADCAST_JOBS.progress, job_id)
+    sent, skipped, failed = counts.get("sent", 0), counts.get("skipped", 0), counts.get("failed", 0)
+    pin_enabled = spec["pin_enabled"]
+    text = spec["text"]
+
+    # ملخص للمشرف الناشر
+    summary = (
+        "📡 تمت عملية بث التوصية الفنية.\n\n"
+        f"✅ تم الإرسال إلى: {sent} مجموعة\n"
+        f"⏭️ تم التخطي في: {skipped} مجموعة (البوت ليس مشرفاً)\n"
+        f"⚠️ فشل الإرسال في: {failed} مجموعة\n\n"
+        f"📌 خيار التثبيت كان: {'مفعّل' if pin_enabled else 'غير مفعّل'}"
+    )
+    await _report_broadcast_progress(bot, job_id, spec, summary)
+
+    # إشعار جميع المشرفين (بدون أرقام تعريفية)
+    admin_notification_caption = (
+        "📡 تمت عملية بث توصية فنية جديدة.\n\n"
+        f"👤 الناشر:\n`{spec['admin_name']}`\n\n"
+        f"👥 المجموعة التابعة له:\n`{spec['group_title']}`\n\n"
+        "📊 ملخص البث:\n"
+        f"✅ تم الإرسال إلى: `{sent}` مجموعة\n"
+        f"⏭️ تم التخطي في: `{skipped}` مجموعة (البوت ليس مشرفاً)\n"
+        f"⚠️ فشل الإرسال في: `{failed}` مجموعة\n"
+        f"📌 خيار التثبيت: `{'مفعّل' if pin_enabled else 'غير مفعّل'}`\n\n"
+        "📄 نص التوصية:\n"
+        f"{text or '— التوصية بدون نص (وسائط فقط) —'}"
+    )
+
+    # نستخدم وسيط واحد فقط لمعاينة المشرفين
+    notify_media = plan.preview_media
+
+    async def _send_to_admin(aid):
+        if notify_media:
+            mtype = notify_media.get("type")
+            fid = notify_media.get("file_id")
+            if mtype == "photo":
+                return await bot.send_photo(aid, fid, caption=admin_notification_caption)
+            elif mtype == "video":
+                return await bot.send_video(aid, fid, caption=admin_notification_caption)
+            elif mtype == "document":
+                return await bot.send_document(aid, fid, caption=admin_notification_caption)
+            elif mtype == "voice":
+                return await bot.send_voice(aid, fid, caption=admin_notification_caption)
+            return None
+        return await bot.send_message(aid, admin_notification_caption)
+
+    notify_admins(_send_to_admin, tag="RECO NOTIFY ADMIN")
+
+
+async def resume_broadcast_jobs_job(context: ContextTypes.DEFAULT_TYPE):
+    """استئناف مهام البث التي توقف نبضها (إعادة تشغيل أثناء البث)."""
+    if not is_primary_worker():
+        return
+    try:
+        for job_id in await asyncio.to_thread(BROADCAST_JOBS.stale, BROADCAST_JOB_STALE_SECONDS):
+            if job_id in BROADCAST_RUNNING:
+                continue
+            if await asyncio.to_thread(BROADCAST_JOBS.take_over, job_id, BROADCAST_JOB_STALE_SECONDS):
+                logging.info(f"[RECO BROADCAST] ♻️ استئناف مهمة البث #{job_id}")
+                spawn_background(run_broadcast_job(job_id), name=f"broadcast_job:{job_id}")
+    except Exception as e:
+        logging.error(f"[RECO BROADCAST] ❌ فشل فحص مهام البث المتوقفة: {e}")
+
 
 async def broadcast_recommendation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """بث التوصية على المجموعات (الكل أو المحدد فقط) + خيار تثبيت الرسالة + إشعار المشرفين"""
@@ -2202,14 +5294,14 @@ async def broadcast_recommendation(update: Update, context: ContextTypes.DEFAULT
         await query.answer("لا توجد توصية جاهزة للبث. يرجى إرسال التوصية أولاً.", show_alert=True)
         return
 
-    data = query.data or ""
+    scope = callback_args(context).get("scope")
     selected_ids = ud.get("reco_selected") or []
 
     # 🎯 تحديد المجموعات المستهدفة
-    if data == "reco_broadcast_all":
+    if scope == "all":
         # بث لجميع المجموعات المتاحة
         targets = collect_target_chat_ids(context)
-    elif data == "reco_broadcast":
+    elif scope == "selected":
         # بث للمجموعات المحددة فقط – منع لو ما فيه ولا مجموعة
         if not selected_ids:
             await query.answer(
@@ -2228,297 +5320,25 @@ async def broadcast_recommendation(update: Update, context: ContextTypes.DEFAULT
 
     await query.answer("📡 جاري بث التوصية على المجموعات...", show_alert=False)
 
-    # 🆕 تجهيز نص التوصية بصيغة HTML + رابط "اضغط هنا لعرض التفاصيل" إن وجد
-    raw_text = text or ""
-    url_match = None
-    if raw_text:
-        url_match = re.search(r"(https?://\S+)", raw_text)
-
-    html_body = ""
-    if raw_text:
-        if url_match:
-            url = url_match.group(1)
-            # إزالة الرابط الخام من النص الظاهر
-            cleaned = raw_text.replace(url, "").strip()
-            html_body = html.escape(cleaned)
-        else:
-            html_body = html.escape(raw_text)
-
-    # 🆕 إضافة تذييل ثابت في أسفل التوصية
-    footer = "فريق الصيانة والدعم الفني GO"
-    if html_body:
-        html_body += "\n\n" + html.escape(footer)
-    else:
-        html_body = html.escape(footer)
-
-    html_text = html_body
-    if url_match:
-        url = url_match.group(1).strip()
-        safe_url = html.escape(url, quote=True)
-        if html_text:
-            html_text += "\n\n"
-        html_text += f"🔗 <a href=\"{safe_url}\">اضغط هنا لعرض التفاصيل</a>"
-
-    sent = failed = skipped = 0
-
-    # ترتيب الأنواع للألبوم: فيديو ثم صورة ثم ملف
-    type_order = {"video": 0, "photo": 1, "document": 2}
-
-    for chat_id in targets:
-        try:
-            # تأكد أن البوت مشرف في المجموعة
-            member = await context.bot.get_chat_member(chat_id, context.bot.id)
-            if member.status not in ("administrator", "creator"):
-                skipped += 1
-                continue
-
-            sent_msg = None
-
-            if media_list:
-                try:
-                    # نفصل بين الوسائط الصوتية وغيرها
-                    non_voice_media = [m for m in media_list if m.get("type") != "voice"]
-                    voice_media = [m for m in media_list if m.get("type") == "voice"]
-
-                    # 🧩 حالة وجود وسائط غير صوتية وصوت معاً
-                    if non_voice_media and voice_media:
-                        # 🔢 ترتيب غير الصوتية: فيديو → صور → مستندات
-                        non_voice_media = sorted(
-                            non_voice_media,
-                            key=lambda m: type_order.get(m.get("type"), 3)
-                        )
-
-                        album = []
-                        for m in non_voice_media:
-                            mtype = m.get("type")
-                            fid = m.get("file_id")
-                            if not mtype or not fid:
-                                continue
-
-                            if mtype == "photo":
-                                album.append(InputMediaPhoto(media=fid))
-                            elif mtype == "video":
-                                album.append(InputMediaVideo(media=fid))
-                            elif mtype == "document":
-                                album.append(InputMediaDocument(media=fid))
-
-                        album_msgs = []
-                        if album:
-                            # 🖼️ كل الوسائط غير الصوتية برسالة واحدة (ألبوم) بدون كابتشن
-                            album_msgs = await context.bot.send_media_group(chat_id, album)
-
-                        # 🎧 نرسل أول ملف صوتي مع نص التوصية الكامل + التذييل
-                        main_voice = voice_media[0]
-                        extra_voices = voice_media[1:]
-                        voice_msg = None
-                        vf = main_voice.get("file_id")
-                        if vf:
-                            voice_msg = await context.bot.send_voice(
-                                chat_id,
-                                vf,
-                                caption=html_text or "",
-                                parse_mode=constants.ParseMode.HTML,
-                            )
-
-                        # أي أصوات إضافية بدون كابتشن
-                        for v in extra_voices:
-                            try:
-                                vf2 = v.get("file_id")
-                                if vf2:
-                                    await context.bot.send_voice(chat_id, vf2)
-                            except Exception as e2:
-                                logging.warning(f"[RECO BROADCAST] فشل إرسال voice إضافي إلى {chat_id}: {e2}")
-
-                        # الرسالة التي يمكن تثبيتها: نفضّل رسالة الصوت + النص
-                        sent_msg = voice_msg or (album_msgs[0] if album_msgs else None)
-
-                    # 🧩 حالة وجود وسائط غير صوتية فقط (بدون صوت)
-                    elif non_voice_media and not voice_media:
-                        non_voice_media = sorted(
-                            non_voice_media,
-                            key=lambda m: type_order.get(m.get("type"), 3)
-                        )
-
-                        album = []
-                        for idx, m in enumerate(non_voice_media):
-                            mtype = m.get("type")
-                            fid = m.get("file_id")
-                            if not mtype or not fid:
-                                continue
-
-                            # أول وسيط فقط نضع معه الكابتشن (النص + التذييل + الرابط)
-                            if mtype == "photo":
-                                if idx == 0:
-                                    album.append(
-                                        InputMediaPhoto(
-                                            media=fid,
-                                            caption=html_text or "",
-                                            parse_mode=constants.ParseMode.HTML,
-                                        )
-                                    )
-                                else:
-                                    album.append(InputMediaPhoto(media=fid))
-                            elif mtype == "video":
-                                if idx == 0:
-                                    album.append(
-                                        InputMediaVideo(
-                                            media=fid,
-                                            caption=html_text or "",
-                                            parse_mode=constants.ParseMode.HTML,
-                                        )
-                                    )
-                                else:
-                                    album.append(InputMediaVideo(media=fid))
-                            elif mtype == "document":
-                                if idx == 0:
-                                    album.append(
-                                        InputMediaDocument(
-                                            media=fid,
-                                            caption=html_text or "",
-                                            parse_mode=constants.ParseMode.HTML,
-                                        )
-                                    )
-                                else:
-                                    album.append(InputMediaDocument(media=fid))
-
-                        album_msgs = []
-                        if album:
-                            album_msgs = await context.bot.send_media_group(chat_id, album)
-
-                        sent_msg = album_msgs[0] if album_msgs else None
-
-                    # 🧩 حالة الصوت فقط بدون أي وسائط أخرى
-                    elif voice_media and not non_voice_media:
-                        main_voice = voice_media[0]
-                        extra_voices = voice_media[1:]
-
-                        first_voice_msg = None
-                        fid = main_voice.get("file_id")
-                        if fid:
-                            first_voice_msg = await context.bot.send_voice(
-                                chat_id,
-                                fid,
-                                caption=html_text or "",
-                                parse_mode=constants.ParseMode.HTML,
-                            )
-
-                        for v in extra_voices:
-                            try:
-                                vf = v.get("file_id")
-                                if vf:
-                                    await context.bot.send_voice(chat_id, vf)
-                            except Exception as e2:
-                                logging.warning(f"[RECO BROADCAST] فشل إرسال voice إضافي إلى {chat_id}: {e2}")
-
-                        sent_msg = first_voice_msg
-
-                except Exception as e:
-                    logging.warning(f"[RECO BROADCAST] خطأ أثناء إرسال الوسائط المتعددة إلى {chat_id}: {e}")
-                    # في حالة أي خطأ نرجع للخطة البسيطة: نص فقط
-                    sent_msg = await context.bot.send_message(
-                        chat_id,
-                        html_text or "",
-                        parse_mode=constants.ParseMode.HTML,
-                        disable_web_page_preview=True,
-                    )
-            else:
-                # 🆕 لا توجد وسائط → نحاول إرسال صورة GO-NOW.PNG مع نفس النص
-                try:
-                    with open("GO-NOW.PNG", "rb") as f:
-                        sent_msg = await context.bot.send_photo(
-                            chat_id,
-                            f,
-                            caption=html_text or "",
-                            parse_mode=constants.ParseMode.HTML,
-                        )
-                except Exception as e:
-                    logging.warning(f"[RECO BROADCAST] تعذر إرسال صورة GO-NOW.PNG إلى {chat_id}: {e}")
-                    # في حال فشل تحميل الصورة نرجع لإرسال التوصية كنص HTML فقط
-                    sent_msg = await context.bot.send_message(
-                        chat_id,
-                        html_text or "",
-                        parse_mode=constants.ParseMode.HTML,
-                        disable_web_page_preview=True,
-                    )
-
-            # 📌 تثبيت الرسالة إن كان الخيار مفعّل
-            if pin_enabled and sent_msg is not None:
-                try:
-                    await context.bot.pin_chat_message(
-                        chat_id=chat_id,
-                        message_id=sent_msg.message_id,
-                        disable_notification=True,
-                    )
-                except BadRequest as e:
-                    # غالباً لأن البوت لا يملك صلاحية التثبيت – نتجاهل بدون إيقاف البث
-                    logging.warning(f"[RECO PIN] تعذر تثبيت الرسالة في {chat_id}: {e}")
-                except Exception as e:
-                    logging.warning(f"[RECO PIN] خطأ غير متوقع أثناء التثبيت في {chat_id}: {e}")
-
-            sent += 1
-        except Exception as e:
-            logging.warning(f"[RECO BROADCAST] فشل إرسال التوصية إلى {chat_id}: {e}")
-            failed += 1
-
-    # ملخص للمشرف الناشر
-    summary = (
-        "📡 تمت عملية بث التوصية الفنية.\n\n"
-        f"✅ تم الإرسال إلى: {sent} مجموعة\n"
-        f"⏭️ تم التخطي في: {skipped} مجموعة (البوت ليس مشرفاً)\n"
-        f"⚠️ فشل الإرسال في: {failed} مجموعة\n\n"
-        f"📌 خيار التثبيت كان: {'مفعّل' if pin_enabled else 'غير مفعّل'}"
-    )
+    # 🗂️ البث مهمة محفوظة: تستمر بعد إعادة التشغيل ولا تكرر النشر في نفس المجموعة
+    spec = {
+        "text": text,
+        "media_list": media_list,
+        "pin_enabled": pin_enabled,
+        "admin_id": admin_id,
+        "admin_name": admin_name,
+        "group_title": ud.get("group_title", "—"),
+    }
+    job_id = await asyncio.to_thread(BROADCAST_JOBS.create, spec, targets)
     try:
-        await query.message.reply_text(summary)
+        progress_msg = await query.message.reply_text(
+            format_broadcast_progress(job_id, {"pending": len(set(targets))})
+        )
+        spec["progress_message_id"] = progress_msg.message_id
+        await asyncio.to_thread(BROADCAST_JOBS.update_spec, job_id, spec)
     except Exception:
         pass
-
-    # إشعار جميع المشرفين (بدون أرقام تعريفية)
-    group_title = ud.get("group_title", "—")
-
-    admin_notification_caption = (
-        "📡 تمت عملية بث توصية فنية جديدة.\n\n"
-        f"👤 الناشر:\n`{admin_name}`\n\n"
-        f"👥 المجموعة التابعة له:\n`{group_title}`\n\n"
-        "📊 ملخص البث:\n"
-        f"✅ تم الإرسال إلى: `{sent}` مجموعة\n"
-        f"⏭️ تم التخطي في: `{skipped}` مجموعة (البوت ليس مشرفاً)\n"
-        f"⚠️ فشل الإرسال في: `{failed}` مجموعة\n"
-        f"📌 خيار التثبيت: `{'مفعّل' if pin_enabled else 'غير مفعّل'}`\n\n"
-        "📄 نص التوصية:\n"
-        f"{text or '— التوصية بدون نص (وسائط فقط) —'}"
-    )
-
-    # نستخدم وسيط واحد فقط لمعاينة المشرفين
-    notify_media = None
-    non_voice_media = [m for m in media_list if m.get("type") != "voice"]
-    voice_media = [m for m in media_list if m.get("type") == "voice"]
-    if non_voice_media:
-        non_voice_media = sorted(
-            non_voice_media,
-            key=lambda m: type_order.get(m.get("type"), 3)
-        )
-        notify_media = non_voice_media[0]
-    elif voice_media:
-        notify_media = voice_media[0]
-
-    for aid in AUTHORIZED_USERS:
-        try:
-            if notify_media:
-                mtype = notify_media.get("type")
-                fid = notify_media.get("file_id")
-                if mtype == "photo":
-                    await context.bot.send_photo(aid, fid, caption=admin_notification_caption)
-                elif mtype == "video":
-                    await context.bot.send_video(aid, fid, caption=admin_notification_caption)
-                elif mtype == "document":
-                    await context.bot.send_document(aid, fid, caption=admin_notification_caption)
-                elif mtype == "voice":
-                    await context.bot.send_voice(aid, fid, caption=admin_notification_caption)
-            else:
-                await context.bot.send_message(aid, admin_notification_caption)
-        except Exception as e:
-            logging.warning(f"[RECO NOTIFY ADMIN] فشل إشعار المشرف {aid}: {e}")
+    spawn_background(run_broadcast_job(job_id), name=f"broadcast_job:{job_id}")
 
     # 🧹 تنظيف بيانات التوصية من user_data بعد الانتهاء
     ud.pop("reco_text", None)
@@ -2623,13 +5443,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             df_admins = df_admins[df_admins["manager_id"].astype(int) != target_id]
-            if target_id in AUTHORIZED_USERS:
-                AUTHORIZED_USERS.remove(target_id)
+            AUTHORIZED_USERS.discard(target_id)
 
-            # قفل الكتابة على ملف الإكسل قبل تعديل شيت managers
-            async with EXCEL_LOCK:
-                with pd.ExcelWriter("bot_data.xlsx", engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
-                    df_admins.to_excel(writer, sheet_name="managers", index=False)
+            # حذف صف المشرف من شيت managers عبر كاتب الملف
+            await excel_write([("delete", "managers", "manager_id", target_id)])
 
             await message.reply_text(f"🗑️ تم حذف المشرف بنجاح:\n<code>{target_id}</code>", parse_mode="HTML")
         except Exception as e:
@@ -2649,12 +5466,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await message.reply_text("ℹ️ هذا المشرف موجود مسبقًا.")
                 return
 
-            AUTHORIZED_USERS.append(new_admin_id)
+            AUTHORIZED_USERS.add(new_admin_id)
             df_admins = pd.concat([df_admins, pd.DataFrame([{"manager_id": new_admin_id}])], ignore_index=True)
-            # قفل الكتابة على ملف الإكسل قبل تعديل شيت managers
-            async with EXCEL_LOCK:
-                with pd.ExcelWriter("bot_data.xlsx", engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
-                    df_admins.to_excel(writer, sheet_name="managers", index=False)
+            # إضافة صف المشرف إلى شيت managers عبر كاتب الملف
+            await excel_write([("upsert", "managers", "manager_id", {"manager_id": new_admin_id})])
 
             await message.reply_text(f"✅ تم إضافة المشرف:\n<code>{new_admin_id}</code>", parse_mode="HTML")
         except Exception as e:
@@ -2705,10 +5520,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             suggestion_id = await start_suggestion_session(actual_user_id, context)
 
         # ✅ منع KeyError
-        record = suggestion_records.get(actual_user_id, {}).get(suggestion_id)
+        record = await asyncio.to_thread(TICKETS.get, actual_user_id, suggestion_id)
         if not record:
             suggestion_id = await start_suggestion_session(actual_user_id, context)
-            record = suggestion_records[actual_user_id][suggestion_id]
+            record = await asyncio.to_thread(TICKETS.get, actual_user_id, suggestion_id)
 
         if not context.user_data[actual_user_id].get("compose_text") and not context.user_data[actual_user_id].get("compose_media"):
             record["text"] = ""
@@ -2776,7 +5591,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # ✅ منع KeyError
-        record = suggestion_records.get(actual_user_id, {}).get(suggestion_id)
+        record = await asyncio.to_thread(TICKETS.get, actual_user_id, suggestion_id)
         if not record:
             await message.reply_text("⚠️ التذكرة غير موجودة أو تم تنظيفها. افتح التذكرة مجددًا من القائمة.")
             return
@@ -2955,17 +5770,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard_rows = []
 
         # ✅ زر "عرض القطع المصنفة" يفتح تصنيفات القطع لنفس الفئة المختارة
-        safe_car = str(selected_car).replace(" ", "_")
+        safe_car = str(selected_car)
         keyboard_rows.append(
-            [InlineKeyboardButton("🗂 عرض القطع المصنفة", callback_data=f"showparts_{safe_car}_{user_id}")]
+            [InlineKeyboardButton("🗂 عرض القطع المصنفة", callback_data=f"showparts_{cb_ref(safe_car)}_{user_id}")]
         )
 
         parts_brand = context.user_data[user_id].get("parts_brand")
 
         if parts_brand:
-            safe_brand = parts_brand.replace(" ", "_")
+            safe_brand = parts_brand
             keyboard_rows.append(
-                [InlineKeyboardButton("⬅️ رجوع لاختيار سيارة", callback_data=f"pbrand_{safe_brand}_{user_id}")]
+                [InlineKeyboardButton("⬅️ رجوع لاختيار سيارة", callback_data=f"pbrand_{cb_ref(safe_brand)}_{user_id}")]
             )
 
         keyboard_rows.append(
@@ -2984,12 +5799,12 @@ async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
 
-    data = query.data or ""
+    kind = callback_args(context).get("kind")
     mode = context.user_data.get(user_id, {}).get("compose_mode")
 
     # ✅ إلغاء استفسار المستخدم (cancel_suggestion)
-    if data == "cancel_suggestion":
-        suggestion_records.pop(user_id, None)
+    if kind == "suggestion":
+        await asyncio.to_thread(TICKETS.discard_drafts, user_id)
         context.user_data.setdefault(user_id, {})
         context.user_data[user_id].clear()
 
@@ -3000,7 +5815,7 @@ async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
     # ✅ إلغاء رد المشرف (cancel_custom_reply)
-    elif data == "cancel_custom_reply":
+    elif kind == "custom_reply":
         admin_id = user_id
         admin_state = context.user_data.get(admin_id, {}) or {}
         target_user_id = admin_state.get("custom_reply_for")
@@ -3008,10 +5823,10 @@ async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # ✅ فك القفل إن كانت التذكرة موجودة
         if target_user_id and suggestion_id:
-            record = suggestion_records.get(target_user_id, {}).get(suggestion_id)
+            record = await asyncio.to_thread(TICKETS.get, target_user_id, suggestion_id)
             if record:
                 try:
-                    unlock_ticket(record)
+                    await unlock_ticket(record, admin_id)
                 except Exception:
                     pass
 
@@ -3028,7 +5843,7 @@ async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ✅ إذا ضغط إلغاء عام أثناء suggestion (متوافق مع كودك القديم)
     elif mode == "suggestion":
-        suggestion_records.pop(user_id, None)
+        await asyncio.to_thread(TICKETS.discard_drafts, user_id)
         context.user_data.setdefault(user_id, {})
         context.user_data[user_id].clear()
 
@@ -3050,8 +5865,7 @@ async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
 async def show_manual_car_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data.split("_")
-    user_id = int(data[1])
+    user_id = callback_args(context)["user_id"]
 
     await log_event(update, "📘 فتح قائمة دليل المالك")
 
@@ -3083,9 +5897,9 @@ async def show_manual_car_list(update: Update, context: ContextTypes.DEFAULT_TYP
     if brands:
         keyboard = []
         for brand in brands:
-            safe_brand = brand.replace(" ", "_")
+            safe_brand = brand
             keyboard.append(
-                [InlineKeyboardButton(brand, callback_data=f"mnlbrand_{safe_brand}_{user_id}")]
+                [InlineKeyboardButton(brand, callback_data=f"mnlbrand_{cb_ref(safe_brand)}_{user_id}")]
             )
 
         keyboard.append(
@@ -3137,7 +5951,7 @@ async def show_manual_car_list(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     keyboard = [
-        [InlineKeyboardButton(car, callback_data=f"manualcar_{car.replace(' ', '_')}_{user_id}")]
+        [InlineKeyboardButton(car, callback_data=f"manualcar_{cb_ref(car)}_{user_id}")]
         for car in car_names
     ]
 
@@ -3184,19 +5998,9 @@ async def manual_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE
     mnlbrand_<BRAND>_<USER_ID>
     """
     query = update.callback_query
-    data = (query.data or "").split("_")
-    if len(data) < 3:
-        await query.answer("❌ بيانات غير صالحة.", show_alert=True)
-        return
-
-    try:
-        user_id = int(data[-1])
-    except ValueError:
-        await query.answer("❌ رقم مستخدم غير صحيح.", show_alert=True)
-        return
-
-    # البراند قد يحتوي مسافات → نجمع ما بين mnlbrand و user_id
-    brand = "_".join(data[1:-1]).replace("_", " ").strip()
+    args = callback_args(context)
+    user_id = args["user_id"]
+    brand = args["brand"].strip()
 
     # نحفظ البراند في user_data لاستخدامه لاحقاً (مثلاً مع زر "اختيار سيارة اخرى")
     context.user_data.setdefault(user_id, {})
@@ -3270,7 +6074,7 @@ async def manual_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE
         [
             InlineKeyboardButton(
                 car,
-                callback_data=f"manualcar_{car.replace(' ', '_')}_{user_id}",
+                callback_data=f"manualcar_{cb_ref(car)}_{user_id}",
             )
         ]
         for car in car_names
@@ -3318,9 +6122,9 @@ async def manual_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def handle_manualcar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    parts = query.data.split("_")
-    user_id_from_callback = int(parts[-1])
-    car_name = " ".join(parts[1:-1])
+    args = callback_args(context)
+    user_id_from_callback = args["user_id"]
+    car_name = args["car"]
     user_name = query.from_user.full_name
 
     try:
@@ -3343,8 +6147,8 @@ async def handle_manualcar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # ✅ زر "اختيار سيارة اخرى" يرجع لقائمة سيارات نفس البراند إن وُجد
     if brand:
-        brand_slug = str(brand).strip().replace(" ", "_")
-        other_car_cb = f"mnlbrand_{brand_slug}_{user_id_from_callback}"
+        brand_slug = str(brand).strip()
+        other_car_cb = f"mnlbrand_{cb_ref(brand_slug)}_{user_id_from_callback}"
     else:
         # احتياطاً يرجع لقائمة البراندات
         other_car_cb = f"manual_{user_id_from_callback}"
@@ -3412,20 +6216,10 @@ async def handle_manualcar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_manualdfcar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data or ""
-    parts = data.split("_")
-
-    # شكل الكولباك: manualpdf_رقمصف_رقممستخدم
-    if len(parts) < 3:
-        await query.answer("⚠️ بيانات غير صالحة.", show_alert=True)
-        return
-
-    try:
-        index = int(parts[1])
-        user_id = int(parts[2])
-    except ValueError:
-        await query.answer("⚠️ بيانات غير صالحة.", show_alert=True)
-        return
+    # شكل الكولباك: openpdf_رقمصف_رقممستخدم
+    args = callback_args(context)
+    index = args["index"]
+    user_id = args["user_id"]
 
     try:
         row = df_manual.iloc[index]
@@ -3444,8 +6238,8 @@ async def handle_manualdfcar(update: Update, context: ContextTypes.DEFAULT_TYPE)
     brand = user_data.get("manual_brand")
     if brand:
         # يرجع لقائمة سيارات نفس البراند
-        brand_slug = str(brand).replace(" ", "_")
-        other_car_cb = f"mnlbrand_{brand_slug}_{user_id}"
+        brand_slug = str(brand)
+        other_car_cb = f"mnlbrand_{cb_ref(brand_slug)}_{user_id}"
     else:
         # احتياطاً: يرجع لقائمة البراندات
         other_car_cb = f"manual_{user_id}"
@@ -3528,9 +6322,9 @@ def get_manual_caption(user_name: str, car_name: str) -> str:
 
 async def select_car_for_parts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data.split("_")
-    user_id = int(data[-1])
-    car = " ".join(data[1:-1])
+    args = callback_args(context)
+    user_id = args["user_id"]
+    car = args["car"].strip()
 
     context.user_data.setdefault(user_id, {})
     context.user_data[user_id]["selected_car"] = car
@@ -3553,16 +6347,16 @@ async def select_car_for_parts(update: Update, context: ContextTypes.DEFAULT_TYP
     }
 
     keyboard = [
-        [InlineKeyboardButton(name, callback_data=f"catpart_{keyword}_{user_id}")]
+        [InlineKeyboardButton(name, callback_data=f"catpart_{cb_ref(keyword)}_{user_id}")]
         for name, keyword in part_categories.items()
     ]
 
     # 🔙 زر رجوع لاختيار سيارة أخرى من نفس البراند (إن وجد براند)
     parts_brand = context.user_data[user_id].get("parts_brand")
     if parts_brand:
-        safe_brand = parts_brand.replace(" ", "_")
+        safe_brand = parts_brand
         keyboard.append(
-            [InlineKeyboardButton("⬅️ رجوع لاختيار سيارة اخرى", callback_data=f"pbrand_{safe_brand}_{user_id}")]
+            [InlineKeyboardButton("⬅️ رجوع لاختيار سيارة اخرى", callback_data=f"pbrand_{cb_ref(safe_brand)}_{user_id}")]
         )
 
     # 🔙 زر رجوع للقائمة الرئيسية
@@ -3608,19 +6402,10 @@ async def send_part_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     - ⬅️ رجوع للقائمة الرئيسية
     """
     query = update.callback_query
-    data = (query.data or "").split("_")
-
-    # نتوقع: partimg_<index>_<user_id>
-    if len(data) < 4:
-        await query.answer("❌ بيانات غير صالحة.", show_alert=True)
-        return
-
-    try:
-        index = int(data[2])
-        user_id = int(data[3])
-    except ValueError:
-        await query.answer("❌ بيانات غير صالحة.", show_alert=True)
-        return
+    # شكل الكولباك: part_image_<index>_<user_id>
+    args = callback_args(context)
+    index = args["index"]
+    user_id = args["user_id"]
 
     # علامة أن هذه الصورة انفتحت (لو حاب تستخدمها لاحقاً)
     context.user_data.setdefault(user_id, {})[f"image_opened_{index}"] = True
@@ -3658,11 +6443,11 @@ async def send_part_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1) رجوع لقائمة التصنيفات لنفس السيارة (لو محددة)
     safe_car = None
     if selected_car not in (None, "", "غير معروف"):
-        safe_car = str(selected_car).replace(" ", "_")
+        safe_car = str(selected_car)
         buttons.append([
             InlineKeyboardButton(
                 "🗂 رجوع لقائمة تصنيفات القطع",
-                callback_data=f"showparts_{safe_car}_{user_id}"
+                callback_data=f"showparts_{cb_ref(safe_car)}_{user_id}"
             )
         ])
 
@@ -3670,11 +6455,11 @@ async def send_part_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # نحاول أولاً نرجع لنفس البراند لو محفوظ، وإلا نفتح قائمة قطع الغيار من جديد
     parts_brand = user_data.get("parts_brand")
     if parts_brand:
-        safe_brand = str(parts_brand).replace(" ", "_")
+        safe_brand = str(parts_brand)
         buttons.append([
             InlineKeyboardButton(
                 "🚗 اختيار سيارة أخرى",
-                callback_data=f"pbrand_{safe_brand}_{user_id}"
+                callback_data=f"pbrand_{cb_ref(safe_brand)}_{user_id}"
             )
         ])
     else:
@@ -3696,9 +6481,10 @@ async def send_part_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     reply_markup = InlineKeyboardMarkup(buttons)
 
-    msg = await context.bot.send_photo(
-        chat_id=query.message.chat_id,
-        photo=row.get("Image"),
+    msg = await send_cached_photo(
+        context.bot,
+        query.message.chat_id,
+        row.get("Image"),
         caption=caption,
         parse_mode=constants.ParseMode.MARKDOWN,
         reply_markup=reply_markup,
@@ -3708,11 +6494,11 @@ async def send_part_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
 async def car_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data.split("_")
-    user_id = int(data[-1])
+    args = callback_args(context)
+    user_id = args["user_id"]
 
     # اسم السيارة من الكول باك
-    car = "_".join(data[1:-1]).replace("_", " ")
+    car = args["car"]
 
     # حفظ نوع السيارة في جلسة المستخدم
     user_data = context.user_data.setdefault(user_id, {})
@@ -3735,9 +6521,9 @@ async def car_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # (اختياري) رجوع لقائمة سيارات نفس البراند إن كان محفوظاً
     brand = user_data.get("brand")
     if brand:
-        safe_brand = str(brand).replace(" ", "_")
+        safe_brand = str(brand)
         keyboard.append(
-            [InlineKeyboardButton("⬅️ رجوع لقائمة السيارات", callback_data=f"mbrand_{safe_brand}_{user_id}")]
+            [InlineKeyboardButton("⬅️ رجوع لقائمة السيارات", callback_data=f"mbrand_{cb_ref(safe_brand)}_{user_id}")]
         )
 
     # زر رجوع للقائمة الرئيسية
@@ -3767,21 +6553,30 @@ async def car_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await log_event(update, f"اختار {car} من قائمة السيارات")
 
 
+def _render_maintenance_body(row, car, km_value) -> str:
+    maintenance_action = str(row.get("maintenance_action", "")).strip()
+
+    # 🧩 حالة الطراز قيد التجهيز
+    if PLACEHOLDER_TEXT in maintenance_action:
+        return (
+            f"🚗 *نوع السيارة:* {car}\n"
+            f"📏 *المسافة:* {km_value} كم\n\n"
+            f"📌 {PLACEHOLDER_TEXT}"
+        )
+
+    # ✳️ الحالة العادية: عرض الإجراءات الفعلية من الإكسل
+    return (
+        f"🚗 *نوع السيارة:* {car}\n"
+        f"📏 *المسافة:* {km_value}\n"
+        f"🛠️ *الإجراءات:* _{maintenance_action}_"
+    )
+
 async def km_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data.split("_")
-
     # شكل الكول باك: km_<km>_<user_id>
-    if len(data) < 3:
-        await query.answer("❌ استعلام غير صالح.", show_alert=True)
-        return
-
-    km_value = data[1]
-    try:
-        user_id = int(data[2])
-    except ValueError:
-        await query.answer("❌ استعلام غير صالح.", show_alert=True)
-        return
+    args = callback_args(context)
+    km_value = args["km"]
+    user_id = args["user_id"]
 
     # 🔐 حماية الاستعلام ليبقى خاص بصاحبه
     if query.from_user.id != user_id:
@@ -3812,47 +6607,43 @@ async def km_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
     delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
     header = f"`🧑‍💻 استعلام خاص بـ {user_name}`\n\n"
+    footer = f"\n\n`⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)`"
+
+    multiple = len(results) > 1
+    entries = []
+    for n, (i, row) in enumerate(results.iterrows(), start=1):
+        text = cached_body("maintenance", df_maintenance, i, lambda: _render_maintenance_body(row, car, km_value))
+
+        # عند وجود أكثر من نتيجة نرقم الأزرار لتعرف لأي نتيجة تتبع
+        suffix = f" ({n})" if multiple else ""
+        if multiple:
+            text = f"*{n})*\n{text}"
+        entries.append({
+            "text": text,
+            "buttons": [
+                (f"عرض تكلفة الصيانة 💰{suffix}", f"cost_{i}_{user_id}"),
+                (f"عرض ملف الصيانة 📂{suffix}", f"brochure_{i}_{user_id}"),
+            ],
+        })
 
-    for i, row in results.iterrows():
-        maintenance_action = str(row.get("maintenance_action", "")).strip()
-
-        # 🧩 حالة الطراز قيد التجهيز
-        if PLACEHOLDER_TEXT in maintenance_action:
-            text = (
-                f"{header}"
-                f"🚗 *نوع السيارة:* {car}\n"
-                f"📏 *المسافة:* {km_value} كم\n\n"
-                f"📌 {PLACEHOLDER_TEXT}\n\n"
-                f"`⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)`"
-            )
-        else:
-            # ✳️ الحالة العادية: عرض الإجراءات الفعلية من الإكسل
-            text = (
-                f"{header}"
-                f"🚗 *نوع السيارة:* {car}\n"
-                f"📏 *المسافة:* {km_value}\n"
-                f"🛠️ *الإجراءات:* _{maintenance_action}_\n\n"
-                f"`⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)`"
-            )
-
-        safe_car = str(car).replace(" ", "_")
-
-        keyboard = [
-            [InlineKeyboardButton("عرض تكلفة الصيانة 💰", callback_data=f"cost_{i}_{user_id}")],
-            [InlineKeyboardButton("عرض ملف الصيانة 📂", callback_data=f"brochure_{i}_{user_id}")],
-            # رجوع لقائمة مسافات الصيانة لنفس السيارة
-            [InlineKeyboardButton("⬅️ رجوع لقائمة مسافات الصيانة", callback_data=f"car_{safe_car}_{user_id}")],
-            # رجوع للقائمة الرئيسية
-            [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-        ]
-
+    safe_car = str(car)
+    extra_rows = [
+        # رجوع لقائمة مسافات الصيانة لنفس السيارة
+        [("⬅️ رجوع لقائمة مسافات الصيانة", f"car_{cb_ref(safe_car)}_{user_id}")],
+        # رجوع للقائمة الرئيسية
+        [("⬅️ رجوع للقائمة الرئيسية", f"back_main_{user_id}")],
+    ]
 
-        msg = await query.message.reply_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=constants.ParseMode.MARKDOWN
-        )
-        register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await send_paginated_results(
+        context,
+        query.message.chat_id,
+        user_id,
+        entries,
+        header=header,
+        footer=footer,
+        parse_mode=constants.ParseMode.MARKDOWN,
+        extra_rows=extra_rows,
+    )
 
     await log_event(update, f"اختار {car} على مسافة {km_value} كم")
 
@@ -3871,7 +6662,8 @@ async def km_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def send_cost(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    index, user_id = int(query.data.split("_")[1]), int(query.data.split("_")[2])
+    args = callback_args(context)
+    index, user_id = args["index"], args["user_id"]
 
     # 🔐 حماية الاستعلام
     if query.from_user.id != user_id:
@@ -3971,13 +6763,13 @@ async def send_cost(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         pass
 
-    safe_car = str(car_type).replace(" ", "_")
+    safe_car = str(car_type)
 
     # 🔙 أزرار الرسالة الجديدة لتكلفة الصيانة:
     back_keyboard = InlineKeyboardMarkup(
         [
             [InlineKeyboardButton("📄 عرض ملف الصيانة", callback_data=f"brochure_{index}_{user_id}")],
-            [InlineKeyboardButton("⬅️ رجوع لقائمة مسافات الصيانة", callback_data=f"car_{safe_car}_{user_id}")],
+            [InlineKeyboardButton("⬅️ رجوع لقائمة مسافات الصيانة", callback_data=f"car_{cb_ref(safe_car)}_{user_id}")],
             [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")],
         ]
     )
@@ -3999,17 +6791,43 @@ async def send_cost(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for k in ["km_value", "maintenance_results"]:
             user_data.pop(k, None)
             
+def _maintenance_cars_for_brand(brand: str) -> list:
+    return (
+        df_maintenance[
+            df_maintenance["brand"].astype(str).str.strip() == brand
+        ]["car_type"]
+        .dropna()
+        .astype(str)
+        .str.strip()
+        .unique()
+        .tolist()
+    )
+
+
+@keyboard_list("mcars")
+def _maintenance_cars_keyboard(context, user_id: int, brand: str):
+    rows = [
+        [InlineKeyboardButton(car, callback_data=f"car_{cb_ref(car)}_{user_id}")]
+        for car in _maintenance_cars_for_brand(brand)
+    ]
+    footer = [
+        # زر رجوع لاختيار براند آخر
+        [InlineKeyboardButton("⬅️ رجوع لاختيار براند آخر", callback_data=f"maintenance_{user_id}")],
+        # زر رجوع للقائمة الرئيسية
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")],
+    ]
+    return rows, footer
+
+
 async def maintenance_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     استقبال ضغط زر براند الصيانة:
     mbrand_<BRAND>_<USER_ID>
     """
     query = update.callback_query
-    data = query.data.split("_")
-    user_id = int(data[-1])
-
-    # قد يكون البراند فيه مسافات، نجمع ما بين mbrand و user_id
-    brand = "_".join(data[1:-1]).replace("_", " ").strip()
+    args = callback_args(context)
+    user_id = args["user_id"]
+    brand = args["brand"].strip()
 
     context.user_data.setdefault(user_id, {})
     context.user_data[user_id]["brand"] = brand
@@ -4019,16 +6837,7 @@ async def maintenance_brand_choice(update: Update, context: ContextTypes.DEFAULT
         return
 
     # استخراج السيارات لهذا البراند من شيت الصيانة
-    cars = (
-        df_maintenance[
-            df_maintenance["brand"].astype(str).str.strip() == brand
-        ]["car_type"]
-        .dropna()
-        .astype(str)
-        .str.strip()
-        .unique()
-        .tolist()
-    )
+    cars = _maintenance_cars_for_brand(brand)
 
     # لو ما في أي سيارة (يعني البراند كله مجرد صفوف تحضيرية)
     if not cars:
@@ -4053,52 +6862,53 @@ async def maintenance_brand_choice(update: Update, context: ContextTypes.DEFAULT
         await log_event(update, f"براند بدون سيارات فعلياً في الصيانة: {brand}")
         return
 
-    # ✅ لدينا سيارات لهذا البراند → نعرض القائمة
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                car,
-                callback_data=f"car_{car.replace(' ', '_')}_{user_id}"
-            )
-        ]
-        for car in cars
-    ]
-    # زر رجوع لاختيار براند آخر
-    keyboard.append(
-        [InlineKeyboardButton("⬅️ رجوع لاختيار براند آخر", callback_data=f"maintenance_{user_id}")]
-    )
-    # زر رجوع للقائمة الرئيسية
-    keyboard.append(
-        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-    )
-
+    # ✅ لدينا سيارات لهذا البراند → نعرض القائمة (بصفحات لو طالت)
     msg = await query.edit_message_text(
         f"🚗 اختر فئة السيارة ضمن {brand}:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=paged_keyboard(context, "mcars", user_id, brand),
     )
     register_message(user_id, msg.message_id, query.message.chat_id, context)
     await log_event(update, f"عرض سيارات الصيانة للبراند: {brand}")
 
 
+def _parts_cars_for_brand(brand: str) -> list:
+    brand_col = next((c for c in ["Brand", "brand", "BRAND", "البراند"] if c in df_parts.columns), None)
+    car_col = next((c for c in ["Station No", "car_name", "Car", "الفئة"] if c in df_parts.columns), None)
+    if not brand_col or not car_col:
+        return []
+    return (
+        df_parts.loc[df_parts[brand_col].astype(str).str.strip() == brand, car_col]
+        .dropna()
+        .astype(str)
+        .str.strip()
+        .drop_duplicates()
+        .tolist()
+    )
+
+
+@keyboard_list("pcars")
+def _parts_cars_keyboard(context, user_id: int, brand: str):
+    # مهم جداً: نستخدم showparts_ عشان يروح لـ select_car_for_parts
+    rows = [
+        [InlineKeyboardButton(car, callback_data=f"showparts_{cb_ref(str(car))}_{user_id}")]
+        for car in _parts_cars_for_brand(brand)
+    ]
+    footer = [
+        [InlineKeyboardButton("⬅️ رجوع لاختيار براند آخر", callback_data=f"consumable_{user_id}")],
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")],
+    ]
+    return rows, footer
+
+
 async def parts_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     استقبال ضغط زر براند قطع الغيار:
     pbrand_<BRAND>_<USER_ID>
     """
     query = update.callback_query
-    data = (query.data or "").split("_")
-    if len(data) < 3:
-        await query.answer("❌ بيانات غير صالحة.", show_alert=True)
-        return
-
-    try:
-        user_id = int(data[-1])
-    except ValueError:
-        await query.answer("❌ رقم مستخدم غير صحيح.", show_alert=True)
-        return
-
-    # البراند قد يحتوي مسافات → نجمع ما بين pbrand و user_id
-    brand = "_".join(data[1:-1]).replace("_", " ").strip()
+    args = callback_args(context)
+    user_id = args["user_id"]
+    brand = args["brand"].strip()
 
     context.user_data.setdefault(user_id, {})
     context.user_data[user_id]["parts_brand"] = brand
@@ -4129,16 +6939,7 @@ async def parts_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer("⚠️ لا توجد أعمدة فئات سيارات معرفة لهذا البراند.", show_alert=True)
         return
 
-    car_names = (
-        parts_df.loc[parts_df[brand_col].astype(str).str.strip() == brand, car_col]
-        .dropna()
-        .astype(str)
-        .str.strip()
-        .drop_duplicates()
-        .tolist()
-        if brand_col
-        else []
-    )
+    car_names = _parts_cars_for_brand(brand)
 
     now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
     delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
@@ -4180,22 +6981,7 @@ async def parts_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         register_message(user_id, msg.message_id, query.message.chat_id, context)
         return
 
-    # ✅ لدينا سيارات لهذا البراند → نعرضها
-    keyboard = []
-    for car in car_names:
-        safe_car = str(car).replace(" ", "_")
-        # مهم جداً: نستخدم showparts_ عشان يروح لـ select_car_for_parts
-        callback_data = f"showparts_{safe_car}_{user_id}"
-        keyboard.append([InlineKeyboardButton(car, callback_data=callback_data)])
-
-    # أزرار رجوع
-    keyboard.append(
-        [InlineKeyboardButton("⬅️ رجوع لاختيار براند آخر", callback_data=f"consumable_{user_id}")]
-    )
-    keyboard.append(
-        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-    )
-
+    # ✅ لدينا سيارات لهذا البراند → نعرضها (بصفحات لو طالت)
     text = (
         f"`🧑‍💻 استعلام خاص بـ {query.from_user.full_name}`\n\n"
         f"🔧 البراند المختار: {brand}\n\n"
@@ -4203,7 +6989,7 @@ async def parts_brand_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"`⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)`"
     )
 
-    markup = InlineKeyboardMarkup(keyboard)
+    markup = paged_keyboard(context, "pcars", user_id, brand)
 
     # 🔐 هنا نعالج مشكلة: There is no text in the message to edit
     try:
@@ -4234,17 +7020,12 @@ async def save_parts(df: pd.DataFrame):
     global df_parts
     df_parts = df.copy()
 
-    async with EXCEL_LOCK:
-        await asyncio.to_thread(
-            write_excel_background,
-            "bot_data.xlsx",
-            df_parts,
-            "parts"
-        )
+    await excel_write([("sheet", "parts", df_parts)])
 
 async def send_brochure(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    index, user_id = int(query.data.split("_")[1]), int(query.data.split("_")[2])
+    args = callback_args(context)
+    index, user_id = args["index"], args["user_id"]
 
     # 🔐 حماية الاستعلام ليبقى خاص بصاحبه
     if query.from_user.id != user_id:
@@ -4266,7 +7047,7 @@ async def send_brochure(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     header = f"`🧑‍💻 استعلام خاص بـ {user_name}`\n"
 
-    safe_car = str(car_type).replace(" ", "_")
+    safe_car = str(car_type)
 
     # 🔙 أزرار الرسالة الجديدة لملف الصيانة:
     # 1) عرض تكلفة الصيانة
@@ -4275,7 +7056,7 @@ async def send_brochure(update: Update, context: ContextTypes.DEFAULT_TYPE):
     back_keyboard = InlineKeyboardMarkup(
         [
             [InlineKeyboardButton("💰 عرض تكلفة الصيانة", callback_data=f"cost_{index}_{user_id}")],
-            [InlineKeyboardButton("⬅️ رجوع لقائمة مسافات الصيانة", callback_data=f"car_{safe_car}_{user_id}")],
+            [InlineKeyboardButton("⬅️ رجوع لقائمة مسافات الصيانة", callback_data=f"car_{cb_ref(safe_car)}_{user_id}")],
             [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")],
         ]
     )
@@ -4386,48 +7167,8 @@ async def handle_service_centers(update: Update, context: ContextTypes.DEFAULT_T
 
     await log_event(update, "عرض مراكز الخدمة الرسمية للمستخدم")
 
-async def handle_branch_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    data = query.data.split("_")
-    user_id = int(data[1])
-
-    # 🧹 حذف فيديو المواقع السابق إن وجد
-    map_msg_id = context.user_data.get(user_id, {}).get("map_msg_id")
-    if map_msg_id:
-        try:
-            await context.bot.delete_message(
-                chat_id=query.message.chat_id,
-                message_id=map_msg_id
-            )
-        except Exception:
-            pass
-        context.user_data[user_id]["map_msg_id"] = None
-
-    # 🧹 حذف زرّي "📍 مواقع الفروع" و"🔧 المتاجر المستقلة" من الرسالة السابقة
-    try:
-        old_keyboard = query.message.reply_markup.inline_keyboard
-        new_keyboard = [
-            row for row in old_keyboard
-            if not any(
-                btn.callback_data
-                and ("branches_" in btn.callback_data or "independent_" in btn.callback_data)
-                for btn in row
-            )
-        ]
-        await query.message.edit_reply_markup(
-            reply_markup=InlineKeyboardMarkup(new_keyboard) if new_keyboard else None
-        )
-    except Exception:
-        pass
-
-    user_name = query.from_user.full_name
-    now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
-    delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
-
-    header = f"`🧑‍💼 استعلام خاص بـ {user_name}`"
-    middle = "🚨 مواقع مراكز الصيانة شيري CHERY"
-    footer = f"\n\n`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة ({delete_time} / 🇸🇦)`"
-
+@keyboard_list("branches")
+def _branches_keyboard(context, user_id: int, arg: str):
     # ==========================================================
     # 🛑 حماية مهمة: branches قد تكون dict وليس list → تسبب خطأ
     # ==========================================================
@@ -4470,33 +7211,90 @@ async def handle_branch_list(update: Update, context: ContextTypes.DEFAULT_TYPE)
         else:
             keyboard_rows.append([InlineKeyboardButton(label, callback_data=f"not_ready_{user_id}")])
 
-    if not keyboard_rows:
-        await query.answer("❌ لا يوجد فروع صالحة للعرض حالياً.", show_alert=True)
-        return
+    footer = [
+        # زر المراكز المستقلة
+        [InlineKeyboardButton("🔧 المتاجر ومراكز الصيانة المستقلة", callback_data=f"independent_{user_id}")],
+        # زر الرجوع
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back:main:{user_id}")],
+    ]
+    return keyboard_rows, footer
 
-    # زر المراكز المستقلة
-    keyboard_rows.append(
-        [InlineKeyboardButton("🔧 المتاجر ومراكز الصيانة المستقلة", callback_data=f"independent_{user_id}")]
-    )
 
-    # زر الرجوع
-    keyboard_rows.append(
-        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back:main:{user_id}")]
-    )
+async def handle_branch_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+
+    # 🧹 حذف فيديو المواقع السابق إن وجد
+    map_msg_id = context.user_data.get(user_id, {}).get("map_msg_id")
+    if map_msg_id:
+        try:
+            await context.bot.delete_message(
+                chat_id=query.message.chat_id,
+                message_id=map_msg_id
+            )
+        except Exception:
+            pass
+        context.user_data[user_id]["map_msg_id"] = None
+
+    # 🧹 حذف زرّي "📍 مواقع الفروع" و"🔧 المتاجر المستقلة" من الرسالة السابقة
+    try:
+        old_keyboard = query.message.reply_markup.inline_keyboard
+        new_keyboard = [
+            row for row in old_keyboard
+            if not any(
+                btn.callback_data
+                and ("branches_" in btn.callback_data or "independent_" in btn.callback_data)
+                for btn in row
+            )
+        ]
+        await query.message.edit_reply_markup(
+            reply_markup=InlineKeyboardMarkup(new_keyboard) if new_keyboard else None
+        )
+    except Exception:
+        pass
+
+    user_name = query.from_user.full_name
+    now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
+    delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
+
+    header = f"`🧑‍💼 استعلام خاص بـ {user_name}`"
+    middle = "🚨 مواقع مراكز الصيانة شيري CHERY"
+    footer = f"\n\n`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة ({delete_time} / 🇸🇦)`"
+
+    markup = paged_keyboard(context, "branches", user_id)
+    if not _keyboard_list_entry(context, "branches", user_id, "-")["items"]:
+        await query.answer("❌ لا يوجد فروع صالحة للعرض حالياً.", show_alert=True)
+        return
 
     msg = await context.bot.send_message(
         chat_id=query.message.chat_id,
         text=f"{header}\n{middle}:{footer}",
         parse_mode=constants.ParseMode.MARKDOWN,
-        reply_markup=InlineKeyboardMarkup(keyboard_rows),
+        reply_markup=markup,
     )
 
     register_message(user_id, msg.message_id, query.message.chat_id, context)
     await log_event(update, "عرض قائمة فروع مراكز شيري الرسمية")
 
+@keyboard_list("cities")
+def _independent_cities_keyboard(context, user_id: int, arg: str):
+    cities = df_independent["city"].dropna().unique().tolist()
+    rows = [
+        [InlineKeyboardButton(city, callback_data=f"setcity_{cb_ref(city)}_{user_id}")]
+        for city in cities
+    ]
+    footer = [
+        # ✅ زر "مواقع فروع شركة شيري" أسفل المدن
+        [InlineKeyboardButton("📍 مواقع فروع شركة شيري", callback_data=f"branches_{user_id}")],
+        # ✅ زر رجوع للقائمة الرئيسية أسفل المدن
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back:main:{user_id}")],
+    ]
+    return rows, footer
+
+
 async def handle_independent(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    user_id = int(query.data.split("_")[1])
+    user_id = callback_args(context)["user_id"]
 
     # 🧹 حذف فيديو المواقع السابق إن وجد
     map_msg_id = context.user_data.get(user_id, {}).get("map_msg_id")
@@ -4549,27 +7347,13 @@ async def handle_independent(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             register_message(user_id, msg1.message_id, query.message.chat_id, context)
 
-    # 🌍 قائمة المدن من شيت المراكز المستقلة
-    cities = df_independent["city"].dropna().unique().tolist()
-    city_buttons = [
-        [InlineKeyboardButton(city, callback_data=f"setcity_{city}_{user_id}")]
-        for city in cities
-    ]
-
-    # ✅ إضافة زر "مواقع فروع شركة شيري" أسفل المدن
-    city_buttons.append(
-        [InlineKeyboardButton("📍 مواقع فروع شركة شيري", callback_data=f"branches_{user_id}")]
-    )
-
-    # ✅ زر رجوع للقائمة الرئيسية أسفل المدن
-    city_buttons.append(
-        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back:main:{user_id}")]
-    )
+    # 🌍 قائمة المدن من شيت المراكز المستقلة (بصفحات لو طالت)
+    city_buttons = paged_keyboard(context, "cities", user_id)
 
     msg2 = await context.bot.send_message(
         chat_id=query.message.chat_id,
         text="🌍 اختر المدينة لعرض المراكز والمتاجر مباشرة:",
-        reply_markup=InlineKeyboardMarkup(city_buttons),
+        reply_markup=city_buttons,
         parse_mode=constants.ParseMode.MARKDOWN,
     )
     register_message(user_id, msg2.message_id, query.message.chat_id, context)
@@ -4578,9 +7362,9 @@ async def handle_independent(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    parts = query.data.split("_")
-    city = parts[1]
-    user_id = int(parts[2])
+    args = callback_args(context)
+    city = args["city"]
+    user_id = args["user_id"]
 
     # 🔴 إزالة قفل تكرار المدينة (معطل)
     # if context.user_data.get(user_id, {}).get("city_selected"):
@@ -4608,6 +7392,32 @@ async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     register_message(user_id, msg.message_id, query.message.chat_id, context)
     await log_event(update, f"اختار مدينة: {city}")
 
+def _render_independent_body(row) -> str:
+    name = row.get("name", "بدون اسم")
+    phone = row.get("phone", "غير متوفر")
+    result_type = row.get("type", "")
+    location_url = row.get("location_url", "")
+
+    name_safe = html.escape(str(name))
+    phone_safe = html.escape(str(phone))
+    result_type_safe = html.escape(str(result_type)) if result_type else "غير محدد"
+
+    # 📝 نص الوصف (HTML بدل ماركداون)
+    text = (
+        f"🏪 الاسم: {name_safe}\n"
+        f"🔧 التصنيف: {result_type_safe}\n"   # 👈 النوع (متجر / مركز)
+        f"📞 الهاتف: {phone_safe}"
+    )
+
+    # 🌐 رابط الموقع إن وجد (رابط مخفي داخل نص عربي قابل للنقر فقط)
+    if isinstance(location_url, str) and location_url.strip():
+        safe_url = location_url.strip()
+        safe_url_escaped = html.escape(safe_url)
+        text += (
+            f"\n🌐 <a href=\"{safe_url_escaped}\">اضغط هنا لعرض الموقع والتفاصيل </a>"
+        )
+    return text
+
 async def _send_independent_results(update: Update, context: ContextTypes.DEFAULT_TYPE, filter_type: str):
     """
     عرض نتائج المراكز / المتاجر المستقلة مع صورة المتجر (إن وجدت) + رابط الموقع من ملف Excel.
@@ -4647,70 +7457,39 @@ async def _send_independent_results(update: Update, context: ContextTypes.DEFAUL
     user_name_safe = html.escape(user_name)
     city_safe = html.escape(str(city))
 
-    for _, row in results.iterrows():
-        name = row.get("name", "بدون اسم")
-        phone = row.get("phone", "غير متوفر")
-        result_type = row.get("type", "")
-        image_url = row.get("image_url", "")
-        location_url = row.get("location_url", "")
+    header = (
+        f"<code>🧑‍💻 استعلام خاص بـ {user_name_safe}</code>\n"
+        f"<code>🏙️ المدينة: {city_safe}</code>\n\n"
+    )
+    footer = f"\n\n<code>⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)</code>"
 
-        name_safe = html.escape(str(name))
-        phone_safe = html.escape(str(phone))
-        result_type_safe = html.escape(str(result_type)) if result_type else "غير محدد"
+    photos, text_entries = [], []
+    for idx, row in results.iterrows():
+        image_url = row.get("image_url", "")
+        text = cached_body("independent", df_independent, idx, lambda: _render_independent_body(row))
 
-        # 📝 نص الوصف (HTML بدل ماركداون)
-        text = (
-            f"<code>🧑‍💻 استعلام خاص بـ {user_name_safe}</code>\n"
-            f"<code>🏙️ المدينة: {city_safe}</code>\n\n"
-            f"🏪 الاسم: {name_safe}\n"
-            f"🔧 التصنيف: {result_type_safe}\n"   # 👈 النوع (متجر / مركز)
-            f"📞 الهاتف: {phone_safe}\n"
-        )
-
-        # 🌐 رابط الموقع إن وجد (رابط مخفي داخل نص عربي قابل للنقر فقط)
-        if isinstance(location_url, str) and location_url.strip():
-            safe_url = location_url.strip()
-            safe_url_escaped = html.escape(safe_url)
-            text += (
-                f"🌐 <a href=\"{safe_url_escaped}\">اضغط هنا لعرض الموقع والتفاصيل </a>\n"
-            )
+        entry = {"text": text}
+        # 🖼 النتائج التي لها صورة تذهب للألبوم، والباقي لرسالة نصية واحدة بصفحات
+        if isinstance(image_url, str) and image_url.strip().lower().startswith("http"):
+            photos.append({"url": image_url.strip(), "caption": header + text + footer, "entry": entry})
+        else:
+            text_entries.append(entry)
 
-        text += (
-            f"\n<code>⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)</code>"
-        )
+    chat_id = query.message.chat_id
+    failed_photos = await send_photo_albums(context, chat_id, user_id, photos)
+    # الصور التي فشل إرسالها تُعرض نصياً مع البقية
+    text_entries.extend(item["entry"] for item in failed_photos)
 
-        # 🖼 إذا عندنا رابط صورة صالح نرسلها كصورة + كابشن، غير كذا نرسل نص فقط
-        try:
-            if isinstance(image_url, str) and image_url.strip().lower().startswith("http"):
-                msg = await context.bot.send_photo(
-                    chat_id=query.message.chat_id,
-                    photo=image_url.strip(),
-                    caption=text,
-                    parse_mode=constants.ParseMode.HTML,
-                )
-            else:
-                msg = await query.message.reply_text(
-                    text,
-                    parse_mode=constants.ParseMode.HTML
-                )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
-        except Exception as e:
-            logging.warning(f"[INDEPENDENT] فشل إرسال نتيجة مع الصورة لـ {name}: {e}")
-            try:
-                # fallback: إرسال نص فقط لو الصورة فشلت
-                msg = await query.message.reply_text(
-                    text,
-                    parse_mode=constants.ParseMode.HTML
-                )
-                register_message(user_id, msg.message_id, query.message.chat_id, context)
-            except Exception as e2:
-                logging.error(f"[INDEPENDENT] فشل إرسال نتيجة نصية لـ {name}: {e2}")
+    try:
+        await send_paginated_results(context, chat_id, user_id, text_entries, header=header, footer=footer)
+    except Exception as e:
+        logging.error(f"[INDEPENDENT] فشل إرسال النتائج النصية ({len(text_entries)}): {e}")
 
     await log_event(update, f"✅ عرض نتائج {filter_type} في {city}")
 
 async def show_center_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    user_id = int(query.data.split("_")[2])
+    user_id = callback_args(context)["user_id"]
 
     # 🧹 إزالة أزرار اختيار نوع الخدمة من الرسالة القديمة (المراكز + المتاجر)
     try:
@@ -4754,7 +7533,7 @@ async def show_center_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_store_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    user_id = int(query.data.split("_")[2])
+    user_id = callback_args(context)["user_id"]
 
     # 🧹 إزالة أزرار اختيار نوع الخدمة من الرسالة القديمة (المراكز + المتاجر)
     try:
@@ -4796,771 +7575,736 @@ async def show_store_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📜 عرض قائمة المتاجر في {context.user_data[user_id].get('city', 'غير معروفة')}"
     )
 
-async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    raw_data = query.data or ""
+def _remember_menu_chat(context, user_id: int, query):
+    """حفظ المجموعة التي فُتحت منها القائمة (تُستخدم لاحقاً في مركز الدعم)."""
+    chat = query.message.chat
+    context.user_data.setdefault(user_id, {})
+    context.user_data[user_id]["group_title"] = chat.title or "خاص"
+    context.user_data[user_id]["group_id"] = chat.id
 
-    # ✅ تعريف الاسم بشكل آمن لـ HTML (يحل مشكلة NameError نهائيا)
-    _user = query.from_user
-    name = html.escape((_user.full_name or "الصديق").strip())
 
-    # 🔙 زر رجوع للقائمة الرئيسية back_main_USERID
-    if raw_data.startswith("back_main_"):
-        try:
-            user_id = int(raw_data.split("_")[2])
-        except Exception:
-            await query.answer("❌ خطأ في زر الرجوع", show_alert=True)
-            return
+async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """🔙 زر رجوع للقائمة الرئيسية back_main_USERID"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
 
-        keyboard = build_main_menu_keyboard(user_id)
+    keyboard = build_main_menu_keyboard(user_id)
 
-        msg = None
-        try:
-            if getattr(query.message, "text", None):
-                msg = await query.edit_message_text(
-                    "اختر الخدمة المطلوبة:",
-                    reply_markup=keyboard
-                )
-            else:
-                raise Exception("message has no text")
-        except Exception:
-            msg = await query.message.reply_text(
+    msg = None
+    try:
+        if getattr(query.message, "text", None):
+            msg = await query.edit_message_text(
                 "اختر الخدمة المطلوبة:",
                 reply_markup=keyboard
             )
+        else:
+            raise Exception("message has no text")
+    except Exception:
+        msg = await query.message.reply_text(
+            "اختر الخدمة المطلوبة:",
+            reply_markup=keyboard
+        )
 
-        register_message(user_id, msg.message_id, query.message.chat_id, context)
-        await log_event(update, "⬅️ رجوع الى القائمة الرئيسية")
-        return
+    register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await log_event(update, "⬅️ رجوع الى القائمة الرئيسية")
 
-    # ❌ زر إلغاء النقاش والعودة للقائمة الرئيسية
-    if raw_data == "cancelteam":
-        admin_id = query.from_user.id
-        state = context.user_data.get(admin_id, {}) or {}
 
-        # حذف ثريد النقاش من الذاكرة
-        thread_id = state.get("team_thread_id")
-        if thread_id is not None:
-            team_threads.pop(thread_id, None)
+async def cancel_team_thread(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """❌ زر إلغاء النقاش والعودة للقائمة الرئيسية"""
+    query = update.callback_query
+    admin_id = query.from_user.id
+    state = context.user_data.get(admin_id, {}) or {}
 
-        # حذف رسالة تعليمات النقاش إن وُجدت
-        chat_id = state.get("team_msg_chat_id")
-        msg_id = state.get("team_msg_id")
-        if chat_id and msg_id:
-            try:
-                await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except Exception:
-                pass
+    # حذف ثريد النقاش إن لم تُكتب فيه أي مداخلة (النقاشات القائمة تبقى)
+    thread_id = state.get("team_thread_id")
+    if thread_id is not None:
+        await asyncio.to_thread(TEAM_THREADS.discard_if_empty, thread_id)
 
-        # تصفير حالة النقاش للمشرف
-        state["team_mode"] = False
-        state["team_thread_id"] = None
-        state["team_msg_chat_id"] = None
-        state["team_msg_id"] = None
-        context.user_data[admin_id] = state
+    # حذف رسالة تعليمات النقاش إن وُجدت
+    chat_id = state.get("team_msg_chat_id")
+    msg_id = state.get("team_msg_id")
+    if chat_id and msg_id:
+        try:
+            await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
+        except Exception:
+            pass
 
-        # الرجوع للقائمة الرئيسية في الخاص
-        keyboard = build_main_menu_keyboard(admin_id)
-        await context.bot.send_message(
-            chat_id=admin_id,
-            text="🔙 تم إلغاء النقاش.\nاختر من القائمة الرئيسية:",
-            reply_markup=keyboard,
-        )
+    # تصفير حالة النقاش للمشرف
+    state["team_mode"] = False
+    state["team_thread_id"] = None
+    state["team_msg_chat_id"] = None
+    state["team_msg_id"] = None
+    context.user_data[admin_id] = state
 
-        await query.answer()
-        return
+    # الرجوع للقائمة الرئيسية في الخاص
+    keyboard = build_main_menu_keyboard(admin_id)
+    await context.bot.send_message(
+        chat_id=admin_id,
+        text="🔙 تم إلغاء النقاش.\nاختر من القائمة الرئيسية:",
+        reply_markup=keyboard,
+    )
 
-    # ✅ ازرار الرجوع الموحدة back:target:user_id
-    if raw_data.startswith("back:"):
-        await handle_back(update, context)
-        return
- 
-     # ✅ معالجة خاصة لزر showparts_ (لأن الاسم فيه مسافات تتحول إلى _)
-    if raw_data.startswith("showparts_"):
-        try:
-            data = raw_data[len("showparts_"):]
-            last_underscore = data.rfind("_")
-            selected_car = data[:last_underscore].replace("_", " ").strip()
-            user_id = int(data[last_underscore + 1:])
+    await query.answer()
 
-            context.user_data.setdefault(user_id, {})
-            context.user_data[user_id]["selected_car"] = selected_car
 
-            await select_car_for_parts(update, context)
-        except Exception as e:
-            logging.error(f"🔴 Error in showparts callback: {e}")
-            await query.answer("❌ حدث خطأ أثناء معالجة التصنيف.", show_alert=True)
-        return
+# ================== 🔧 خدمة الأعطال الشائعة ==================
+# 🔧 فهرس الأعطال: تصنيف → نصوص جاهزة، مشترك لكل المستخدمين
+#    يُبنى مرة واحدة لكل نسخة من df_faults (بدل تكرار التصفية لكل ضغطة وتخزين نسخة لكل مستخدم)
+FAULT_INDEX = {"source": None, "version": "", "categories": [], "entries": {}}
+
+
+def _render_fault_entry(row) -> str:
+    car_type = row.get("car_type", "")
+    symptom = row.get("symptom", "")
+    cause = row.get("cause", "")
+    solution = row.get("solution", "")
+
+    parts = []
+    if str(car_type).strip():
+        parts.append(f"`🚗 نوع السيارة (إن وجد): {car_type}`")
+    if str(symptom).strip():
+        parts.append(f"🔹 العَرَض:\n{symptom}")
+    if str(cause).strip():
+        parts.append(f"🔹 السبب المحتمل:\n{cause}")
+    if str(solution).strip():
+        parts.append(f"🔹 الحل المقترح:\n{solution}")
+    return "\n\n".join(parts)
+
+
+def get_fault_index() -> dict:
+    """الفهرس الحالي؛ يُعاد بناؤه تلقائياً إذا تغير df_faults."""
+    faults_df = df_faults
+    if FAULT_INDEX["source"] is faults_df:
+        return FAULT_INDEX
+
+    categories, entries = [], {}
+    if faults_df is not None and not faults_df.empty and "category" in faults_df.columns:
+        keys = faults_df["category"].astype(str).str.strip()
+        valid = faults_df["category"].notna()
+        for key, (_, row) in zip(keys[valid], faults_df[valid].iterrows()):
+            if key not in entries:
+                categories.append(key)
+                entries[key] = []
+            entries[key].append(_render_fault_entry(row))
+
+    # النسخة مشتقة من المحتوى: نفس البيانات بعد إعادة التشغيل = نفس الأزرار صالحة
+    digest = hashlib.blake2b(digest_size=4)
+    for key in categories:
+        digest.update(key.encode("utf-8"))
+        for text in entries[key]:
+            digest.update(text.encode("utf-8"))
+
+    FAULT_INDEX.update(
+        source=faults_df,
+        version=digest.hexdigest(),
+        categories=categories,
+        entries=entries,
+    )
+    logging.info(f"[FAULTS] 🔧 فهرس الأعطال: {len(categories)} تصنيف (نسخة {FAULT_INDEX['version']})")
+    return FAULT_INDEX
 
-    # من هنا يكمل كود الأزرار العام
-    data = raw_data.split("_")
 
-    # ✅ تحضير action و user_id مع حالات خاصة catpart_ و faultcat_
-    action = None
-    user_id: Optional[int] = None
+async def show_faults_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """faults_USERID: قائمة تصنيفات الأعطال الشائعة"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-    if raw_data.startswith("catpart_"):
-        # شكل الداتا: catpart_keyword_userid
-        if len(data) < 3:
-            await query.answer("⚠️ بيانات غير صالحة، يرجى المحاولة مجددًا.", show_alert=True)
-            return
-        _, keyword, user_id_str = data
-        action = "catpart"
-        try:
-            user_id = int(user_id_str)
-        except ValueError:
-            logging.error(f"🔴 فشل في تحليل user_id في catpart: {user_id_str}")
-            await query.answer("⚠️ خطأ في البيانات، يرجى المحاولة مجددًا.", show_alert=True)
-            return
+    fault_index = get_fault_index()
+    faults_df = fault_index["source"]
 
-    elif raw_data.startswith("faultcat_"):
-    # شكل الداتا: faultcat_idx_userid
-        if len(data) < 3:
-            await query.answer("❌ بيانات غير صالحة لهذا الاختيار.", show_alert=True)
-            return
+    # لا يوجد شيت او فارغ
+    if faults_df is None or faults_df.empty or "category" not in faults_df.columns:
+        text = (
+            "🔧 الأعطال الشائعة وحلولها\n\n"
+            "هذه الخدمة تحت التحديث حالياً أو لم يتم إضافة بيانات في ملف Excel بعد.\n\n"
+            "عند تجهيز قاعدة بيانات الأعطال سوف تظهر لك قائمة بالأنظمة والأعراض والحلول بإذن الله."
+        )
+        keyboard = [
+            [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+        ]
+        msg = await query.edit_message_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        register_message(user_id, msg.message_id, query.message.chat_id, context)
+        await log_event(update, "محاولة فتح خدمة الاعطال الشائعة بدون بيانات")
+        return
 
-        action = "faultcat"
-        try:
-            user_id = int(data[2])
-        except ValueError:
-            await query.answer("❌ خطأ في بيانات المستخدم.", show_alert=True)
-            return
+    # قائمة الانظمة / التصنيفات من الفهرس المشترك
+    categories = fault_index["categories"]
 
-    else:
-    # باقي الأنواع الأخرى مثل parts_123 أو suggestion_123 أو faults_123 أو maintenance_123 أو coming_soon_123 ...
-        valid = True
+    if not categories:
+        text = (
+            "🔧 الأعطال الشائعة وحلولها\n\n"
+            "لم يتم العثور على أي تصنيفات للأعطال في ملف Excel.\n"
+            "فضلاً قم بإضافة بيانات في شيت faults."
+        )
+        keyboard = [
+            [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+        ]
+        msg = await query.edit_message_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        register_message(user_id, msg.message_id, query.message.chat_id, context)
+        return
 
-        if len(data) < 2:
-            await query.answer("⚠️ زر غير مفهوم، يرجى المحاولة مجددًا.", show_alert=True)
-            valid = False
+    now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
+    delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
 
-        if valid:
-        # ✅ آخر جزء دائما هو user_id حتى لو action فيه _
-            user_id_str = data[-1]
-            try:
-                user_id = int(user_id_str)
-            except ValueError:
-                logging.error(f"🔴 فشل في تحليل user_id: {user_id_str}")
-                await query.answer("⚠️ خطأ في البيانات، يرجى المحاولة مجددًا.", show_alert=True)
-                valid = False
+    keyboard = []
+    for idx, cat in enumerate(categories):
+        keyboard.append(
+            [InlineKeyboardButton(cat, callback_data=f"faultcat_{idx}_{user_id}_{fault_index['version']}")]
+        )
 
-        if valid:
-        # ✅ action قد يكون كلمة واحدة أو كلمتين مثل coming_soon
-            action = "_".join(data[:-1])
+    # زر رجوع
+    keyboard.append(
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+    )
 
-    chat = query.message.chat
-    context.user_data.setdefault(user_id, {})
-    context.user_data[user_id]["group_title"] = chat.title or "خاص"
-    context.user_data[user_id]["group_id"] = chat.id
+    text = (
+        "🔧 الأعطال الشائعة وحلولها\n\n"
+        "اختر النظام أو التصنيف الذي ترغب عرض الأعطال الشائعة الخاصة به:\n\n"
+        "`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة "
+        f"({delete_time} / 🇸🇦)`"
+    )
 
-    # ================== 🔧 خدمة الأعطال الشائعة ==================
-    if action == "faults":
-        try:
-            faults_df = df_faults
-        except NameError:
-            faults_df = pd.DataFrame()
-
-        # لا يوجد شيت او فارغ
-        if faults_df is None or faults_df.empty or "category" not in faults_df.columns:
-            text = (
-                "🔧 الأعطال الشائعة وحلولها\n\n"
-                "هذه الخدمة تحت التحديث حالياً أو لم يتم إضافة بيانات في ملف Excel بعد.\n\n"
-                "عند تجهيز قاعدة بيانات الأعطال سوف تظهر لك قائمة بالأنظمة والأعراض والحلول بإذن الله."
-            )
-            keyboard = [
-                [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-            ]
-            msg = await query.edit_message_text(
-                text,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
-            await log_event(update, "محاولة فتح خدمة الاعطال الشائعة بدون بيانات")
-            return
+    msg = await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode=constants.ParseMode.MARKDOWN
+    )
+    register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await log_event(update, "فتح قائمة الاعطال الشائعة الرئيسية")
 
-        # تجهيز قائمة الانظمة / التصنيفات
-        categories = (
-            faults_df["category"]
-            .dropna()
-            .astype(str)
-            .str.strip()
-            .unique()
-            .tolist()
-        )
 
-        if not categories:
-            text = (
-                "🔧 الأعطال الشائعة وحلولها\n\n"
-                "لم يتم العثور على أي تصنيفات للأعطال في ملف Excel.\n"
-                "فضلاً قم بإضافة بيانات في شيت faults."
-            )
-            keyboard = [
-                [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-            ]
-            msg = await query.edit_message_text(
-                text,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
-            return
+async def show_fault_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """faultcat_IDX_USERID_VERSION: أعطال تصنيف معين"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-        # حفظ التصنيفات في user_data مع الفهرس
-        context.user_data[user_id]["fault_categories"] = categories
+    # عرض اعطال تصنيف معين
+    idx = callback_args(context)["idx"]
 
-        now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
-        delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
+    fault_index = get_fault_index()
+    categories = fault_index["categories"]
 
-        keyboard = []
-        for idx, cat in enumerate(categories):
-            keyboard.append(
-                [InlineKeyboardButton(cat, callback_data=f"faultcat_{idx}_{user_id}")]
-            )
+    # الزر من نسخة بيانات أقدم → الفهارس قد تشير لتصنيف مختلف
+    if callback_args(context).get("version", fault_index["version"]) != fault_index["version"]:
+        await query.answer("♻️ تم تحديث قائمة الأعطال، يرجى فتحها من جديد.", show_alert=True)
+        return
 
-        # زر رجوع
-        keyboard.append(
-            [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-        )
+    if not categories or idx < 0 or idx >= len(categories):
+        await query.answer("❌ لم يتم العثور على هذا التصنيف. حاول من جديد عبر القائمة الرئيسية.", show_alert=True)
+        return
 
-        text = (
-            "🔧 الأعطال الشائعة وحلولها\n\n"
-            "اختر النظام أو التصنيف الذي ترغب عرض الأعطال الشائعة الخاصة به:\n\n"
-            "`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة "
-            f"({delete_time} / 🇸🇦)`"
-        )
+    selected_category = categories[idx]
+    fault_texts = fault_index["entries"].get(selected_category, [])
 
-        msg = await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=constants.ParseMode.MARKDOWN
+    if not fault_texts:
+        msg = await query.message.reply_text(
+            f"🚫 لا توجد أعطال مسجلة حالياً تحت التصنيف:\n• {selected_category}"
         )
         register_message(user_id, msg.message_id, query.message.chat_id, context)
-        await log_event(update, "فتح قائمة الاعطال الشائعة الرئيسية")
+        await log_event(update, f"لا توجد اعطال لتصنيف {selected_category}")
         return
 
-    elif action == "faultcat":
-        # عرض اعطال تصنيف معين
-        if len(data) < 3:
-            await query.answer("❌ بيانات غير صالحة لهذا الاختيار.", show_alert=True)
-            return
-
-        idx = int(data[1])
+    user_name = query.from_user.full_name
+    now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
+    delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
 
-        user_store = context.user_data.get(user_id, {})
-        categories = user_store.get("fault_categories", [])
+    header = (
+        f"`🧑‍💻 استعلام خاص بـ {user_name}`\n"
+        f"`🔧 النظام / التصنيف: {selected_category}`\n\n"
+    )
+    footer = (
+        f"\n\n`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة "
+        f"({delete_time} / 🇸🇦)`"
+    )
 
-        if not categories or idx < 0 or idx >= len(categories):
-            await query.answer("❌ لم يتم العثور على هذا التصنيف. حاول من جديد عبر القائمة الرئيسية.", show_alert=True)
-            return
+    entries = [{"text": text} for text in fault_texts]
 
-        selected_category = categories[idx]
+    # الأعطال في رسالة واحدة بصفحات + أزرار الرجوع أسفلها
+    await send_paginated_results(
+        context,
+        query.message.chat_id,
+        user_id,
+        entries,
+        header=header,
+        footer=footer,
+        parse_mode=constants.ParseMode.MARKDOWN,
+        extra_rows=[
+            [("⬅️ العودة لقائمة الأعطال", f"faults_{user_id}")],
+            [("⬅️ رجوع للقائمة الرئيسية", f"back_main_{user_id}")],
+        ],
+    )
 
-        try:
-            faults_df = df_faults
-        except NameError:
-            faults_df = pd.DataFrame()
+    await log_event(update, f"عرض اعطال التصنيف: {selected_category}")
 
-        if faults_df is None or faults_df.empty:
-            await query.answer("❌ لا توجد بيانات أعطال حالياً.", show_alert=True)
-            return
 
-        # تصفية الاعطال حسب التصنيف
-        subset = faults_df[
-            faults_df["category"].astype(str).str.strip() == str(selected_category).strip()
-        ]
+# ================== الصيانة الدورية بنظام البراندات ==================
+async def show_maintenance_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """maintenance_USERID: براندات الصيانة الدورية"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-        if subset.empty:
-            msg = await query.message.reply_text(
-                f"🚫 لا توجد أعطال مسجلة حالياً تحت التصنيف:\n• {selected_category}"
-            )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
-            await log_event(update, f"لا توجد اعطال لتصنيف {selected_category}")
-            return
+    # نحدد أن المستخدم داخل مسار الصيانة
+    context.user_data.setdefault(user_id, {})
+    context.user_data[user_id]["action"] = "maintenance"
 
-        user_name = query.from_user.full_name
-        now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
-        delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
+    # نحاول نقرأ البراندات من شيت الصيانة
+    if "brand" in df_maintenance.columns:
+        brands = (
+            df_maintenance["brand"]
+            .dropna()
+            .astype(str)
+            .str.strip()
+            .unique()
+            .tolist()
+        )
+        brands = [b for b in brands if b]  # حذف الفراغات إن وجدت
+    else:
+        brands = []
 
-        for _, row in subset.iterrows():
-            car_type = row.get("car_type", "")
-            symptom = row.get("symptom", "")
-            cause = row.get("cause", "")
-            solution = row.get("solution", "")
+    # لو مافي عمود brand لأي سبب نرجع للسلوك القديم (قائمة سيارات واحدة)
+    if not brands:
+        cars = (
+            df_maintenance["car_type"]
+            .dropna()
+            .astype(str)
+            .str.strip()
+            .unique()
+            .tolist()
+        )
 
-            text = (
-                f"`🧑‍💻 استعلام خاص بـ {user_name}`\n"
-                f"`🔧 النظام / التصنيف: {selected_category}`\n"
-            )
+        keyboard = [
+            [
+                InlineKeyboardButton(
+                    car,
+                    callback_data=f"car_{cb_ref(car)}_{user_id}"
+                )
+            ]
+            for car in cars
+        ]
+        keyboard.append(
+            [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+        )
 
-            if str(car_type).strip():
-                text += f"`🚗 نوع السيارة (إن وجد): {car_type}`\n"
+        msg = await query.edit_message_text(
+            "🚗 اختر فئة السيارة للصيانة الدورية:",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+        )
+        register_message(user_id, msg.message_id, query.message.chat_id, context)
+        await log_event(update, "فتح قائمة الصيانة الدورية (بدون براندات)")
+        return
 
-            text += "\n"
+    # ✅ هنا السلوك الجديد: عرض براندات أولاً
+    keyboard = []
+    for brand in brands:
+        safe_brand = brand
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    brand,
+                    callback_data=f"mbrand_{cb_ref(safe_brand)}_{user_id}"
+                )
+            ]
+        )
 
-            if str(symptom).strip():
-                text += f"🔹 العَرَض:\n{symptom}\n\n"
-            if str(cause).strip():
-                text += f"🔹 السبب المحتمل:\n{cause}\n\n"
-            if str(solution).strip():
-                text += f"🔹 الحل المقترح:\n{solution}\n\n"
+    # زر رجوع للقائمة الرئيسية
+    keyboard.append(
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+    )
 
-            text += (
-                f"`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة "
-                f"({delete_time} / 🇸🇦)`"
-            )
+    msg = await query.edit_message_text(
+        "🏷 اختر العلامة التجارية أولاً ثم سيتم عرض فئات السيارات:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
+    register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await log_event(update, "فتح قائمة الصيانة الدورية حسب البراند")
 
-            msg = await query.message.reply_text(
-                text,
-                parse_mode=constants.ParseMode.MARKDOWN
-            )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
 
-                # 2) رجوع للقائمة الرئيسية
-        back_keyboard = InlineKeyboardMarkup(
-            [
-                [InlineKeyboardButton("⬅️ العودة لقائمة الأعطال", callback_data=f"faults_{user_id}")],
-                [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")],
-            ]
-        )
+async def show_parts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """parts_USERID: نوع استعلام قطع الغيار"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-        # 🔥 إرسال الأزرار مع نص بسيط حتى تقبل تيليجرام الرسالة
-        back_msg = await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="يمكنك المتابعة من خلال الخيارات التالية:",
-            reply_markup=back_keyboard
-        )
+    keyboard = [
+        # استعلام القطع الاستهلاكية (يبقى كما هو)
+        [InlineKeyboardButton(
+            "🧩 استعلام قطع الغيار الاستهلاكية",
+            callback_data=f"consumable_{user_id}"
+        )],
+        # استعلام قطع غيار عام → يفتح موقع شيري مباشرة كرابط
+        [InlineKeyboardButton(
+            "🧩 استعلام قطع غيار عام (موقع شيري الرسمي)",
+            url="https://www.cheryksa.com/ar/spareparts"
+        )],
+        # زر الرجوع للقائمة الرئيسية
+        [InlineKeyboardButton(
+            "⬅️ رجوع للقائمة الرئيسية",
+            callback_data=f"back_main_{user_id}"
+        )],
+    ]
 
-        register_message(user_id, back_msg.message_id, query.message.chat_id, context)
+    msg = await query.edit_message_text(
+        "اختر نوع استعلام قطع الغيار ⚙️ :",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
+    register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await log_event(update, "اختار استعلام قطع الغيار")
 
-        await log_event(update, f"عرض اعطال التصنيف: {selected_category}")
-        return
 
-    # ================== الصيانة الدورية بنظام البراندات ==================
-    if action == "maintenance":
-        # نحدد أن المستخدم داخل مسار الصيانة
-        context.user_data.setdefault(user_id, {})
-        context.user_data[user_id]["action"] = "maintenance"
+async def show_external_parts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """external_USERID / extparts_USERID: رابط موقع قطع الغيار"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-        # نحاول نقرأ البراندات من شيت الصيانة
-        if "brand" in df_maintenance.columns:
-            brands = (
-                df_maintenance["brand"]
-                .dropna()
-                .astype(str)
-                .str.strip()
-                .unique()
-                .tolist()
-            )
-            brands = [b for b in brands if b]  # حذف الفراغات إن وجدت
-        else:
-            brands = []
+    now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
+    delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
+    keyboard = [[InlineKeyboardButton("🔗 فتح موقع الاستعلام", url="https://www.cheryksa.com/ar/spareparts")]]
+    msg = await query.edit_message_text(
+        "🌐 تم تجهيز الرابط، اضغط الزر بالأسفل للانتقال إلى موقع استعلام قطع غيار شيري الرسمي:\n\n"
+        f"`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة ({delete_time} / 🇸🇦)`",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode=constants.ParseMode.MARKDOWN
+    )
+    register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await log_event(update, "تم فتح رابط قطع الغيار الخارجي (extparts)")
 
-        # لو مافي عمود brand لأي سبب نرجع للسلوك القديم (قائمة سيارات واحدة)
-        if not brands:
-            cars = (
-                df_maintenance["car_type"]
-                .dropna()
-                .astype(str)
-                .str.strip()
-                .unique()
-                .tolist()
-            )
 
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        car,
-                        callback_data=f"car_{car.replace(' ', '_')}_{user_id}"
-                    )
-                ]
-                for car in cars
-            ]
-            keyboard.append(
-                [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-            )
+async def show_consumable_brands(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """consumable_USERID: براندات القطع الاستهلاكية"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-            msg = await query.edit_message_text(
-                "🚗 اختر فئة السيارة للصيانة الدورية:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-            )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
-            await log_event(update, "فتح قائمة الصيانة الدورية (بدون براندات)")
-            return
+    # أولاً نحاول عرض البراندات من شيت parts
+    try:
+        parts_df = df_parts
+    except NameError:
+        parts_df = pd.DataFrame()
+
+    brands = []
+    if not parts_df.empty and "brand" in parts_df.columns:
+        brands = (
+            parts_df["brand"]
+            .dropna()
+            .astype(str)
+            .str.strip()
+            .unique()
+            .tolist()
+        )
+        brands = [b for b in brands if b]
 
-        # ✅ هنا السلوك الجديد: عرض براندات أولاً
+    # في حال توفر البراندات → نعرض قائمة البراندات أولاً
+    if brands:
         keyboard = []
         for brand in brands:
-            safe_brand = brand.replace(" ", "_")
+            safe_brand = brand
             keyboard.append(
-                [
-                    InlineKeyboardButton(
-                        brand,
-                        callback_data=f"mbrand_{safe_brand}_{user_id}"
-                    )
-                ]
+                [InlineKeyboardButton(brand, callback_data=f"pbrand_{cb_ref(safe_brand)}_{user_id}")]
             )
 
-        # زر رجوع للقائمة الرئيسية
         keyboard.append(
             [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
         )
 
         msg = await query.edit_message_text(
-            "🏷 اختر العلامة التجارية أولاً ثم سيتم عرض فئات السيارات:",
+            "🏷 اختر العلامة التجارية أولاً لعرض فئات السيارات للقطع الاستهلاكية:",
             reply_markup=InlineKeyboardMarkup(keyboard),
         )
         register_message(user_id, msg.message_id, query.message.chat_id, context)
-        await log_event(update, "فتح قائمة الصيانة الدورية حسب البراند")
+        await log_event(update, "فتح قائمة البراندات للقطع الاستهلاكية (parts)")
         return
 
+    # في حال عدم توفر عمود brand نعود للسلوك القديم (قائمة سيارات واحدة)
+    keyboard = []
 
-    if action == "parts":
-        keyboard = [
-            # استعلام القطع الاستهلاكية (يبقى كما هو)
-            [InlineKeyboardButton(
-                "🧩 استعلام قطع الغيار الاستهلاكية",
-                callback_data=f"consumable_{user_id}"
-            )],
-            # استعلام قطع غيار عام → يفتح موقع شيري مباشرة كرابط
-            [InlineKeyboardButton(
-                "🧩 استعلام قطع غيار عام (موقع شيري الرسمي)",
-                url="https://www.cheryksa.com/ar/spareparts"
-            )],
-            # زر الرجوع للقائمة الرئيسية
-            [InlineKeyboardButton(
-                "⬅️ رجوع للقائمة الرئيسية",
-                callback_data=f"back_main_{user_id}"
-            )],
-        ]
+    for car in unique_cars:
+        callback_data = f"showparts_{cb_ref(car)}_{user_id}"
+        keyboard.append([InlineKeyboardButton(car, callback_data=callback_data)])
 
-        msg = await query.edit_message_text(
-            "اختر نوع استعلام قطع الغيار ⚙️ :",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-        )
-        register_message(user_id, msg.message_id, query.message.chat_id, context)
-        await log_event(update, "اختار استعلام قطع الغيار")
-        return
+    # زر رجوع في اسفل القائمة
+    keyboard.append([InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")])
 
-    elif action in ("external", "extparts"):
-        now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
-        delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
-        keyboard = [[InlineKeyboardButton("🔗 فتح موقع الاستعلام", url="https://www.cheryksa.com/ar/spareparts")]]
-        msg = await query.edit_message_text(
-            "🌐 تم تجهيز الرابط، اضغط الزر بالأسفل للانتقال إلى موقع استعلام قطع غيار شيري الرسمي:\n\n"
-            f"`⏳ سيتم حذف هذا الاستعلام تلقائياً خلال 15 دقيقة ({delete_time} / 🇸🇦)`",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=constants.ParseMode.MARKDOWN
-        )
-        register_message(user_id, msg.message_id, query.message.chat_id, context)
-        await log_event(update, "تم فتح رابط قطع الغيار الخارجي (extparts)")
+    if not unique_cars:
+        await query.edit_message_text("❌ لا توجد سيارات متاحة في قاعدة البيانات.")
+        await log_event(update, "❌ لا توجد سيارات متاحة في قاعدة البيانات (consumable)")
         return
 
-    elif action == "consumable":
-        # أولاً نحاول عرض البراندات من شيت parts
-        try:
-            parts_df = df_parts
-        except NameError:
-            parts_df = pd.DataFrame()
-
-        brands = []
-        if not parts_df.empty and "brand" in parts_df.columns:
-            brands = (
-                parts_df["brand"]
-                .dropna()
-                .astype(str)
-                .str.strip()
-                .unique()
-                .tolist()
-            )
-            brands = [b for b in brands if b]
-
-        # في حال توفر البراندات → نعرض قائمة البراندات أولاً
-        if brands:
-            keyboard = []
-            for brand in brands:
-                safe_brand = brand.replace(" ", "_")
-                keyboard.append(
-                    [InlineKeyboardButton(brand, callback_data=f"pbrand_{safe_brand}_{user_id}")]
-                )
+    msg = await query.edit_message_text("🚗 اختر فئة السيارة المطلوبة:", reply_markup=InlineKeyboardMarkup(keyboard))
+    register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await log_event(update, "عرض قائمة السيارات للقطع الاستهلاكية (بدون براندات)")
 
-            keyboard.append(
-                [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-            )
 
-            msg = await query.edit_message_text(
-                "🏷 اختر العلامة التجارية أولاً لعرض فئات السيارات للقطع الاستهلاكية:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-            )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
-            await log_event(update, "فتح قائمة البراندات للقطع الاستهلاكية (parts)")
-            return
+def _render_part_line(row) -> str:
+    part_name_value = row.get("Station Name", "غير معروف")
+    part_number_value = row.get("Part No", "غير معروف")
+    price = get_part_price(row)  # 💰 استخراج السعر إن وجد
 
-        # في حال عدم توفر عمود brand نعود للسلوك القديم (قائمة سيارات واحدة)
-        keyboard = []
+    text = (
+        f"🔹 <b>اسم القطعة:</b> {part_name_value}\n"
+        f"🔹 <b>رقم القطعة:</b> {part_number_value}\n"
+    )
 
-        for car in unique_cars:
-            callback_data = f"showparts_{car.replace(' ', '_')}_{user_id}"
-            keyboard.append([InlineKeyboardButton(car, callback_data=callback_data)])
+    if price:
+        price_display = price
+        if "ريال" not in price and "SAR" not in price.upper():
+            price_display = f"{price} ريال"
+        text += f"🔹 <b>السعر التقريبي:</b> {price_display}\n"
+    return text
 
-        # زر رجوع في اسفل القائمة
-        keyboard.append([InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")])
+async def show_part_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """catpart_KEYWORD_USERID: القطع ضمن تصنيف لنفس السيارة"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-        if not unique_cars:
-            await query.edit_message_text("❌ لا توجد سيارات متاحة في قاعدة البيانات.")
-            await log_event(update, "❌ لا توجد سيارات متاحة في قاعدة البيانات (consumable)")
-            return
+    keyword = callback_args(context)["keyword"]
+    selected_car = context.user_data[user_id].get("selected_car")
 
-        msg = await query.edit_message_text("🚗 اختر فئة السيارة المطلوبة:", reply_markup=InlineKeyboardMarkup(keyboard))
-        register_message(user_id, msg.message_id, query.message.chat_id, context)
-        await log_event(update, "عرض قائمة السيارات للقطع الاستهلاكية (بدون براندات)")
+    if not selected_car:
+        await query.answer("❌ يرجى اختيار فئة السيارة أولاً.", show_alert=True)
         return
 
-    elif action == "catpart":
-        keyword = data[1]
-        user_id = int(data[2])
-        selected_car = context.user_data[user_id].get("selected_car")
+    filtered_df = df_parts[df_parts["Station No"] == selected_car]
+    matches = filtered_df[
+        filtered_df["Station Name"]
+        .astype(str)
+        .str.strip()
+        .str.contains(f"^{keyword}|\\s{keyword}", case=False, na=False)
+    ]
 
-        if not selected_car:
-            await query.answer("❌ يرجى اختيار فئة السيارة أولاً.", show_alert=True)
-            return
+    if matches.empty:
+        await query.answer("❌ لم يتم توفير بيانات لهذا التصنيف بعد.\nهذا الطراز قيد الإعداد من فريق GO.", show_alert=True)
+        return
 
-        filtered_df = df_parts[df_parts["Station No"] == selected_car]
-        matches = filtered_df[
-            filtered_df["Station Name"]
-            .astype(str)
-            .str.strip()
-            .str.contains(f"^{keyword}|\\s{keyword}", case=False, na=False)
-        ]
+# 📌 ➤ إضافة بسيطة فقط: حفظ آخر صورة في هذا التصنيف
+    last_image_index = None
+    for idx, row in matches.iterrows():
+        if pd.notna(row.get("Image")):
+            last_image_index = idx
 
-        if matches.empty:
-            await query.answer("❌ لم يتم توفير بيانات لهذا التصنيف بعد.\nهذا الطراز قيد الإعداد من فريق GO.", show_alert=True)
-            return
+    context.user_data.setdefault(user_id, {})
+    context.user_data[user_id]["last_image_index_for_cat"] = last_image_index
+# 📌 انتهى التعديل الوحيد هنا
 
-    # 📌 ➤ إضافة بسيطة فقط: حفظ آخر صورة في هذا التصنيف
-        last_image_index = None
-        for idx, row in matches.iterrows():
-            if pd.notna(row.get("Image")):
-                last_image_index = idx
+    now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
+    delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
+    footer = f"\n<code>⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)</code>"
 
-        context.user_data.setdefault(user_id, {})
-        context.user_data[user_id]["last_image_index_for_cat"] = last_image_index
-    # 📌 انتهى التعديل الوحيد هنا
+    user_name = query.from_user.full_name
 
-        now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
-        delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
-        footer = f"\n<code>⏳ سيتم حذف هذا الاستعلام تلقائيًا خلال 15 دقيقة ({delete_time} / 🇸🇦)</code>"
+# 🔹 رسائل القطع داخل التصنيف
+    header = (
+        f"<code>🧑‍💼 استعلام خاص بـ {user_name}</code>\n"
+        f"<code>🚗 الفئة: {selected_car}</code>\n\n"
+    )
+    for i, row in matches.iterrows():
+        body = cached_body("part_line", df_parts, i, lambda: _render_part_line(row))
+        text = f"{header}{body}\n<code>📌 تم العثور على نتائج بناءً على التصنيف</code>{footer}"
+
+        keyboard = []
+        if pd.notna(row.get("Image")):
+            keyboard.append(
+                [InlineKeyboardButton("عرض الصورة 📸", callback_data=f"part_image_{i}_{user_id}")]
+            )
 
-        user_name = query.from_user.full_name
+        msg = await query.message.reply_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None,
+            parse_mode=ParseMode.HTML
+        )
+        register_message(user_id, msg.message_id, query.message.chat_id, context)
 
-    # 🔹 رسائل القطع داخل التصنيف
-        for i, row in matches.iterrows():
-            part_name_value = row.get("Station Name", "غير معروف")
-            part_number_value = row.get("Part No", "غير معروف")
-            price = get_part_price(row)  # 💰 استخراج السعر إن وجد
+    # 🔹 رسالة ختامية فيها أزرار رجوع
+    safe_car = selected_car
 
-            text = (
-                f"<code>🧑‍💼 استعلام خاص بـ {user_name}</code>\n"
-                f"<code>🚗 الفئة: {selected_car}</code>\n\n"
-                f"🔹 <b>اسم القطعة:</b> {part_name_value}\n"
-                f"🔹 <b>رقم القطعة:</b> {part_number_value}\n"
-            )
+    # نحاول نجيب البراند من user_data لو محفوظ
+    parts_brand = context.user_data.get(user_id, {}).get("parts_brand")
+    back_buttons = [
+        [InlineKeyboardButton("🗂 رجوع لقائمة تصنيفات القطع", callback_data=f"showparts_{cb_ref(safe_car)}_{user_id}")],
+    ]
 
-            if price:
-                price_display = price
-                if "ريال" not in price and "SAR" not in price.upper():
-                    price_display = f"{price} ريال"
-                text += f"🔹 <b>السعر التقريبي:</b> {price_display}\n"
+    if parts_brand:
+        # يرجع لقائمة سيارات نفس البراند
+        safe_brand = str(parts_brand)
+        back_buttons.append(
+            [InlineKeyboardButton("🚘 اختيار سيارة أخرى", callback_data=f"pbrand_{cb_ref(safe_brand)}_{user_id}")]
+        )
+    else:
+        # احتياط: يرجعه لقائمة خدمة قطع الغيار العامة
+        back_buttons.append(
+            [InlineKeyboardButton("🚘 اختيار سيارة أخرى", callback_data=f"parts_{user_id}")]
+        )
 
-            text += f"\n<code>📌 تم العثور على نتائج بناءً على التصنيف</code>{footer}"
+    back_buttons.append(
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+    )
 
-            keyboard = []
-            if pd.notna(row.get("Image")):
-                keyboard.append(
-                    [InlineKeyboardButton("عرض الصورة 📸", callback_data=f"part_image_{i}_{user_id}")]
-                )
+    back_keyboard = InlineKeyboardMarkup(back_buttons)
 
-            msg = await query.message.reply_text(
-                text,
-                reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None,
-                parse_mode=ParseMode.HTML
-            )
-            register_message(user_id, msg.message_id, query.message.chat_id, context)
+    # 🔥 نرسل رسالة جديدة أسفل النتائج تحتوي أزرار الرجوع
+    back_msg = await query.message.reply_text(
+        "يمكنك المتابعة من خلال الأزرار التالية:",
+        reply_markup=back_keyboard,
+    )
+    register_message(user_id, back_msg.message_id, query.message.chat_id, context)
 
-        # 🔹 رسالة ختامية فيها أزرار رجوع
-        safe_car = selected_car.replace(" ", "_")
+    await log_event(update, f"✅ استعلام تصنيفي: {keyword} ضمن {selected_car}")
 
-        # نحاول نجيب البراند من user_data لو محفوظ
-        parts_brand = context.user_data.get(user_id, {}).get("parts_brand")
-        back_buttons = [
-            [InlineKeyboardButton("🗂 رجوع لقائمة تصنيفات القطع", callback_data=f"showparts_{safe_car}_{user_id}")],
-        ]
 
-        if parts_brand:
-            # يرجع لقائمة سيارات نفس البراند
-            safe_brand = str(parts_brand).replace(" ", "_")
-            back_buttons.append(
-                [InlineKeyboardButton("🚘 اختيار سيارة أخرى", callback_data=f"pbrand_{safe_brand}_{user_id}")]
-            )
-        else:
-            # احتياط: يرجعه لقائمة خدمة قطع الغيار العامة
-            back_buttons.append(
-                [InlineKeyboardButton("🚘 اختيار سيارة أخرى", callback_data=f"parts_{user_id}")]
-            )
+async def show_pp_teaser(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """coming_USERID: منصة PP لعروض قطع الغيار"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
+
+    # ✅ تعريف الاسم بشكل آمن لـ HTML
+    name = html.escape((query.from_user.full_name or "الصديق").strip())
+
+    teaser = (
+        f"<b>🚀 اهلا {name}</b>\n\n"
+        "<b>PP | منصة عروض قطع الغيار</b>\n\n"
+        "<i>"
+        "قدّم طلبك مرة واحدة\n"
+        "وسيصل تلقائيًا لمجموعة من التجار\n"
+        "لتحصل على عروض متعددة وتختار الأنسب لك"
+        "</i>\n\n"
+        "<b>⬇️ اضغط الزر وابدأ طلبك الآن</b>"
+    )
 
-        back_buttons.append(
-            [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+    # ✅ زر ديناميكي: رابط عند التفعيل / تنبيه عند عدم التفعيل
+    if PP_DIRECT_ENABLED and PP_BOT_USERNAME:
+        start_btn = InlineKeyboardButton(
+            "↗️ ابدأ بطلب القطع الآن",
+            url=f"https://t.me/{PP_BOT_USERNAME}?start=pp"
+        )
+    else:
+        start_btn = InlineKeyboardButton(
+            "↗️ ابدأ بطلب القطع الآن",
+            callback_data=f"coming_soon_{user_id}"
         )
 
-        back_keyboard = InlineKeyboardMarkup(back_buttons)
+    kb = InlineKeyboardMarkup([
+        [start_btn],
+        [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+                ])
 
-        # 🔥 نرسل رسالة جديدة أسفل النتائج تحتوي أزرار الرجوع
-        back_msg = await query.message.reply_text(
-            "يمكنك المتابعة من خلال الأزرار التالية:",
-            reply_markup=back_keyboard,
+    try:
+        await query.edit_message_text(
+            teaser,
+            reply_markup=kb,
+            parse_mode=constants.ParseMode.HTML,
+            disable_web_page_preview=True
+    )
+    except Exception:
+        await query.message.reply_text(
+            teaser,
+            reply_markup=kb,
+            parse_mode=constants.ParseMode.HTML,
+            disable_web_page_preview=True
         )
-        register_message(user_id, back_msg.message_id, query.message.chat_id, context)
 
-        await log_event(update, f"✅ استعلام تصنيفي: {keyword} ضمن {selected_car}")
-        return
-    
-    elif action == "coming":
-        teaser = (
-            f"<b>🚀 اهلا {name}</b>\n\n"
-            "<b>PP | منصة عروض قطع الغيار</b>\n\n"
-            "<i>"
-            "قدّم طلبك مرة واحدة\n"
-            "وسيصل تلقائيًا لمجموعة من التجار\n"
-            "لتحصل على عروض متعددة وتختار الأنسب لك"
-            "</i>\n\n"
-            "<b>⬇️ اضغط الزر وابدأ طلبك الآن</b>"
-        )
-
-        # ✅ زر ديناميكي: رابط عند التفعيل / تنبيه عند عدم التفعيل
-        if PP_DIRECT_ENABLED and PP_BOT_USERNAME:
-            start_btn = InlineKeyboardButton(
-                "↗️ ابدأ بطلب القطع الآن",
-                url=f"https://t.me/{PP_BOT_USERNAME}?start=pp"
-            )
-        else:
-            start_btn = InlineKeyboardButton(
-                "↗️ ابدأ بطلب القطع الآن",
-                callback_data=f"coming_soon_{user_id}"
-            )
+    await log_event(update, "فتح زر (قريبا شراء قطع غيار مباشر)")
 
-        kb = InlineKeyboardMarkup([
-            [start_btn],
-            [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-                    ])
 
-        try:
-            await query.edit_message_text(
-                teaser,
-                reply_markup=kb,
-                parse_mode=constants.ParseMode.HTML,
-                disable_web_page_preview=True
-        )
-        except Exception:
-            await query.message.reply_text(
-                teaser,
-                reply_markup=kb,
-                parse_mode=constants.ParseMode.HTML,
-                disable_web_page_preview=True
-            )
+async def pp_coming_soon(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """coming_soon_USERID: الخدمة قيد التجهيز"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-        await log_event(update, "فتح زر (قريبا شراء قطع غيار مباشر)")
-        return
+    await query.answer("⏳ الخدمة قيد التجهيز وسيتم تفعيلها قريبا", show_alert=True)
+    await log_event(update, "ضغط زر بدء خدمة PP قبل التفعيل")
 
 
-    elif action == "coming_soon":
-        await query.answer("⏳ الخدمة قيد التجهيز وسيتم تفعيلها قريبا", show_alert=True)
-        await log_event(update, "ضغط زر بدء خدمة PP قبل التفعيل")
-        return
+async def open_support_center(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """suggestion_USERID: فتح جلسة مركز الدعم الفني"""
+    query = update.callback_query
+    user_id = callback_args(context)["user_id"]
+    _remember_menu_chat(context, user_id, query)
 
-    elif action == "suggestion":
-        context.user_data[user_id]["action"] = "suggestion"
+    context.user_data[user_id]["action"] = "suggestion"
 
-        query = update.callback_query
-        user_obj = query.from_user
-        chat = query.message.chat
+    user_obj = query.from_user
+    chat = query.message.chat
 
-        user_name = user_obj.full_name
-        now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
-        delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
+    user_name = user_obj.full_name
+    now_saudi = datetime.now(timezone.utc) + timedelta(hours=3)
+    delete_time = (now_saudi + timedelta(minutes=15)).strftime("%I:%M %p")
 
-        # ✅ اسم المستخدم: باهت صغير (code)
-        user_block = f"🧑‍💼 استفسار دعم فني خاص بـ `{query.from_user.full_name}`"
+    # ✅ اسم المستخدم: باهت صغير (code)
+    user_block = f"🧑‍💼 استفسار دعم فني خاص بـ `{query.from_user.full_name}`"
 
-        prompt_block = (
-            "💬 أهلاً بك في مركز الدعم الفني لبرنامج GO.\n\n"
-            "✉️ يرجى كتابة استفسارك أو ملاحظتك.\n\n"
-            "⚠️ لخدمتك بشكل أدق "
-            "`نرجو إضافة فئة السيارة والموديل والسنة داخل الاستفسار.`\n\n"
-            "ℹ️ إذا احتجت إرسال أكثر من ملف يمكنك إرسالها في استفسارات منفصلة.\n\n"
-            "`يتم الاحتفاظ بهذه الجلسة مؤقتاً لمتابعة رد فريق GO`\n"
-            f"`⏳ سيتم حذف هذه الجلسة بعد 15 دقيقة ({delete_time} / 🇸🇦)`"
-        )
+    prompt_block = (
+        "💬 أهلاً بك في مركز الدعم الفني لبرنامج GO.\n\n"
+        "✉️ يرجى كتابة استفسارك أو ملاحظتك.\n\n"
+        "⚠️ لخدمتك بشكل أدق "
+        "`نرجو إضافة فئة السيارة والموديل والسنة داخل الاستفسار.`\n\n"
+        "ℹ️ إذا احتجت إرسال أكثر من ملف يمكنك إرسالها في استفسارات منفصلة.\n\n"
+        "`يتم الاحتفاظ بهذه الجلسة مؤقتاً لمتابعة رد فريق GO`\n"
+        f"`⏳ سيتم حذف هذه الجلسة بعد 15 دقيقة ({delete_time} / 🇸🇦)`"
+    )
 
-        text = f"{user_block}\n\n{prompt_block}"
+    text = f"{user_block}\n\n{prompt_block}"
 
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📤 يمكنك اضافة وسائط مع الاستفسار ", callback_data="send_suggestion")],
-          # [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
-        ])
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📤 يمكنك اضافة وسائط مع الاستفسار ", callback_data="send_suggestion")],
+      # [InlineKeyboardButton("⬅️ رجوع للقائمة الرئيسية", callback_data=f"back_main_{user_id}")]
+    ])
 
-        # 👇 هنا الذكاء: لو الرسالة الحالية هي رسالة الشكر (فيها رقم تذكرة) نخليها كما هي ونرسل رسالة جديدة تحتها
-        current_text = (query.message.text or "") if query.message else ""
+    # 👇 هنا الذكاء: لو الرسالة الحالية هي رسالة الشكر (فيها رقم تذكرة) نخليها كما هي ونرسل رسالة جديدة تحتها
+    current_text = (query.message.text or "") if query.message else ""
 
-        if "🎫 رقم تذكرتك" in current_text:
+    if "🎫 رقم تذكرتك" in current_text:
+        msg = await query.message.reply_text(
+            text,
+            reply_markup=keyboard,
+            parse_mode=constants.ParseMode.MARKDOWN
+        )
+    else:
+        # السلوك القديم للقائمة الرئيسية أو أماكن أخرى
+        try:
+            msg = await query.edit_message_text(
+                text,
+                reply_markup=keyboard,
+                parse_mode=constants.ParseMode.MARKDOWN
+            )
+        except Exception:
+            # لو فشل التعديل لأي سبب، نرجع نرسلها كرسالة جديدة
             msg = await query.message.reply_text(
                 text,
                 reply_markup=keyboard,
                 parse_mode=constants.ParseMode.MARKDOWN
             )
-        else:
-            # السلوك القديم للقائمة الرئيسية أو أماكن أخرى
-            try:
-                msg = await query.edit_message_text(
-                    text,
-                    reply_markup=keyboard,
-                    parse_mode=constants.ParseMode.MARKDOWN
-                )
-            except Exception:
-                # لو فشل التعديل لأي سبب، نرجع نرسلها كرسالة جديدة
-                msg = await query.message.reply_text(
-                    text,
-                    reply_markup=keyboard,
-                    parse_mode=constants.ParseMode.MARKDOWN
-                )
 
-        register_message(user_id, msg.message_id, query.message.chat_id, context)
-        await log_event(update, "بدأ المستخدم إرسال استفسار أو ملاحظة عبر مركز الدعم الفني")
+    register_message(user_id, msg.message_id, query.message.chat_id, context)
+    await log_event(update, "بدأ المستخدم إرسال استفسار أو ملاحظة عبر مركز الدعم الفني")
 
-        if "active_suggestion_id" not in context.user_data[user_id]:
-            suggestion_id = await start_suggestion_session(user_id, context)
-        else:
-            suggestion_id = context.user_data[user_id]["active_suggestion_id"]
+    if "active_suggestion_id" not in context.user_data[user_id]:
+        suggestion_id = await start_suggestion_session(user_id, context)
+    else:
+        suggestion_id = context.user_data[user_id]["active_suggestion_id"]
+
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
+    if record:
+        record["group_name"] = chat.title if getattr(chat, "title", None) else "خاص"
+        record["group_id"] = chat.id
+        record["user_name"] = user_name
 
-        record = suggestion_records.get(user_id, {}).get(suggestion_id)
-        if record:
-            record["group_name"] = chat.title if getattr(chat, "title", None) else "خاص"
-            record["group_id"] = chat.id
-            record["user_name"] = user_name
 
-        return
-        
 async def start_team_general_thread(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """زر: team_main_USERID من القائمة الرئيسية"""
     query = update.callback_query
-    data = (query.data or "").split("_")
-
-    if len(data) != 3:
-        await query.answer("❌ بيانات غير صالحة.", show_alert=True)
-        return
-
-    try:
-        admin_id_from_cb = int(data[2])
-    except ValueError:
-        await query.answer("❌ خطأ في رقم المستخدم.", show_alert=True)
-        return
+    admin_id_from_cb = callback_args(context)["user_id"]
 
     admin = query.from_user
     admin_id = admin.id
@@ -5569,8 +8313,7 @@ async def start_team_general_thread(update: Update, context: ContextTypes.DEFAUL
         await query.answer("❌ غير مصرح لك باستخدام هذا الزر.", show_alert=True)
         return
 
-    thread_id = _next_team_thread_id()
-    team_threads[thread_id] = {
+    thread_id = await asyncio.to_thread(TEAM_THREADS.create, {
         "type": "general",
         "created_by": admin_id,
         "created_at": datetime.now(timezone.utc).isoformat(),
@@ -5580,7 +8323,7 @@ async def start_team_general_thread(update: Update, context: ContextTypes.DEFAUL
             "chat_title": getattr(query.message.chat, "title", "خاص"),
         },
         "reply_count": 0,
-    }
+    })
 
     state = context.user_data.setdefault(admin_id, {})
     state["team_mode"] = True
@@ -5617,11 +8360,7 @@ async def start_team_general_thread(update: Update, context: ContextTypes.DEFAUL
 async def start_team_opinion_thread(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """زر: team_opinion_userId_suggestionId من إشعارات الرد"""
     query = update.callback_query
-    data = (query.data or "").split("_")
-
-    if len(data) < 3:
-        await query.answer("❌ بيانات غير صالحة.", show_alert=True)
-        return
+    args = callback_args(context)
 
     admin = query.from_user
     admin_id = admin.id
@@ -5629,15 +8368,9 @@ async def start_team_opinion_thread(update: Update, context: ContextTypes.DEFAUL
         await query.answer("❌ غير مصرح لك باستخدام هذا الزر.", show_alert=True)
         return
 
-    try:
-        user_id = int(data[2])
-    except ValueError:
-        await query.answer("❌ رقم مستخدم غير صحيح.", show_alert=True)
-        return
-
-    # suggestion_id هو بقية السلسلة
-    suggestion_id = "_".join(data[3:]) if len(data) > 3 else ""
-    record = suggestion_records.get(user_id, {}).get(suggestion_id)
+    user_id = args["user_id"]
+    suggestion_id = args["suggestion_id"]
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
     if not record:
         await query.answer("⚠️ لا يوجد سجل لهذا الاستفسار.", show_alert=True)
         return
@@ -5662,8 +8395,7 @@ async def start_team_opinion_thread(update: Update, context: ContextTypes.DEFAUL
         if not _bad(fixed_id) and fixed_id != user_id:
             record["group_id"] = fixed_id
 
-    thread_id = _next_team_thread_id()
-    team_threads[thread_id] = {
+    thread_id = await asyncio.to_thread(TEAM_THREADS.create, {
         "type": "suggestion",
         "created_by": admin_id,
         "created_at": datetime.now(timezone.utc).isoformat(),
@@ -5677,7 +8409,7 @@ async def start_team_opinion_thread(update: Update, context: ContextTypes.DEFAUL
             "text": record.get("text"),
         },
         "reply_count": 0,
-    }
+    })
 
     state = context.user_data.setdefault(admin_id, {})
     state["team_mode"] = True
@@ -5693,20 +8425,10 @@ async def start_team_opinion_thread(update: Update, context: ContextTypes.DEFAUL
         ),
     )
 
-async def team_reply_existing_thread(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """زر: team_reply_threadId من رسالة نقاش سابقة"""
-    query = update.callback_query
-    data = (query.data or "").split("_")
-
-    if len(data) != 3:
-        await query.answer("❌ بيانات غير صالحة.", show_alert=True)
-        return
-
-    try:
-        thread_id = int(data[2])
-    except ValueError:
-        await query.answer("❌ رقم نقاش غير صحيح.", show_alert=True)
-        return
+async def team_reply_existing_thread(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """زر: team_reply_threadId من رسالة نقاش سابقة"""
+    query = update.callback_query
+    thread_id = callback_args(context)["thread_id"]
 
     admin = query.from_user
     admin_id = admin.id
@@ -5714,7 +8436,9 @@ async def team_reply_existing_thread(update: Update, context: ContextTypes.DEFAU
         await query.answer("❌ غير مصرح لك باستخدام هذا الزر.", show_alert=True)
         return
 
-    if thread_id not in team_threads:
+    # السياق يُقرأ من القرص عند الضغط فقط (آخر المداخلات محفوظة داخل سجل النقاش)
+    thread = await asyncio.to_thread(TEAM_THREADS.get, thread_id)
+    if not thread:
         await query.answer("⚠️ هذا النقاش لم يعد موجوداً.", show_alert=True)
         return
 
@@ -5722,11 +8446,18 @@ async def team_reply_existing_thread(update: Update, context: ContextTypes.DEFAU
     state["team_mode"] = True
     state["team_thread_id"] = thread_id
 
+    recent_lines = [
+        f"• {m.get('name') or m.get('from')}: {(m.get('text') or '')[:200]}"
+        for m in (thread.get("messages") or [])[-3:]
+    ]
+    recent_block = ("🗂️ آخر المداخلات:\n" + "\n".join(recent_lines) + "\n\n") if recent_lines else ""
+
     await query.answer()
     await context.bot.send_message(
         chat_id=admin_id,
         text=(
             f"🧵 نقاش فريق GO #{thread_id}\n\n"
+            f"{recent_block}"
             "✍️ اكتب ردك الآن ليتم إرساله لبقية المشرفين ضمن هذا النقاش."
         ),
     )
@@ -5766,7 +8497,7 @@ async def handle_suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     suggestion_id = await start_suggestion_session(user_id, context)
 
-    record = suggestion_records.get(user_id, {}).get(suggestion_id)
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
     if record:
         record["group_name"] = chat.title if chat.type != "private" else "خاص"
         record["group_id"] = chat.id if chat.type != "private" else "غير معروف"
@@ -5774,17 +8505,12 @@ async def handle_suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_suggestion_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data_parts = query.data.split("_")
+    args = callback_args(context)
 
     # prefix = reply أو replyready
-    prefix = data_parts[0] if data_parts else ""
-
-    if len(data_parts) < 3 or not data_parts[1].isdigit():
-        await query.answer("❌ لا يمكن معالجة الطلب، البيانات غير مكتملة.", show_alert=True)
-        return
-
-    user_id = int(data_parts[1])
-    suggestion_id = data_parts[2]
+    prefix = args["prefix"]
+    user_id = args["user_id"]
+    suggestion_id = args["suggestion_id"]
     admin_id = query.from_user.id
     admin_name = query.from_user.full_name
 
@@ -5792,7 +8518,7 @@ async def handle_suggestion_reply(update: Update, context: ContextTypes.DEFAULT_
         await query.answer("❌ غير مصرح لك بالرد.", show_alert=True)
         return
 
-    record = suggestion_records.get(user_id, {}).get(suggestion_id)
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
     if not record:
         await query.answer("❌ لا يوجد سجل لهذا الاستفسار.", show_alert=True)
         return
@@ -5810,13 +8536,7 @@ async def handle_suggestion_reply(update: Update, context: ContextTypes.DEFAULT_
 
     # ✅ قفل مؤقت فقط قبل أول رد (منع مشرفين يفتحون التذكرة بنفس الوقت)
     if not record.get("replied_by"):
-        locked_by_id = record.get("locked_by_id")
-        if locked_by_id and not _lock_expired(record) and int(locked_by_id) != int(admin_id):
-            locker = record.get("locked_by_name") or "مشرف آخر"
-            await query.answer(f"🔒 التذكرة قيد المعالجة بواسطة: {locker}", show_alert=True)
-            return
-
-        ok, reason = lock_ticket(record, admin_id, admin_name)
+        ok, reason = await lock_ticket(record, admin_id, admin_name)
         if not ok:
             await query.answer(reason, show_alert=True)
             return
@@ -5901,7 +8621,7 @@ async def send_suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("⚠️ لا توجد جلسة دعم نشطة.", show_alert=True)
         return
 
-    record = suggestion_records.get(user_id, {}).get(suggestion_id)
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
     if not record:
         await query.answer("⚠️ لا يوجد استفسار أو ملاحظة محفوظ.", show_alert=True)
         return
@@ -5957,61 +8677,58 @@ async def send_suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     record["admin_messages"] = {}
 
-    # إرسال الاستفسار لكل مشرف
-    for admin_id in AUTHORIZED_USERS:
-        try:
-            sent = None
-            full_caption = header
+    # إرسال الاستفسار لكل مشرف (بالتوازي وفي الخلفية)
+    async def _send_to_admin(admin_id):
+        sent = None
+        full_caption = header
 
-            if media:
-                mtype = media["type"]
-                fid = media["file_id"]
-                if text:
-                    full_caption += f"\n\n📝 <b>الاستفسار الوارد :</b>\n<code>{text}</code>"
+        if media:
+            mtype = media["type"]
+            fid = media["file_id"]
+            if text:
+                full_caption += f"\n\n📝 <b>الاستفسار الوارد :</b>\n<code>{text}</code>"
 
-                if mtype == "photo":
-                    sent = await context.bot.send_photo(
-                        admin_id, fid,
-                        caption=full_caption,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=keyboard
-                    )
-                elif mtype == "video":
-                    sent = await context.bot.send_video(
-                        admin_id, fid,
-                        caption=full_caption,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=keyboard
-                    )
-                elif mtype == "document":
-                    sent = await context.bot.send_document(
-                        admin_id, fid,
-                        caption=full_caption,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=keyboard
-                    )
-                elif mtype == "voice":
-                    sent = await context.bot.send_voice(
-                        admin_id, fid,
-                        caption=full_caption,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=keyboard
-                    )
-            else:
-                suggestion_block = f"\n\n📝 <b>الاستفسار الوارد:</b>\n<code>{text}</code>" if text else ""
-                full_caption += suggestion_block
-                sent = await context.bot.send_message(
-                    admin_id,
-                    text=full_caption,
+            if mtype == "photo":
+                sent = await context.bot.send_photo(
+                    admin_id, fid,
+                    caption=full_caption,
                     parse_mode=ParseMode.HTML,
                     reply_markup=keyboard
                 )
+            elif mtype == "video":
+                sent = await context.bot.send_video(
+                    admin_id, fid,
+                    caption=full_caption,
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=keyboard
+                )
+            elif mtype == "document":
+                sent = await context.bot.send_document(
+                    admin_id, fid,
+                    caption=full_caption,
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=keyboard
+                )
+            elif mtype == "voice":
+                sent = await context.bot.send_voice(
+                    admin_id, fid,
+                    caption=full_caption,
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=keyboard
+                )
+        else:
+            suggestion_block = f"\n\n📝 <b>الاستفسار الوارد:</b>\n<code>{text}</code>" if text else ""
+            full_caption += suggestion_block
+            sent = await context.bot.send_message(
+                admin_id,
+                text=full_caption,
+                parse_mode=ParseMode.HTML,
+                reply_markup=keyboard
+            )
 
-            if sent:
-                record["admin_messages"][admin_id] = sent.message_id
+        return sent
 
-        except Exception as e:
-            logging.error(f"[استفسار] فشل في إرسال الاستفسار للمشرف {admin_id}: {e}")
+    notify_admins(_send_to_admin, record=record, tag="استفسار")
 
     record["submitted"] = True
     record["timestamp"] = datetime.now()
@@ -6064,19 +8781,14 @@ async def send_suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_send_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data_parts = (query.data or "").split("_")
-
-    if len(data_parts) < 4:
-        await query.answer("❌ تنسيق البيانات غير صحيح.", show_alert=True)
-        return
-
-    reply_key = data_parts[1]
-    user_id = int(data_parts[2])
-    suggestion_id = data_parts[3]
+    args = callback_args(context)
+    reply_key = args["reply_key"]
+    user_id = args["user_id"]
+    suggestion_id = args["suggestion_id"]
     admin_id = query.from_user.id
     admin_name = query.from_user.full_name
 
-    record = suggestion_records.get(user_id, {}).get(suggestion_id)
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
     if not record:
         await query.answer("❌ لا يوجد سجل لهذا الاستفسار.", show_alert=True)
         return
@@ -6084,13 +8796,7 @@ async def handle_send_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ✅ قفل مؤقت فقط قبل أول رد
     locked_now = False
     if not record.get("replied_by"):
-        locked_by_id = record.get("locked_by_id")
-        if locked_by_id and not _lock_expired(record) and int(locked_by_id) != int(admin_id):
-            locker = record.get("locked_by_name") or "مشرف آخر"
-            await query.answer(f"🔒 التذكرة قيد المعالجة بواسطة: {locker}", show_alert=True)
-            return
-
-        ok, reason = lock_ticket(record, admin_id, admin_name)
+        ok, reason = await lock_ticket(record, admin_id, admin_name)
         if not ok:
             await query.answer(reason, show_alert=True)
             return
@@ -6242,55 +8948,54 @@ async def handle_send_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
         record["caption"] = user_caption
 
         # ✅ فك القفل بعد نجاح الإرسال
-        unlock_ticket(record)
+        await unlock_ticket(record, admin_id)
 
         try:
             await query.message.delete()
         except Exception:
             pass
 
-        # إشعار جميع المشرفين
-        for aid in AUTHORIZED_USERS:
-            try:
-                buttons = [
-                    [InlineKeyboardButton("🟦 دعوة فريق GO للنقاش", callback_data=f"team_main_{aid}")],
-                    [InlineKeyboardButton("🗣️ دعوة إبداء رأي", callback_data=f"team_opinion_{user_id}_{suggestion_id}")],
-                ]
-
-                if aid == admin_id:
-                    buttons.insert(
-                        0,
-                        [InlineKeyboardButton("✉️ إرسال رد آخر", callback_data=f"customreply_{user_id}_{suggestion_id}")]
-                    )
+        # إشعار جميع المشرفين (بالتوازي وفي الخلفية)
+        async def _send_to_admin(aid):
+            buttons = [
+                [InlineKeyboardButton("🟦 دعوة فريق GO للنقاش", callback_data=f"team_main_{aid}")],
+                [InlineKeyboardButton("🗣️ دعوة إبداء رأي", callback_data=f"team_opinion_{user_id}_{suggestion_id}")],
+            ]
 
-                reply_markup = InlineKeyboardMarkup(buttons)
-
-                if media:
-                    mtype = media["type"]
-                    fid = media["file_id"]
-                    if mtype == "photo":
-                        await context.bot.send_photo(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    elif mtype == "video":
-                        await context.bot.send_video(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    elif mtype == "document":
-                        await context.bot.send_document(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    elif mtype == "voice":
-                        await context.bot.send_voice(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                else:
-                    try:
-                        with open("GO-NOW.PNG", "rb") as image:
-                            await context.bot.send_photo(aid, image, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    except Exception:
-                        await context.bot.send_message(aid, text=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup, disable_web_page_preview=True)
+            if aid == admin_id:
+                buttons.insert(
+                    0,
+                    [InlineKeyboardButton("✉️ إرسال رد آخر", callback_data=f"customreply_{user_id}_{suggestion_id}")]
+                )
 
-            except Exception as e:
-                logging.warning(f"[HANDLE_SEND_REPLY][admin_notify {aid}] فشل إرسال الإشعار: {e}")
+            reply_markup = InlineKeyboardMarkup(buttons)
+
+            if media:
+                mtype = media["type"]
+                fid = media["file_id"]
+                if mtype == "photo":
+                    return await context.bot.send_photo(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                elif mtype == "video":
+                    return await context.bot.send_video(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                elif mtype == "document":
+                    return await context.bot.send_document(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                elif mtype == "voice":
+                    return await context.bot.send_voice(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+            else:
+                try:
+                    with open("GO-NOW.PNG", "rb") as image:
+                        return await context.bot.send_photo(aid, image, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                except Exception:
+                    return await context.bot.send_message(aid, text=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup, disable_web_page_preview=True)
+            return None
+
+        notify_admins(_send_to_admin, tag="HANDLE_SEND_REPLY")
 
     except Exception as e:
         # ✅ لو فشل الإرسال: نفك القفل لو كان هو اللي قفّل (حتى لا تعلق التذكرة)
         if locked_now:
             try:
-                unlock_ticket(record)
+                await unlock_ticket(record, admin_id)
             except Exception:
                 pass
 
@@ -6302,23 +9007,13 @@ async def handle_send_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_custom_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    data = query.data
+    args = callback_args(context)
     admin_id = query.from_user.id
     admin_name = query.from_user.full_name
+    user_id = args["user_id"]
+    suggestion_id = args["suggestion_id"]
 
-    if not data.startswith("customreply_"):
-        await query.answer("🚫 بيانات غير صالحة.", show_alert=True)
-        return
-
-    try:
-        parts = data.split("_")
-        user_id = int(parts[1])
-        suggestion_id = parts[2]
-    except Exception:
-        await query.answer("🚫 فشل في استخراج بيانات الاستفسار.", show_alert=True)
-        return
-
-    record = suggestion_records.get(user_id, {}).get(suggestion_id)
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
     if not record:
         await query.answer("❌ لا يوجد سجل لهذه الاستفسار.", show_alert=True)
         return
@@ -6371,7 +9066,7 @@ async def submit_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer("❌ لا توجد جلسة رد نشطة.", show_alert=True)
         return
 
-    record = suggestion_records.get(user_id, {}).get(suggestion_id)
+    record = await asyncio.to_thread(TICKETS.get, user_id, suggestion_id)
     if not record:
         await query.answer("❌ لا يوجد سجل لهذه الاستفسار.", show_alert=True)
         return
@@ -6381,13 +9076,7 @@ async def submit_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # ✅ قفل مؤقت فقط قبل أول رد
     locked_now = False
     if not record.get("replied_by"):
-        locked_by_id = record.get("locked_by_id")
-        if locked_by_id and not _lock_expired(record) and int(locked_by_id) != int(admin_id):
-            locker = record.get("locked_by_name") or "مشرف آخر"
-            await query.answer(f"🔒 التذكرة قيد المعالجة بواسطة: {locker}", show_alert=True)
-            return
-
-        ok, reason = lock_ticket(record, admin_id, admin_name)
+        ok, reason = await lock_ticket(record, admin_id, admin_name)
         if not ok:
             await query.answer(reason, show_alert=True)
             return
@@ -6561,7 +9250,7 @@ async def submit_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
         record["caption"] = user_caption
 
         # ✅ فك القفل بعد نجاح الإرسال
-        unlock_ticket(record)
+        await unlock_ticket(record, admin_id)
 
         try:
             await query.message.delete()
@@ -6578,48 +9267,47 @@ async def submit_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
             record.pop("reply_menu_chat", None)
             record.pop("reply_menu_id", None)
 
-        # إشعار جميع المشرفين بالرد
-        for aid in AUTHORIZED_USERS:
-            try:
-                buttons = [
-                    [InlineKeyboardButton("🟦 دعوة فريق GO للنقاش", callback_data=f"team_main_{aid}")],
-                    [InlineKeyboardButton("🗳 دعوة إبداء رأي", callback_data=f"team_opinion_{user_id}_{suggestion_id}")],
-                ]
-
-                if aid == admin_id:
-                    buttons.insert(
-                        0,
-                        [InlineKeyboardButton("✉️ إرسال رد آخر", callback_data=f"customreply_{user_id}_{suggestion_id}")]
-                    )
+        # إشعار جميع المشرفين بالرد (بالتوازي وفي الخلفية)
+        async def _send_to_admin(aid):
+            buttons = [
+                [InlineKeyboardButton("🟦 دعوة فريق GO للنقاش", callback_data=f"team_main_{aid}")],
+                [InlineKeyboardButton("🗳 دعوة إبداء رأي", callback_data=f"team_opinion_{user_id}_{suggestion_id}")],
+            ]
 
-                reply_markup = InlineKeyboardMarkup(buttons)
-
-                if media:
-                    mtype = media["type"]
-                    fid = media["file_id"]
-                    if mtype == "photo":
-                        await context.bot.send_photo(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    elif mtype == "video":
-                        await context.bot.send_video(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    elif mtype == "document":
-                        await context.bot.send_document(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    elif mtype == "voice":
-                        await context.bot.send_voice(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                else:
-                    try:
-                        with open("GO-NOW.PNG", "rb") as image:
-                            await context.bot.send_photo(aid, image, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
-                    except Exception:
-                        await context.bot.send_message(
-                            aid,
-                            text=admin_caption,
-                            parse_mode=ParseMode.MARKDOWN,
-                            reply_markup=reply_markup,
-                            disable_web_page_preview=True
-                        )
+            if aid == admin_id:
+                buttons.insert(
+                    0,
+                    [InlineKeyboardButton("✉️ إرسال رد آخر", callback_data=f"customreply_{user_id}_{suggestion_id}")]
+                )
 
-            except Exception as e:
-                logging.warning(f"[رد مخصص - إشعار مشرف {aid}] فشل: {e}")
+            reply_markup = InlineKeyboardMarkup(buttons)
+
+            if media:
+                mtype = media["type"]
+                fid = media["file_id"]
+                if mtype == "photo":
+                    return await context.bot.send_photo(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                elif mtype == "video":
+                    return await context.bot.send_video(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                elif mtype == "document":
+                    return await context.bot.send_document(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                elif mtype == "voice":
+                    return await context.bot.send_voice(aid, fid, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+            else:
+                try:
+                    with open("GO-NOW.PNG", "rb") as image:
+                        return await context.bot.send_photo(aid, image, caption=admin_caption, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+                except Exception:
+                    return await context.bot.send_message(
+                        aid,
+                        text=admin_caption,
+                        parse_mode=ParseMode.MARKDOWN,
+                        reply_markup=reply_markup,
+                        disable_web_page_preview=True
+                    )
+            return None
+
+        notify_admins(_send_to_admin, tag="رد مخصص")
 
         # تنظيف حالة المشرف بعد الإرسال
         context.user_data.pop(admin_id, None)
@@ -6627,7 +9315,7 @@ async def submit_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         if locked_now:
             try:
-                unlock_ticket(record)
+                await unlock_ticket(record, admin_id)
             except Exception:
                 pass
         logging.error(f"[رد مخصص] فشل في إرسال الرد للمستخدم {user_id}: {e}")
@@ -6655,6 +9343,7 @@ async def handle_control_panel(update: Update, context: ContextTypes.DEFAULT_TYP
         [InlineKeyboardButton("🧨 تدمير البيانات", callback_data="self_destruct")],
         [InlineKeyboardButton("🔁 إعادة تشغيل الجلسة", callback_data="restart_session")],
         [InlineKeyboardButton("💾 النسخ الاحتياطي الآن", callback_data="ctrl_backup")],
+        [InlineKeyboardButton("📡 مهام البث", callback_data="ctrl_broadcasts")],
         [InlineKeyboardButton("🚪 خروج", callback_data="exit_control")],
     ]
 
@@ -6664,6 +9353,64 @@ async def handle_control_panel(update: Update, context: ContextTypes.DEFAULT_TYP
         parse_mode=ParseMode.MARKDOWN
     )
 
+TICKET_STATUS_LABELS = {
+    "draft": "📝 مسودة (لم تُرسل)",
+    "open": "📬 بانتظار الرد",
+    "replied": "✅ تم الرد",
+    "archived": "🗄️ مؤرشفة",
+}
+
+
+async def handle_ticket_lookup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/ticket رقم → عرض التذكرة فوراً | /ticket بدون رقم → ملخص الحالات وآخر التذاكر المفتوحة"""
+    admin_id = update.effective_user.id
+    if admin_id not in AUTHORIZED_USERS:
+        await update.message.reply_text("🚫 غير مصرح لك بالبحث في التذاكر.")
+        return
+
+    arg = (context.args[0] if context.args else "").lstrip("#")
+    if not arg:
+        counts = await asyncio.to_thread(TICKETS.counts)
+        open_tickets = await asyncio.to_thread(TICKETS.for_status, "open", 15)
+        lines = ["<b>🎫 تذاكر مركز الدعم</b>"]
+        for status, label in TICKET_STATUS_LABELS.items():
+            lines.append(f"{label}: <code>{counts.get(status, 0)}</code>")
+        if open_tickets:
+            lines.append("\n<b>📬 أحدث التذاكر بانتظار الرد:</b>")
+            lines.extend(f"• <code>/ticket {no}</code>" for no, _ in open_tickets)
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+        return
+
+    if not arg.isdigit():
+        await update.message.reply_text("❌ استخدم: /ticket رقم_التذكرة")
+        return
+
+    found = await asyncio.to_thread(TICKETS.by_number, int(arg))
+    if not found:
+        await update.message.reply_text(f"⚠️ لا توجد تذكرة بالرقم #{arg}")
+        return
+
+    record = found["record"]
+    status = "archived" if found["archived"] else ticket_status(record)
+    text_preview = html.escape(str(record.get("text") or "—"))[:800]
+    lines = [
+        f"<b>🎫 التذكرة #{arg}</b>",
+        f"الحالة: {TICKET_STATUS_LABELS[status]}",
+        f"👤 {html.escape(str(record.get('user_name') or '—'))} (<code>{found['user_id']}</code>)",
+        f"👥 {html.escape(str(record.get('group_name') or '—'))}",
+        f"📝 {text_preview}",
+    ]
+    if record.get("replied_by"):
+        lines.append(f"🛠️ تم الرد بواسطة: {html.escape(str(record['replied_by']))}")
+
+    keyboard = None
+    if status == "open":
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(
+            "📝 الرد على الاستفسار الوارد",
+            callback_data=f"reply_{found['user_id']}_{found['suggestion_id']}",
+        )]])
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=keyboard)
+
 # ✅ معالجة الضغط على أزرار الصيانة
 async def handle_control_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -6702,6 +9449,34 @@ async def handle_control_buttons(update: Update, context: ContextTypes.DEFAULT_T
         await create_excel_backup(reason="manual", context=context, notify_chat_id=user_id)
         return
 
+    # ✅ متابعة تقدم مهام بث التوصيات (تشمل المهام المستأنفة بعد إعادة التشغيل)
+    if action == "ctrl_broadcasts":
+        jobs = await asyncio.to_thread(BROADCAST_JOBS.recent, 5)
+        lines = ["📡 آخر مهام بث التوصيات:"]
+        for job_id, created_at, state, spec in jobs:
+            counts = await asyncio.to_thread(BROADCAST_JOBS.progress, job_id)
+            started = (datetime.fromtimestamp(created_at, timezone.utc) + timedelta(hours=3)).strftime("%Y-%m-%d %H:%M")
+            lines.append(
+                f"\n{'🔄 جارية' if state == 'running' else '🏁 مكتملة'} — {started} — {spec.get('admin_name', '—')}\n"
+                + format_broadcast_progress(job_id, counts)
+            )
+        if not jobs:
+            lines.append("لا توجد مهام بث حتى الآن.")
+        health = BROADCAST_TARGETS.counts()
+        if health:
+            lines.append(
+                f"\n🩺 مجموعات مستبعدة من البث: ميتة {health.get('dead', 0)} | "
+                f"متعثرة {health.get('demoted', 0)} | محوّلة {health.get('migrated', 0)}"
+            )
+        await query.message.edit_text(
+            "\n".join(lines),
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔄 تحديث", callback_data="ctrl_broadcasts")],
+                [InlineKeyboardButton("⬅️ عودة", callback_data="control_back")],
+            ]),
+        )
+        return
+
     # باقي الإجراءات كما هي
     if action == "control_back":
         await query.message.edit_text(
@@ -6715,6 +9490,7 @@ async def handle_control_buttons(update: Update, context: ContextTypes.DEFAULT_T
                 [InlineKeyboardButton("🧨 تدمير البيانات", callback_data="self_destruct")],
                 [InlineKeyboardButton("🔁 إعادة تشغيل الجلسة", callback_data="restart_session")],
                 [InlineKeyboardButton("💾 النسخ الاحتياطي الآن", callback_data="ctrl_backup")],
+                [InlineKeyboardButton("📡 مهام البث", callback_data="ctrl_broadcasts")],
                 [InlineKeyboardButton("🚪 خروج", callback_data="exit_control")]
             ]),
             parse_mode=constants.ParseMode.MARKDOWN
@@ -6834,8 +9610,7 @@ async def handle_control_buttons(update: Update, context: ContextTypes.DEFAULT_T
         try:
             df_admins = pd.read_excel("bot_data.xlsx", sheet_name="managers")
             AUTHORIZED_USERS.clear()
-            for _, row in df_admins.iterrows():
-                AUTHORIZED_USERS.append(int(row["manager_id"]))
+            AUTHORIZED_USERS.update(int(row["manager_id"]) for _, row in df_admins.iterrows())
             await query.message.edit_text("✅ تم إعادة تحميل ملف الإعدادات وتحديث البيانات.",
                                           reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="control_back")]]))
         except Exception as e:
@@ -6867,23 +9642,11 @@ async def handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_statistics(update, context)
 
 async def save_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global RATED_USERS
-
     query = update.callback_query
-    data = query.data or ""
-    parts = data.split("_")
-
     # شكل الكول باك: ratingval_رقم_رقم
-    if len(parts) != 3:
-        await query.answer("⚠️ تنسيق غير صالح.", show_alert=True)
-        return
-
-    try:
-        rating_value = int(parts[1])
-        user_id = int(parts[2])
-    except ValueError:
-        await query.answer("⚠️ بيانات تقييم غير صالحة.", show_alert=True)
-        return
+    args = callback_args(context)
+    rating_value = args["rating"]
+    user_id = args["user_id"]
 
     # منع أي أحد غير صاحب الجلسة من التقييم
     if query.from_user.id != user_id:
@@ -6931,34 +9694,8 @@ async def save_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
 
     try:
-        ratings_file = "bot_data.xlsx"
-
-        # قراءة شيت ratings إن وجد
-        try:
-            df_ratings = pd.read_excel(ratings_file, sheet_name="ratings")
-        except Exception:
-            df_ratings = pd.DataFrame(
-                columns=["user_id", "name", "rating", "timestamp", "group_name", "group_id"]
-            )
-
-        # ✅ توحيد نوع user_id داخل df_ratings
-        if not df_ratings.empty and "user_id" in df_ratings.columns:
-            try:
-                df_ratings["user_id"] = pd.to_numeric(df_ratings["user_id"], errors="coerce")
-            except Exception:
-                pass
-
-        # ✅ هل هذا المستخدم قيّم من قبل؟
-        already_rated = False
-        if not df_ratings.empty and "user_id" in df_ratings.columns:
-            try:
-                already_rated = int(user_id) in df_ratings["user_id"].dropna().astype(int).tolist()
-            except Exception:
-                already_rated = False
-
-        # طبقة حماية إضافية من الكاش
-        if user_id in RATED_USERS:
-            already_rated = True
+        # ✅ تسجيل التقييم (سطر واحد في ratings.log) — False يعني أنه قيّم من قبل
+        already_rated = not RATINGS.add(rating_entry)
 
         if already_rated:
             # إزالة أزرار التقييم من الرسالة الأصلية (إن أمكن)
@@ -6998,21 +9735,6 @@ async def save_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer(alert_text, show_alert=True)
             return
 
-        # ✅ مستخدم جديد في التقييم → نضيفه إلى الإكسل
-        df_ratings = pd.concat([df_ratings, pd.DataFrame([rating_entry])], ignore_index=True)
-
-        # تحديث قائمة المقيمين في الذاكرة
-        RATED_USERS.add(user_id)
-
-        # حفظ التقييم في الخلفية بدون تجميد البوت
-        async with EXCEL_LOCK:
-            await asyncio.to_thread(
-                write_excel_background,
-                ratings_file,
-                df_ratings,
-                "ratings"
-            )
-
         # محاولة حذف رسالة أزرار التقييم القديمة
         try:
             if query.message:
@@ -7058,23 +9780,24 @@ async def save_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # اسم عرض للمجموعة في إشعار المشرفين
         display_group_name = group_name or "استعلام خاص (بدون مجموعة مرتبطة)"
 
-        # إشعار المشرفين
-        for admin_id in AUTHORIZED_USERS:
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=(
-                        "🌟 *تقييم جديد من مستخدم*\n\n"
-                        f"👤 الاسم:\n`{user_name}`\n\n"
-                        f"👥 المجموعة:\n`{display_group_name}`\n\n"
-                        f"🆔 رقم المجموعة:\n`{group_id}`\n\n"
-                        f"📝 التقييم:\n`{rating_emojis.get(rating_value, '⭐')}`\n\n"
-                        f"🕓 الوقت:\n`{rating_entry['timestamp']}`"
-                    ),
-                    parse_mode=constants.ParseMode.MARKDOWN,
-                )
-            except Exception as e:
-                logging.warning(f"❌ فشل إرسال إشعار التقييم للمشرف {admin_id}: {e}")
+        # إشعار المشرفين (بالتوازي وفي الخلفية)
+        admin_rating_text = (
+            "🌟 *تقييم جديد من مستخدم*\n\n"
+            f"👤 الاسم:\n`{user_name}`\n\n"
+            f"👥 المجموعة:\n`{display_group_name}`\n\n"
+            f"🆔 رقم المجموعة:\n`{group_id}`\n\n"
+            f"📝 التقييم:\n`{rating_emojis.get(rating_value, '⭐')}`\n\n"
+            f"🕓 الوقت:\n`{rating_entry['timestamp']}`"
+        )
+
+        async def _send_to_admin(admin_id):
+            return await context.bot.send_message(
+                chat_id=admin_id,
+                text=admin_rating_text,
+                parse_mode=constants.ParseMode.MARKDOWN,
+            )
+
+        notify_admins(_send_to_admin, tag="RATING")
 
     except Exception as e:
         logging.error(f"[RATING] ❌ فشل في حفظ التقييم: {e}", exc_info=True)
@@ -7101,15 +9824,13 @@ async def handle_add_admin_id(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     # ✅ إضافة إلى القائمة الحالية
-    AUTHORIZED_USERS.append(new_admin_id)
+    AUTHORIZED_USERS.add(new_admin_id)
     df_admins = pd.concat([df_admins, pd.DataFrame([{"manager_id": new_admin_id}])], ignore_index=True)
 
     # ✅ حفظ التغييرات في الملف Excel
     try:
-        # قفل الكتابة على ملف الإكسل قبل تعديل شيت managers
-        async with EXCEL_LOCK:
-            with pd.ExcelWriter("bot_data.xlsx", engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
-                df_admins.to_excel(writer, sheet_name="managers", index=False)
+        # إضافة صف المشرف إلى شيت managers عبر كاتب الملف
+        await excel_write([("upsert", "managers", "manager_id", {"manager_id": new_admin_id})])
 
         await message.reply_text(f"✅ تم إضافة المشرف بنجاح: `{new_admin_id}`", parse_mode=ParseMode.MARKDOWN)
 
@@ -7152,115 +9873,407 @@ def _prepare_reco_targets_for_admin(admin_id: int, context: ContextTypes.DEFAULT
 
     logging.info(f"[RECO GROUPS] للمشرف {admin_id}: عدد المجموعات المتاحة للبث = {len(groups)}")
 
+# ================================================================
+#  🧭 موجّه أزرار callback: شجرة بادئات (trie) واحدة بدل عشرات أنماط regex
+#  - كل نمط يُكتب كقالب: "showparts_{car:rest}_{user_id:int}"
+#  - تُحلل البيانات مرة واحدة فقط وتُمرر للهاندلر في context.callback_args
+#  - الحقل rest يأخذ كل ما بين الحقول (يسمح بالمسافات و "_" داخل أسماء السيارات)
+#  - الحقل ref مثل rest لكنه يقبل مفاتيح جدول الحمولات (cb_ref) ويعيد القيمة الأصلية
+# ================================================================
+CALLBACK_TRIE: dict = {}
+_TRIE_ROUTES = ""  # مفتاح قائمة المسارات داخل عقدة الشجرة (لا يتعارض مع أي حرف)
+
+metric_declare("go_callback_unrouted_total", "counter", "Callback queries that matched no route.")
+
+# ----------------------------------------------------------------
+# 🎟️ جدول حمولات الأزرار (payload table)
+# - Telegram يحد callback_data بـ 64 بايت، والأسماء العربية الطويلة تتجاوزه بسهولة
+# - القيم القصيرة تبقى كما هي داخل الزر، والطويلة تُحفظ هنا ويحمل الزر مفتاحًا قصيرًا "~xxxxxxxx"
+# - المفتاح مشتق من محتوى القيمة (blake2b) فنفس الاسم يعطي نفس المفتاح دائمًا
+# - الجدول LRU محدود الحجم + TTL، والزر المنتهي يعطي رسالة واضحة بدل خطأ
+# ----------------------------------------------------------------
+CALLBACK_REF_MARK = "~"
+CALLBACK_INLINE_BYTES = int(os.getenv("GO_CALLBACK_INLINE_BYTES", "32"))
+CALLBACK_PAYLOAD_MAX = int(os.getenv("GO_CALLBACK_PAYLOAD_MAX", "5000"))
+CALLBACK_PAYLOAD_TTL = float(os.getenv("GO_CALLBACK_PAYLOAD_TTL", str(7 * 24 * 3600)))
+CALLBACK_PAYLOADS: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, stored_at)
+CALLBACK_PAYLOAD_EXPIRED = object()  # قيمة بديلة عندما لا نجد المفتاح في الجدول
+
+metric_declare("go_callback_payload_lookups_total", "counter", "Callback payload table lookups by result (hit/miss).")
+metric_declare("go_callback_payload_entries", "gauge", "Entries currently held in the callback payload table.")
+
+
+def _callback_payload_key(value: str) -> str:
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=6).digest()
+    # altchars بدون "_" لأنه فاصل الحقول في القوالب
+    return base64.b64encode(digest, altchars=b"-.").decode("ascii")
+
+
+def _prune_callback_payloads(now: float):
+    while CALLBACK_PAYLOADS:
+        key, (_, stored_at) = next(iter(CALLBACK_PAYLOADS.items()))
+        if len(CALLBACK_PAYLOADS) <= CALLBACK_PAYLOAD_MAX and now - stored_at <= CALLBACK_PAYLOAD_TTL:
+            break
+        CALLBACK_PAYLOADS.pop(key, None)
+    metric_set("go_callback_payload_entries", len(CALLBACK_PAYLOADS))
+
+
+def cb_ref(value) -> str:
+    """ترميز قيمة داخل callback_data: كما هي إن كانت قصيرة، وإلا مفتاح قصير من الجدول."""
+    value = str(value)
+    if len(value.encode("utf-8")) <= CALLBACK_INLINE_BYTES and not value.startswith(CALLBACK_REF_MARK):
+        return value
+
+    key = _callback_payload_key(value)
+    now = monotonic()
+    previous = CALLBACK_PAYLOADS.get(key)
+    if previous is not None and previous[0] != value:
+        logging.warning(f"[CB PAYLOAD] ⚠️ تصادم مفتاح {key} — سيتم استبدال القيمة القديمة")
+    CALLBACK_PAYLOADS[key] = (value, now)
+    CALLBACK_PAYLOADS.move_to_end(key)
+    _prune_callback_payloads(now)
+    return CALLBACK_REF_MARK + key
+
+
+def resolve_cb_ref(raw: str):
+    """عكس cb_ref: ترجع القيمة الأصلية أو CALLBACK_PAYLOAD_EXPIRED إن انتهت صلاحيتها."""
+    if not raw.startswith(CALLBACK_REF_MARK):
+        return raw
+
+    key = raw[len(CALLBACK_REF_MARK):]
+    now = monotonic()
+    entry = CALLBACK_PAYLOADS.get(key)
+    if entry is None or now - entry[1] > CALLBACK_PAYLOAD_TTL:
+        CALLBACK_PAYLOADS.pop(key, None)
+        metric_inc("go_callback_payload_lookups_total", {"result": "miss"})
+        return CALLBACK_PAYLOAD_EXPIRED
+
+    # الاستخدام يجدد العنصر (LRU + TTL منزلق)
+    CALLBACK_PAYLOADS[key] = (entry[0], now)
+    CALLBACK_PAYLOADS.move_to_end(key)
+    metric_inc("go_callback_payload_lookups_total", {"result": "hit"})
+    return entry[0]
+
+
+def add_callback_route(template: str, handler, **bound):
+    """تسجيل مسار: قالب + هاندلر + قيم ثابتة اختيارية تُضاف للـ args."""
+    prefix, _, fields_part = template.partition("{")
+    fields = []
+    sep = "_"
+    if fields_part:
+        fields_part = "{" + fields_part
+        raw_fields = re.findall(r"\{(\w+)(?::(\w+))?\}", fields_part)
+        separators = set(re.sub(r"\{\w+(?::\w+)?\}", "\0", fields_part).split("\0")) - {""}
+        if len(separators) > 1:
+            raise ValueError(f"قالب غير صالح: {template}")
+        sep = separators.pop() if separators else prefix[-1:]
+        fields = [(name, kind or "str") for name, kind in raw_fields]
+        if sum(1 for _, kind in fields if kind in ("rest", "ref")) > 1:
+            raise ValueError(f"حقل rest واحد فقط لكل قالب: {template}")
+
+    route = {
+        "template": template,
+        "prefix": prefix,
+        "sep": sep,
+        "fields": fields,
+        "handler": handler,
+        "bound": bound,
+    }
+
+    node = CALLBACK_TRIE
+    for ch in prefix:
+        node = node.setdefault(ch, {})
+    node.setdefault(_TRIE_ROUTES, []).append(route)
+    return route
+
+
+def _parse_callback_body(route: dict, body: str) -> Optional[dict]:
+    fields = route["fields"]
+    if not fields:
+        return {} if body == "" else None
+
+    sep = route["sep"]
+    rest_idx = next((i for i, (_, kind) in enumerate(fields) if kind in ("rest", "ref")), None)
+
+    if rest_idx is None:
+        values = body.split(sep)
+        if len(values) != len(fields):
+            return None
+    else:
+        left = rest_idx
+        right = len(fields) - rest_idx - 1
+        head = body.split(sep, left) if left else [body]
+        if len(head) != left + 1:
+            return None
+        tail = head[-1].rsplit(sep, right) if right else [head[-1]]
+        if len(tail) != right + 1:
+            return None
+        values = head[:-1] + tail
+
+    args = {}
+    for (name, kind), value in zip(fields, values):
+        if value == "":
+            return None
+        if kind == "int":
+            try:
+                args[name] = int(value)
+            except ValueError:
+                return None
+        elif kind == "ref":
+            args[name] = resolve_cb_ref(value)
+        else:
+            args[name] = value
+    return args
+
+
+def match_callback_route(data: str):
+    """أطول بادئة مطابقة أولاً؛ ترجع (route, args) أو None."""
+    candidates = []
+    node = CALLBACK_TRIE
+    depth = 0
+    if _TRIE_ROUTES in node:
+        candidates.append((0, node[_TRIE_ROUTES]))
+    for ch in data:
+        node = node.get(ch)
+        if node is None:
+            break
+        depth += 1
+        if _TRIE_ROUTES in node:
+            candidates.append((depth, node[_TRIE_ROUTES]))
+
+    for depth, routes in reversed(candidates):
+        body = data[depth:]
+        for route in routes:
+            args = _parse_callback_body(route, body)
+            if args is not None:
+                if route["bound"]:
+                    args.update(route["bound"])
+                return route, args
+    return None
+
+
+def callback_args(context) -> dict:
+    """بيانات الزر بعد التحليل (من الموجّه)."""
+    return getattr(context, "callback_args", None) or {}
+
+
+async def route_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    match = match_callback_route(query.data or "")
+    if match is None:
+        metric_inc("go_callback_unrouted_total")
+        logging.warning(f"[ROUTER] ⚠️ زر بدون مسار: {query.data!r}")
+        await query.answer("⚠️ زر غير مفهوم، يرجى المحاولة مجددًا.", show_alert=True)
+        return
+
+    route, args = match
+    if any(value is CALLBACK_PAYLOAD_EXPIRED for value in args.values()):
+        logging.info(f"[ROUTER] ⌛ زر منتهي الصلاحية: {query.data!r}")
+        await query.answer("⌛ انتهت صلاحية هذا الزر، يرجى فتح القائمة من جديد عبر /go", show_alert=True)
+        return
+
+    context.callback_args = args
+    label = route["template"]
+    started = perf_counter()
+    try:
+        async with shared_state_unit():
+            return await route["handler"](update, context)
+    except Exception:
+        metric_inc("go_handler_errors_total", {"handler": label})
+        raise
+    finally:
+        metric_observe("go_handler_latency_seconds", perf_counter() - started, {"handler": label})
+
+# الموجّه يسجل زمن كل مسار بنفسه (بدل تسميته كهاندلر واحد)
+route_callback._go_instrumented = True
+
+
+async def answer_disabled_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer("🚫 هذا الزر غير نشط حالياً.")
+
 application.add_handler(CommandHandler("start", start))
 application.add_handler(CommandHandler("go", start))
 application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"(?i)^go$"), handle_go_text))
 application.add_handler(CommandHandler("go25s", handle_control_panel))
-
-# ✅ أوامر لوحة التحكم العامة + إشعار التحديث + وضع الصيانة
-application.add_handler(
-    CallbackQueryHandler(
-        handle_control_buttons,
-        pattern="^(ctrl_maintenance_on|ctrl_maintenance_off|reload_settings|add_admin|list_admins|clear_sessions|self_destruct|control_back|admins_menu|restart_session|delete_admin|broadcast_update|ctrl_backup|exit_control)$"
-    )
-)
+application.add_handler(CommandHandler("ticket", handle_ticket_lookup))
 
 # ✅ استقبال رسائل المستخدمين والمشرفين (اقتراحات وردود مخصصة)
 application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message))
 
+# ✅ أوامر لوحة التحكم العامة + إشعار التحديث + وضع الصيانة
+for _ctrl_action in (
+    "ctrl_maintenance_on", "ctrl_maintenance_off", "reload_settings", "add_admin", "list_admins",
+    "clear_sessions", "self_destruct", "control_back", "admins_menu", "restart_session",
+    "delete_admin", "broadcast_update", "ctrl_backup", "ctrl_broadcasts", "exit_control",
+):
+    add_callback_route(_ctrl_action, handle_control_buttons)
+
 # ✅ نظام الاقتراحات (إرسال + ردود سريعة + رد مخصص)
-application.add_handler(CallbackQueryHandler(send_suggestion, pattern=r"^send_suggestion$"))
+add_callback_route("send_suggestion", send_suggestion)
 # ✅ نقاشات فريق GO الداخلية
-application.add_handler(CallbackQueryHandler(start_team_general_thread, pattern=r"^team_main_\d+$"))
-# ✅ إرسال توصية فنية عامة للمجموعات
-# ✅ إرسال توصية فنية عامة للمجموعات
+add_callback_route("team_main_{user_id:int}", start_team_general_thread)
+add_callback_route("team_opinion_{user_id:int}_{suggestion_id:rest}", start_team_opinion_thread)
+add_callback_route("team_reply_{thread_id:int}", team_reply_existing_thread)
+add_callback_route("cancelteam", cancel_team_thread)
+
 # ✅ إرسال توصية فنية عامة للمجموعات
-application.add_handler(CallbackQueryHandler(start_recommendation, pattern=r"^send_reco$"))
-application.add_handler(CallbackQueryHandler(broadcast_recommendation, pattern=r"^reco_broadcast(_all)?$"))
-application.add_handler(CallbackQueryHandler(cancel_recommendation, pattern=r"^reco_cancel$"))
+add_callback_route("send_reco", start_recommendation)
+add_callback_route("reco_broadcast", broadcast_recommendation, scope="selected")
+add_callback_route("reco_broadcast_all", broadcast_recommendation, scope="all")
+add_callback_route("reco_cancel", cancel_recommendation)
 
 # ✅ اختيار المجموعات يدوياً للتوصية + التثبيت
-application.add_handler(CallbackQueryHandler(show_reco_groups, pattern=r"^reco_select$"))
-application.add_handler(CallbackQueryHandler(toggle_reco_group, pattern=r"^reco_tgl_-?\d+$"))
-application.add_handler(CallbackQueryHandler(change_reco_page, pattern=r"^reco_page_(prev|next)$"))
-application.add_handler(CallbackQueryHandler(toggle_reco_pin, pattern=r"^reco_pin_toggle$"))
-
-application.add_handler(CallbackQueryHandler(start_team_opinion_thread, pattern=r"^team_opinion_\d+_.+$"))
-application.add_handler(CallbackQueryHandler(team_reply_existing_thread, pattern=r"^team_reply_\d+$"))
-
-application.add_handler(
-    CallbackQueryHandler(handle_suggestion_reply, pattern=r"^reply(?:ready)?_\d+_.+$")
-)
-application.add_handler(CallbackQueryHandler(handle_send_reply, pattern=r"^sendreply_[a-zA-Z0-9]+_\d+_.+$"))
-application.add_handler(CallbackQueryHandler(handle_custom_reply, pattern=r"^customreply_\d+_.+$"))
-application.add_handler(CallbackQueryHandler(submit_admin_reply, pattern=r"^submit_admin_reply$"))
+add_callback_route("reco_select", show_reco_groups)
+add_callback_route("reco_tgl_{cid:int}", toggle_reco_group)
+add_callback_route("reco_page_prev", change_reco_page, direction="prev")
+add_callback_route("reco_page_next", change_reco_page, direction="next")
+add_callback_route("reco_pin_toggle", toggle_reco_pin)
+
+add_callback_route("reply_{user_id:int}_{suggestion_id:rest}", handle_suggestion_reply, prefix="reply")
+add_callback_route("replyready_{user_id:int}_{suggestion_id:rest}", handle_suggestion_reply, prefix="replyready")
+add_callback_route("sendreply_{reply_key}_{user_id:int}_{suggestion_id:rest}", handle_send_reply)
+add_callback_route("customreply_{user_id:int}_{suggestion_id:rest}", handle_custom_reply)
+add_callback_route("submit_admin_reply", submit_admin_reply)
 
 # ✅ التقييم
-application.add_handler(CallbackQueryHandler(show_statistics, pattern=r"^rate_\d+$"))
-application.add_handler(CallbackQueryHandler(save_rating, pattern=r"^ratingval_\d+_\d+$"))
+add_callback_route("rate_{user_id:int}", show_statistics)
+add_callback_route("ratingval_{rating:int}_{user_id:int}", save_rating)
+
+# ✅ القائمة الرئيسية + الرجوع
+add_callback_route("back_main_{user_id:int}", back_to_main)
+add_callback_route("back:{target}:{user_id:int}", handle_back)
+add_callback_route("parts_{user_id:int}", show_parts_menu)
+add_callback_route("maintenance_{user_id:int}", show_maintenance_menu)
+add_callback_route("consumable_{user_id:int}", show_consumable_brands)
+add_callback_route("external_{user_id:int}", show_external_parts)
+add_callback_route("extparts_{user_id:int}", show_external_parts)
+add_callback_route("suggestion_{user_id:int}", open_support_center)
+add_callback_route("coming_{user_id:int}", show_pp_teaser)
+add_callback_route("coming_soon_{user_id:int}", pp_coming_soon)
 
 # ✅ الصيانة وقطع الغيار
-application.add_handler(CallbackQueryHandler(car_choice, pattern=r"^car_.*_\d+$"))
-application.add_handler(CallbackQueryHandler(maintenance_brand_choice, pattern=r"^mbrand_.*_\d+$"))
-application.add_handler(CallbackQueryHandler(parts_brand_choice, pattern=r"^pbrand_.*_\d+$"))
-application.add_handler(CallbackQueryHandler(km_choice, pattern=r"^km_.*_\d+$"))
-application.add_handler(CallbackQueryHandler(send_cost, pattern=r"^cost_\d+_\d+$"))
-application.add_handler(CallbackQueryHandler(send_part_image, pattern=r"^part_image_\d+_\d+$"))
-
-# ✅ أزرار القوائم الخاصة بالصيانة وقطع الغيار والاقتراحات والأعطال + الرجوع
-# ✅ أزرار التصنيف داخل نفس القائمة (تحت كل فئة)
-application.add_handler(CallbackQueryHandler(button, pattern=r"^catpart_.*_\d+$"))
-
-# ✅ أزرار الخدمات الرئيسية (قطع غيار / صيانة / ... من القائمة الرئيسية)
-application.add_handler(
-    CallbackQueryHandler(
-        button,
-        pattern=r"^(parts|maintenance|consumable|external|suggestion|coming|coming_soon)_\d+$"
-    )
-)
-
-# ✅ اختيار سيارة للقطع الاستهلاكية + الرجوع لقائمة التصنيفات لنفس السيارة
-application.add_handler(CallbackQueryHandler(select_car_for_parts, pattern=r"^(carpart_|showparts_).*"))
-
-# الأعطال الشائعة من القائمة الرئيسية
-application.add_handler(CallbackQueryHandler(button, pattern=r"^faults_\d+$"))
-# ✅ تصنيفات الأعطال الفرعية
-application.add_handler(CallbackQueryHandler(button, pattern=r"^faultcat_\d+_\d+$"))
-# أزرار الرجوع القديمة من نوع back_main_USERID
-application.add_handler(CallbackQueryHandler(button, pattern=r"^back_main_\d+$"))
-# أزرار الرجوع الموحدة من نوع back:target:user_id
-application.add_handler(CallbackQueryHandler(button, pattern=r"^back:"))
-application.add_handler(CallbackQueryHandler(button, pattern=r"^cancelteam$"))
-
-application.add_handler(CallbackQueryHandler(send_brochure, pattern=r"^brochure_\d+_\d+$"))
+add_callback_route("car_{car:ref}_{user_id:int}", car_choice)
+add_callback_route("mbrand_{brand:ref}_{user_id:int}", maintenance_brand_choice)
+add_callback_route("pbrand_{brand:ref}_{user_id:int}", parts_brand_choice)
+add_callback_route("km_{km:rest}_{user_id:int}", km_choice)
+add_callback_route("cost_{index:int}_{user_id:int}", send_cost)
+add_callback_route("brochure_{index:int}_{user_id:int}", send_brochure)
+add_callback_route("part_image_{index:int}_{user_id:int}", send_part_image)
+add_callback_route("showparts_{car:ref}_{user_id:int}", select_car_for_parts)
+add_callback_route("carpart_{car:ref}_{user_id:int}", select_car_for_parts)
+add_callback_route("catpart_{keyword:ref}_{user_id:int}", show_part_category)
+
+# الأعطال الشائعة + التصنيفات الفرعية
+add_callback_route("faults_{user_id:int}", show_faults_menu)
+add_callback_route("faultcat_{idx:int}_{user_id:int}_{version}", show_fault_category)
+add_callback_route("faultcat_{idx:int}_{user_id:int}", show_fault_category)  # أزرار قديمة بدون نسخة
 
 # ✅ دليل المالك
-application.add_handler(CallbackQueryHandler(show_manual_car_list, pattern=r"^manual_"))
-application.add_handler(CallbackQueryHandler(manual_brand_choice, pattern=r"^mnlbrand_.*_\d+$"))
-application.add_handler(CallbackQueryHandler(handle_manualcar, pattern=r"^manualcar_.*_\d+$"))
-application.add_handler(CallbackQueryHandler(handle_manualdfcar, pattern=r"^openpdf_"))
+add_callback_route("manual_{user_id:int}", show_manual_car_list)
+add_callback_route("mnlbrand_{brand:ref}_{user_id:int}", manual_brand_choice)
+add_callback_route("manualcar_{car:ref}_{user_id:int}", handle_manualcar)
+add_callback_route("openpdf_{index:int}_{user_id:int}", handle_manualdfcar)
 
 # ✅ المراكز والمتاجر
-application.add_handler(CallbackQueryHandler(handle_service_centers, pattern=r"^service_\d+$"))
-application.add_handler(CallbackQueryHandler(handle_branch_list, pattern=r"^branches_\d+$"))
-application.add_handler(CallbackQueryHandler(handle_independent, pattern=r"^independent_\d+$"))
-application.add_handler(CallbackQueryHandler(show_center_list, pattern=r"^show_centers_\d+$"))
-application.add_handler(CallbackQueryHandler(show_store_list, pattern=r"^show_stores_\d+$"))
-application.add_handler(CallbackQueryHandler(set_city, pattern=r"^setcity_.*_\d+$"))
+add_callback_route("service_{user_id:int}", handle_service_centers)
+add_callback_route("branches_{user_id:int}", handle_branch_list)
+add_callback_route("independent_{user_id:int}", handle_independent)
+add_callback_route("show_centers_{user_id:int}", show_center_list)
+add_callback_route("show_stores_{user_id:int}", show_store_list)
+add_callback_route("setcity_{city:ref}_{user_id:int}", set_city)
 
 # ✅ زر الإلغاء
-application.add_handler(CallbackQueryHandler(handle_cancel, pattern=r"^cancel_"))
+add_callback_route("cancel_{kind:rest}", handle_cancel)
 
 # ✅ زر غير نشط
-application.add_handler(CallbackQueryHandler(
-    lambda u, c: asyncio.create_task(u.callback_query.answer("🚫 هذا الزر غير نشط حالياً.")),
-    pattern=r"^disabled$"
-))
+add_callback_route("disabled", answer_disabled_button)
+add_callback_route("rpage_{key}_{page:int}_{user_id:int}", change_result_page)
+add_callback_route("kbp_{name}_{page:int}_{user_id:int}_{arg:ref}", change_keyboard_page)
+
+# ✅ هاندلر واحد لكل أزرار callback (الموجّه يختار المسار)
+application.add_handler(CallbackQueryHandler(route_callback))
+
+# 📊 قياس زمن كل الهاندلرات المسجلة أعلاه
+instrument_handlers(application)
+
+# ================================================================
+#  🧷 توجيه ثابت للتحديثات بين الـ workers (GO_WORKERS > 1)
+#  - كل worker يحجز رقم slot في STATE_BACKEND (مع heartbeat)
+#  - التحديث يُعالج في slot = user_id % GO_WORKERS حتى تبقى user_data وجلسة المستخدم في نفس العملية
+#  - إن وصل لـ worker آخر يُمرر عبر طابور slot المالك في الحالة المشتركة
+# ================================================================
+WORKER_SLOT: Optional[int] = 0 if GO_WORKERS == 1 else None
+WORKER_SLOT_TTL = 30.0
+WORKER_QUEUE_POLL = 0.05
+
+metric_declare("go_updates_forwarded_total", "counter", "Webhook updates handed to the owning worker slot.")
+
+
+def update_routing_key(json_data: dict) -> Optional[int]:
+    """المستخدم صاحب التحديث (أو المحادثة إن لم يوجد مستخدم)."""
+    for field, payload in json_data.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        sender = payload.get("from") or payload.get("user")
+        if isinstance(sender, dict) and sender.get("id") is not None:
+            return int(sender["id"])
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and chat.get("id") is not None:
+            return int(chat["id"])
+    return None
+
+
+def owner_slot(json_data: dict) -> int:
+    key = update_routing_key(json_data)
+    return 0 if key is None else key % GO_WORKERS
+
+
+def is_primary_worker() -> bool:
+    """الجوبات الفردية (نسخ احتياطي / keepalive) تعمل في slot 0 فقط."""
+    return WORKER_SLOT == 0
+
+
+def _claim_worker_slot() -> Optional[int]:
+    for slot in range(GO_WORKERS):
+        if STATE_BACKEND.claim("workers", slot, WORKER_ID, WORKER_SLOT_TTL):
+            return slot
+    return None
+
+
+async def worker_slot_keeper():
+    """حجز slot ثم تجديده دورياً؛ وسحب التحديثات المحولة لهذا الـ slot."""
+    global WORKER_SLOT
+    last_heartbeat = 0.0
+    while True:
+        try:
+            now = monotonic()
+            if WORKER_SLOT is None or now - last_heartbeat > WORKER_SLOT_TTL / 3:
+                slot = await asyncio.to_thread(_claim_worker_slot) if WORKER_SLOT is None else (
+                    WORKER_SLOT
+                    if await asyncio.to_thread(STATE_BACKEND.claim, "workers", WORKER_SLOT, WORKER_ID, WORKER_SLOT_TTL)
+                    else None
+                )
+                if slot != WORKER_SLOT:
+                    logging.info(f"[WORKERS] 🧷 {WORKER_ID} → slot={slot}")
+                WORKER_SLOT = slot
+                last_heartbeat = now
+
+            if WORKER_SLOT is not None:
+                for json_data in await asyncio.to_thread(STATE_BACKEND.pop_all, f"updates:{WORKER_SLOT}"):
+                    await application.update_queue.put(Update.de_json(json_data, application.bot))
+        except Exception as e:
+            logging.error(f"[WORKERS] ❌ خطأ في مزامنة slot: {e}")
+        await asyncio.sleep(WORKER_QUEUE_POLL)
+
 
 @app.api_route("/", methods=["GET", "HEAD"])
 async def root():
     return {"message": "Bot is alive"}
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/webhook")
 async def webhook_handler(request: Request):
     json_data = await request.json()
@@ -7268,6 +10281,17 @@ async def webhook_handler(request: Request):
     # 🔎 لوق بسيط كل ما تيجي أبديت من تيليجرام
     logging.info(f"[WEBHOOK] وصل تحديث جديد من تيليجرام: keys={list(json_data.keys())}")
 
+    if GO_WORKERS > 1:
+        slot = owner_slot(json_data)
+        # نحول فقط لـ slot محجوز فعلاً من عملية أخرى؛ slot بلا مالك (بداية التشغيل أو
+        # GO_WORKERS أكبر من عدد العمليات الفعلي) يُعالج هنا بدل أن يبقى في الطابور للأبد
+        if slot != WORKER_SLOT:
+            holder = await asyncio.to_thread(STATE_BACKEND.holder, "workers", slot)
+            if holder is not None and holder != WORKER_ID:
+                metric_inc("go_updates_forwarded_total")
+                await asyncio.to_thread(STATE_BACKEND.push, f"updates:{slot}", json_data)
+                return {"ok": True}
+
     update = Update.de_json(json_data, application.bot)
     await application.update_queue.put(update)
     return {"ok": True}
@@ -7287,19 +10311,29 @@ async def on_startup():
     else:
         webhook_url = base_url.rstrip("/") + "/webhook"
 
-    try:
-        response = requests.get(
-            f"https://api.telegram.org/bot{API_TOKEN}/setWebhook",
-            params={"url": webhook_url},
-            timeout=10,
-        )
-        logging.info(f"🔗 Webhook set to {webhook_url} status={response.status_code} body={response.text}")
-    except Exception as e:
-        logging.error(f"❌ Failed to set webhook: {e}")
+    async def _register_webhook():
+        try:
+            ok = await application.bot.set_webhook(url=webhook_url)
+            logging.info(f"🔗 Webhook set to {webhook_url} ok={ok}")
+        except Exception as e:
+            logging.error(f"❌ Failed to set webhook: {e}")
 
-    await application.initialize()
+    # تسجيل الـ webhook بالتوازي مع initialize (الاثنين طلبات شبكة مستقلة)
+    await asyncio.gather(_register_webhook(), application.initialize())
     await application.start()
 
+    # 📊 مراقبة تأخر event loop
+    spawn_background(event_loop_lag_monitor(), name="event_loop_lag")
+
+    # 🔒 فك أقفال التذاكر المنتهية في موعدها
+    spawn_background(ticket_lock_reaper(), name="ticket_lock_reaper")
+
+    # 🧷 حجز slot واستقبال التحديثات المحولة (عند تشغيل أكثر من worker)
+    if GO_WORKERS > 1:
+        spawn_background(worker_slot_keeper(), name="worker_slot")
+        # ✍️ انتخاب كاتب bot_data.xlsx وسحب تعديلات بقية العمليات
+        spawn_background(excel_writer_loop(), name="excel_writer")
+
         # ✅ تفعيل JobQueue (تنظيف الجلسات + health + النسخ الاحتياطي اليومي + keepalive)
     if application.job_queue:
         application.job_queue.run_repeating(
@@ -7308,6 +10342,35 @@ async def on_startup():
             first=60           # أول تشغيل بعد 60 ثانية من الإقلاع
         )
 
+        # 👥⭐ حفظ المستخدمين والتقييمات الجديدة في الإكسل دورياً
+        application.job_queue.run_repeating(
+            state_logs_snapshot_job,
+            interval=STATE_LOGS_SNAPSHOT_INTERVAL,
+            first=STATE_LOGS_SNAPSHOT_INTERVAL,
+        )
+
+        # 📡 استئناف مهام البث التي قطعتها إعادة التشغيل
+        application.job_queue.run_repeating(
+            resume_broadcast_jobs_job,
+            interval=60,
+            first=20,
+        )
+
+        # 🎫 أرشفة التذاكر المنتهية وحذف المسودات القديمة
+        application.job_queue.run_repeating(
+            prune_tickets_job,
+            interval=6 * 60 * 60,  # كل 6 ساعات
+            first=300,
+        )
+
+        # 🗄️ تعديلات العمليات الأخرى على الحالة المشتركة → النسخ المحلية (المشرفين / المجموعات)
+        if STATE_BACKEND.shared:
+            application.job_queue.run_repeating(
+                refresh_shared_state_job,
+                interval=SHARED_CACHE_TTL,
+                first=SHARED_CACHE_TTL,
+            )
+
         # نبضات صحية دورية داخل الذاكرة فقط
         application.job_queue.run_repeating(
             health_log_job,
@@ -7337,6 +10400,16 @@ async def on_startup():
         except Exception as e:
             logging.error(f"[BACKUP] ❌ فشل جدولة النسخ الاحتياطي اليومي: {e}")
 
+        # 🔍 فحص وسائط الكتالوج يومياً قبل النسخ الاحتياطي (وقت قليل الاستخدام)
+        try:
+            application.job_queue.run_daily(
+                media_validation_job,
+                time=time(hour=3, minute=0, tzinfo=saudi_tz),
+                name="media_validation",
+            )
+        except Exception as e:
+            logging.error(f"[MEDIA CHECK] ❌ فشل جدولة فحص الوسائط: {e}")
+
         print("✅ JobQueue تم تشغيلها")
     else:
         print("⚠️ job_queue غير مفعلة أو غير جاهزة")